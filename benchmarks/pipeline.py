@@ -0,0 +1,240 @@
+"""
+Per-stage and end-to-end benchmarks of the pipeline on a synthetic session and a tiny random model, offline on cpu.
+
+Run from the root of the repository:
+    python -m benchmarks.pipeline --work_dir /tmp/bench --width 4096 --height 4096 --output bench_pipeline.json
+    python -m benchmarks.pipeline --work_dir /tmp/bench --pipeline_args "--capture_reader window --prefetch_depth 0"
+
+Each stage runs in its own process, peak memory is the peak resident size of that process.
+"""
+import os
+import json
+import time
+import shlex
+import platform
+import resource
+import subprocess
+import numpy as np
+import multiprocessing as mp
+from pathlib import Path
+from datetime import datetime
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from inference import parse_args
+from benchmarks.tiny_model import make_tiny_model, TINY_REPO_NAME
+from benchmarks.synthetic_session import make_session
+
+
+def process_peak_rss_MB() -> float:
+    """ Peak resident size since the start of the process, benchmarks run in their own process with run_isolated. """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(usage_self, usage_children) / 1024, 1)
+
+
+def run_isolated(fn, *args) -> dict:
+    """ Run a benchmark in a new process, its peak memory doesn't include the previous benchmarks. """
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def bench_capture(argv: list[str]) -> dict:
+    from src.capture_images import CaptureImages
+
+    opt = parse_args(argv)
+    capture_images = CaptureImages(opt)
+    start_t = time.perf_counter()
+    capture_images.setup(Path(opt.path_session))
+    setup_t = time.perf_counter() - start_t
+
+    tiles, start_t = 0, time.perf_counter()
+    for data in capture_images.generator():
+        tiles += len(data["frame_paths"])
+    elapsed = time.perf_counter() - start_t
+
+    return {
+        "setup_s": round(setup_t, 4), "time_s": round(elapsed, 4), "grid_tiles": len(capture_images.tile_grid),
+        "tiles": tiles, "tiles_per_s": round(tiles / elapsed, 2), "process_peak_rss_MB": process_peak_rss_MB()
+    }
+
+
+def bench_classifier(argv: list[str], n_batches: int, tile_size: int) -> dict:
+    from src.multilabel_classifier import MultiLabelClassifierCUDA
+
+    opt = parse_args(argv)
+    batch_size = int(opt.batch_size)
+    start_t = time.perf_counter()
+    model = MultiLabelClassifierCUDA(opt.multilabel_url, batch_size, opt.preprocessing, opt.pin_memory, opt.channels_last, opt.backend, opt.quantize)
+    load_t = time.perf_counter() - start_t
+
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, (batch_size, tile_size, tile_size, 3), dtype=np.uint8)
+    model.source = iter([{"frames": frames, "frame_paths": [""] * batch_size} for _ in range(n_batches + 1)])
+    generator = model.generator()
+
+    # First batch builds the backend.
+    start_t = time.perf_counter()
+    next(generator)
+    first_batch_t = time.perf_counter() - start_t
+
+    start_t = time.perf_counter()
+    for _ in generator:
+        pass
+    elapsed = time.perf_counter() - start_t
+    tiles = n_batches * batch_size
+
+    return {
+        "load_s": round(load_t, 4), "first_batch_s": round(first_batch_t, 4), "time_s": round(elapsed, 4),
+        "tiles": tiles, "tiles_per_s": round(tiles / elapsed, 2), "process_peak_rss_MB": process_peak_rss_MB()
+    }
+
+
+def bench_savers(argv: list[str], scores_path: str) -> dict:
+    from src.capture_images import CaptureImages
+    from src.savers import MultilabelPredictions
+    from src.libs.multilabel_model import getDynoConfig, get_repo_path
+
+    opt = parse_args(argv)
+    capture_images = CaptureImages(opt)
+    capture_images.setup(Path(opt.path_session))
+    tile_grid = capture_images.tile_grid
+    classes = list(getDynoConfig(get_repo_path(opt.multilabel_url))["label2id"].keys())
+
+    # Random scores for all tiles of the grid.
+    batch_size, rng = int(opt.batch_size), np.random.default_rng(0)
+    batches = []
+    for start in range(0, len(tile_grid), batch_size):
+        tiles_index = np.arange(start, min(start + batch_size, len(tile_grid)))
+        batches.append({
+            "frame_paths": [tile_grid.filename("bench", index) for index in tiles_index],
+            "frames_position": tile_grid.lonlat[tiles_index],
+            "frames_grid_index": tile_grid.grid_index(tiles_index),
+            "multilabel_scores": rng.random((len(tiles_index), len(classes)), dtype=np.float32)
+        })
+
+    savers = MultilabelPredictions(classes, opt.export_csv, opt.checkpoint_every)
+    start_t = time.perf_counter()
+    savers.setup(Path(scores_path))
+    savers.source = iter(batches)
+    for _ in savers.generator():
+        pass
+    savers.cleanup()
+    elapsed = time.perf_counter() - start_t
+
+    return {
+        "time_s": round(elapsed, 4), "tiles": len(tile_grid), "tiles_per_s": round(len(tile_grid) / elapsed, 2),
+        "bytes": Path(scores_path).stat().st_size, "process_peak_rss_MB": process_peak_rss_MB()
+    }
+
+
+def bench_rasters(argv: list[str], scores_path: str, output_dir: str) -> dict:
+    from src.capture_images import CaptureImages
+    from src.libs.multilabel_model import getDynoConfig, get_repo_path
+    from src.libs.predictions_raster_tools import create_rasters_for_classes, create_raster_from_tile_grid
+
+    opt = parse_args(argv)
+    classes = list(getDynoConfig(get_repo_path(opt.multilabel_url))["label2id"].keys())
+    Path(output_dir).mkdir(exist_ok=True, parents=True)
+
+    start_t = time.perf_counter()
+    if opt.raster_mode == "grid":
+        capture_images = CaptureImages(opt)
+        capture_images.setup(Path(opt.path_session))
+        create_raster_from_tile_grid(scores_path, classes, capture_images.tile_grid, f"EPSG:{opt.matching_crs}", output_dir, "bench")
+    else:
+        create_rasters_for_classes(scores_path, classes, output_dir, "bench", "linear", opt.raster_workers)
+    elapsed = time.perf_counter() - start_t
+
+    return {"mode": opt.raster_mode, "classes": len(classes), "time_s": round(elapsed, 4), "process_peak_rss_MB": process_peak_rss_MB()}
+
+
+def bench_end_to_end(argv: list[str]) -> dict:
+    from inference import pipeline_seatizen
+
+    opt = parse_args(argv)
+    start_t = time.perf_counter()
+    pipeline_seatizen(opt)
+    elapsed = time.perf_counter() - start_t
+
+    session = Path(opt.path_session)
+    with open(Path(session, "PROCESSED_DATA", "IA", f"{session.name}_pipeline_metrics.json")) as f:
+        metrics = json.load(f)
+
+    tiles = max([stage["items"] for stage in metrics["stages"].values()] + [0])
+    return {
+        "time_s": round(elapsed, 4), "tiles": tiles, "tiles_per_s": round(tiles / elapsed, 2),
+        "raster_step_s": metrics["steps"].get("create_rasters_for_classes", {}).get("wall_time_s"),
+        "process_peak_rss_MB": process_peak_rss_MB(), "metrics": metrics
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = ArgumentParser(description="Benchmark the pipeline on a synthetic session")
+    ap.add_argument("--work_dir", required=True, help="Folder of the synthetic session and outputs")
+    ap.add_argument("--width", type=int, default=4096, help="Orthophoto width in pixels")
+    ap.add_argument("--height", type=int, default=4096, help="Orthophoto height in pixels")
+    ap.add_argument("--gsd", type=float, default=1.5, help="Ground sampling distance in cm")
+    ap.add_argument("--compress", default="deflate", help="Compression of the tif, none to disable")
+    ap.add_argument("--block_size", type=int, default=256, help="Internal tile size of the tif")
+    ap.add_argument("--batch_size", type=int, default=16, help="Batch size of the pipeline")
+    ap.add_argument("--classifier_batches", type=int, default=20, help="Number of batches of the classifier benchmark")
+    ap.add_argument("--stages", nargs="+", default=["capture", "classifier", "savers", "rasters", "end_to_end"], help="Benchmarks to run")
+    ap.add_argument("--pipeline_args", default="", help="Extra arguments of inference.py, like \"--capture_reader window\"")
+    ap.add_argument("--output", default=None, help="Json file for the results")
+    args = ap.parse_args()
+
+    # Offline on cpu, spawned processes inherit the environment.
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    os.environ["HF_HUB_OFFLINE"] = "1"
+
+    session = make_session(args.work_dir, width=args.width, height=args.height, gsd_cm=args.gsd, block_size=args.block_size,
+                           compress=None if args.compress == "none" else args.compress)
+    make_tiny_model(TINY_REPO_NAME)
+
+    argv = [
+        "-eses", "-pses", str(session), "-mlu", TINY_REPO_NAME, "-bs", str(args.batch_size), "-np", "-c",
+        *shlex.split(args.pipeline_args)
+    ]
+    opt = parse_args(argv)
+    tile_size = int(opt.tiles_size_meters // (args.gsd / 100))
+    scores_path = str(Path(args.work_dir, "bench_scores.parquet"))
+
+    benchmarks = {
+        "capture": (bench_capture, argv),
+        "classifier": (bench_classifier, argv, args.classifier_batches, tile_size),
+        "savers": (bench_savers, argv, scores_path),
+        "rasters": (bench_rasters, argv, scores_path, str(Path(args.work_dir, "bench_rasters"))),
+        "end_to_end": (bench_end_to_end, argv)
+    }
+
+    results = {
+        "date": datetime.now().isoformat(),
+        "git_revision": git_revision(),
+        "host": {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(), "python": platform.python_version()},
+        "config": {**vars(args), "tile_size": tile_size, "argv": argv},
+        "stages": {}
+    }
+    for name in args.stages:
+        # Rasters are created from the scores written by the savers benchmark.
+        if name == "rasters" and not Path(scores_path).exists():
+            results["stages"]["savers"] = run_isolated(*benchmarks["savers"])
+
+        fn, *fn_args = benchmarks[name]
+        results["stages"][name] = run_isolated(fn, *fn_args)
+        print(name, {k: v for k, v in results["stages"][name].items() if k != "metrics"})
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
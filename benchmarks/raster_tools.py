@@ -0,0 +1,85 @@
+"""
+Benchmark of the vectorized raster tools against the previous pure python loops.
+
+Run from the root of the repository:
+    python -m benchmarks.raster_tools --sizes 10000 100000 1000000 --output bench_raster_tools.json
+"""
+import json
+import time
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+from math import radians, cos, sin, sqrt, atan2
+
+from matplotlib.path import Path
+from scipy.spatial import ConvexHull
+
+from src.libs.predictions_raster_tools import compute_grid_value
+
+
+def reference_compute_grid_value(predictions):
+    """ Previous implementation, one scalar haversine by pair of rows. """
+    def haversine(point1, point2):
+        lat1, lon1, lat2, lon2 = map(radians, [*point1, *point2])
+        a = sin((lat2 - lat1) / 2)**2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2)**2
+        return 6371000 * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    distances = []
+    for i in range(len(predictions) - 1):
+        p1 = (predictions.iloc[i]['GPSLatitude'], predictions.iloc[i]['GPSLongitude'])
+        p2 = (predictions.iloc[i+1]['GPSLatitude'], predictions.iloc[i+1]['GPSLongitude'])
+        distances.append(haversine(p1, p2))
+    return np.median(distances)
+
+
+def synthetic_predictions(n_points, seed=0):
+    """ Tiles centroid on a jittered regular grid of 1.5m around Reunion island. """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_points)))
+    rows, cols = np.divmod(np.arange(n_points), side)
+    return pd.DataFrame({
+        "GPSLatitude": -21.1 + rows * 1.35e-5 + rng.normal(0, 1e-7, n_points),
+        "GPSLongitude": 55.2 + cols * 1.45e-5 + rng.normal(0, 1e-7, n_points)
+    })
+
+
+def timed(fn, *args):
+    start_t = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_t
+
+
+def main():
+    ap = ArgumentParser(description="Benchmark raster tools")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Number of points")
+    ap.add_argument("--max_reference_points", type=int, default=100_000, help="Don't run the python loops above this number of points")
+    ap.add_argument("--output", default=None, help="Json file for the results")
+    args = ap.parse_args()
+
+    results = []
+    for n_points in args.sizes:
+        predictions = synthetic_predictions(n_points)
+        points = predictions[["GPSLongitude", "GPSLatitude"]].to_numpy()
+        hull_path = Path(points[ConvexHull(points).vertices])
+        grid = points + 0.3e-5  # Same number of grid cells than points.
+
+        grid_value, grid_value_t = timed(compute_grid_value, predictions)
+        mask, mask_t = timed(hull_path.contains_points, grid)
+        result = {"points": n_points, "grid_value_s": grid_value_t, "hull_mask_s": mask_t}
+
+        if n_points <= args.max_reference_points:
+            reference_value, result["reference_grid_value_s"] = timed(reference_compute_grid_value, predictions)
+            reference_mask, result["reference_hull_mask_s"] = timed(lambda g: np.array([hull_path.contains_point(p) for p in g]), grid)
+            result["grid_value_abs_diff"] = abs(float(grid_value - reference_value))
+            result["hull_mask_equal"] = bool(np.array_equal(mask, reference_mask))
+
+        print(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
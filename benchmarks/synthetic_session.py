@@ -0,0 +1,103 @@
+"""
+Synthetic drone session with an orthophoto and the odm report read by the pipeline.
+
+Run from the root of the repository:
+    python -m benchmarks.synthetic_session --output_dir /tmp/bench_sessions --width 8192 --height 8192 --compress deflate
+"""
+import json
+import numpy as np
+from pathlib import Path
+from argparse import ArgumentParser
+
+import rasterio
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+
+# South west of Reunion island in EPSG:32740.
+ORIGIN = (330000.0, 7650000.0)
+
+
+def footprint_mask(rows: np.ndarray, width: int, height: int, border: float) -> np.ndarray:
+    """ Valid pixels of a rotated ellipse filling the image, with a black border of about border * size around it. """
+    y, x = np.meshgrid(rows, np.arange(width), indexing="ij")
+    u, v = (x - width / 2) / (width / 2), (y - height / 2) / (height / 2)
+    angle = np.radians(20)
+    ur, vr = u * np.cos(angle) - v * np.sin(angle), u * np.sin(angle) + v * np.cos(angle)
+    return (ur / (1 - border))**2 + (vr / (1 - border) * 0.9)**2 <= 1
+
+
+def texture(rows: np.ndarray, width: int, rng: np.random.Generator) -> np.ndarray:
+    """ Smooth colored waves with noise, compressible like a real orthophoto. """
+    y, x = np.meshgrid(rows, np.arange(width), indexing="ij")
+    bands = []
+    for i, (fx, fy) in enumerate([(0.011, 0.007), (0.005, 0.013), (0.009, 0.003)]):
+        wave = 90 + 60 * np.sin(x * fx + i) * np.cos(y * fy - i)
+        bands.append(wave + rng.normal(0, 12, wave.shape))
+    return np.clip(np.stack(bands), 1, 254).astype(np.uint8)
+
+
+def make_session(output_dir: str, name: str = "20240101_REU-SYNTHETIC_UAV-01_01", width: int = 4096, height: int = 4096,
+                 gsd_cm: float = 1.5, crs: str = "32740", block_size: int = 256, compress: str | None = "deflate",
+                 border: float = 0.1, overviews: bool = True, seed: int = 0) -> Path:
+    """ Write PROCESSED_DATA/PHOTOGRAMMETRY with an RGBA odm_orthophoto.tif and odm_report/stats.json, return the session path. """
+    session = Path(output_dir, name)
+    orthophoto_dir = Path(session, "PROCESSED_DATA", "PHOTOGRAMMETRY", "odm_orthophoto")
+    report_dir = Path(session, "PROCESSED_DATA", "PHOTOGRAMMETRY", "odm_report")
+    orthophoto_dir.mkdir(exist_ok=True, parents=True)
+    report_dir.mkdir(exist_ok=True, parents=True)
+
+    with open(Path(report_dir, "stats.json"), "w") as f:
+        json.dump({"odm_processing_statistics": {"average_gsd": gsd_cm}}, f)
+
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": 4, "dtype": "uint8",
+        "crs": CRS.from_epsg(int(crs)), "transform": from_origin(*ORIGIN, gsd_cm / 100, gsd_cm / 100),
+        "tiled": True, "blockxsize": block_size, "blockysize": block_size, "photometric": "RGB",
+        **({"compress": compress} if compress else {})
+    }
+
+    # Written by strips of blocks to bound memory, pixels outside the footprint are black and transparent.
+    rng = np.random.default_rng(seed)
+    with rasterio.open(Path(orthophoto_dir, "odm_orthophoto.tif"), "w", **profile) as dst:
+        dst.colorinterp = [rasterio.enums.ColorInterp.red, rasterio.enums.ColorInterp.green, rasterio.enums.ColorInterp.blue, rasterio.enums.ColorInterp.alpha]
+        for row_start in range(0, height, block_size):
+            rows = np.arange(row_start, min(row_start + block_size, height))
+            valid = footprint_mask(rows, width, height, border)
+            rgb = texture(rows, width, rng) * valid
+            alpha = (valid * 255).astype(np.uint8)
+            dst.write(np.concatenate((rgb, alpha[None])), window=Window(0, row_start, width, len(rows)))
+
+        if overviews:
+            factors = [f for f in [2, 4, 8, 16, 32, 64] if min(width, height) // f >= 64]
+            dst.build_overviews(factors, Resampling.average)
+
+    return session
+
+
+def main():
+    ap = ArgumentParser(description="Generate a synthetic drone session")
+    ap.add_argument("--output_dir", required=True, help="Folder of the session")
+    ap.add_argument("--name", default="20240101_REU-SYNTHETIC_UAV-01_01", help="Session name")
+    ap.add_argument("--width", type=int, default=4096, help="Orthophoto width in pixels")
+    ap.add_argument("--height", type=int, default=4096, help="Orthophoto height in pixels")
+    ap.add_argument("--gsd", type=float, default=1.5, help="Ground sampling distance in cm")
+    ap.add_argument("--crs", default="32740", help="EPSG code of the orthophoto")
+    ap.add_argument("--block_size", type=int, default=256, help="Internal tile size of the tif")
+    ap.add_argument("--compress", default="deflate", help="Compression of the tif, none to disable")
+    ap.add_argument("--border", type=float, default=0.1, help="Relative width of the black border")
+    ap.add_argument("--no_overviews", action="store_true", help="Don't build overviews")
+    ap.add_argument("--seed", type=int, default=0, help="Seed of the texture noise")
+    args = ap.parse_args()
+
+    session = make_session(
+        args.output_dir, args.name, args.width, args.height, args.gsd, args.crs, args.block_size,
+        None if args.compress == "none" else args.compress, args.border, not args.no_overviews, args.seed
+    )
+    print(f"Session written at {session}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Small randomly initialized NewHeadDinoV2ForImageClassification saved like a downloaded hugging face repository.
+
+Run from the root of the repository:
+    python -m benchmarks.tiny_model --repo_name benchmarks/tiny-dinov2 --num_labels 12
+"""
+import json
+import torch
+from pathlib import Path
+from argparse import ArgumentParser
+from transformers import Dinov2Config
+
+from src.libs.multilabel_model import NewHeadDinoV2ForImageClassification, PATH_TO_MULTILABEL_DIRECTORY
+
+
+TINY_REPO_NAME = "benchmarks/tiny-dinov2"
+
+
+def make_tiny_model(repo_name: str = TINY_REPO_NAME, num_labels: int = 12, image_size: int = 56, hidden_size: int = 64,
+                    num_hidden_layers: int = 2, num_attention_heads: int = 2, seed: int = 0) -> Path:
+    """ Save model, config and image processor in models/multilabel/<repo_name>, loaded offline by the pipeline. """
+    repo_path = Path(Path.cwd(), PATH_TO_MULTILABEL_DIRECTORY, repo_name)
+    repo_path.mkdir(exist_ok=True, parents=True)
+
+    labels = [f"Class_{i:02d}" for i in range(num_labels)]
+    config = Dinov2Config(
+        image_size=image_size, patch_size=14, hidden_size=hidden_size, num_hidden_layers=num_hidden_layers,
+        num_attention_heads=num_attention_heads, intermediate_size=hidden_size * 4, num_labels=num_labels,
+        label2id={label: i for i, label in enumerate(labels)}, id2label={i: label for i, label in enumerate(labels)},
+        problem_type="multi_label_classification"
+    )
+
+    torch.manual_seed(seed)
+    model = NewHeadDinoV2ForImageClassification(config).eval()
+    model.save_pretrained(repo_path, safe_serialization=True)
+
+    # Same image processor as DINOv2 models with a smaller input.
+    with open(Path(repo_path, "preprocessor_config.json"), "w") as f:
+        json.dump({
+            "image_processor_type": "BitImageProcessor",
+            "do_resize": True, "size": {"shortest_edge": image_size + image_size // 7}, "resample": 3,
+            "do_center_crop": True, "crop_size": {"height": image_size, "width": image_size},
+            "do_rescale": True, "rescale_factor": 1 / 255,
+            "do_normalize": True, "image_mean": [0.485, 0.456, 0.406], "image_std": [0.229, 0.224, 0.225],
+            "do_convert_rgb": True
+        }, f, indent=4)
+
+    return repo_path
+
+
+def main():
+    ap = ArgumentParser(description="Save a tiny random multilabel model")
+    ap.add_argument("--repo_name", default=TINY_REPO_NAME, help="Name of the repository in models/multilabel")
+    ap.add_argument("--num_labels", type=int, default=12, help="Number of classes")
+    ap.add_argument("--image_size", type=int, default=56, help="Model input size, multiple of the patch size 14")
+    ap.add_argument("--hidden_size", type=int, default=64, help="Hidden size of the backbone")
+    ap.add_argument("--layers", type=int, default=2, help="Number of transformer layers")
+    args = ap.parse_args()
+
+    repo_path = make_tiny_model(args.repo_name, args.num_labels, args.image_size, args.hidden_size, args.layers)
+    print(f"Model written at {repo_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,27 @@
+import time
+START_T = time.perf_counter()
+
 import shutil
-import traceback
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
 from argparse import Namespace, ArgumentParser
 
-from src.libs.parse_opt import get_list_sessions
-from src.libs.predictions_raster_tools import create_rasters_for_classes
+from src.libs.parse_opt import get_list_sessions, get_orthophoto_path
+from src.libs.checkpoint import SessionCheckpoint, model_revision, session_manifest, is_up_to_date, has_up_to_date_scores, TILING_ARGS
+from src.libs.score_cache import ScoreCache, score_cache_key
+from src.libs.embedding_store import EmbeddingStore, backbone_fingerprint
+from src.libs.metrics import SessionMetrics, SessionProfiler
+from src.libs.session_scheduler import SessionScheduler, postprocess_session
+from src.libs.sharding import shard_sessions, SessionClaims
 
+from src.pipeline import Pipeline, PrefetchStage
 from src.capture_images import CaptureImages
-from src.savers import MultilabelPredictions
-from src.multilabel_classifier import MultiLabelClassifierCUDA
+from src.cached_scores import CachedScores, ScoreCacheWriter
+from src.embeddings import StoredEmbeddings, EmbeddingWriter
+from src.tile_deduplicator import TileDeduplicator, DuplicateScoresExpander, CoarseScores
 
-def parse_args() -> Namespace:
+def parse_args(argv: list[str] | None = None) -> Namespace:
 
     # Parse command line arguments.
     ap = ArgumentParser(description="Drone inference", epilog="Thanks to use it!")
@@ -32,6 +41,15 @@ def parse_args() -> Namespace:
     # Choose how to used multilabel model.
     ap.add_argument("-mlu", "--multilabel_url", default="lombardata/drone-DinoVdeau-from-probs-large-2024_11_15-batch-size32_freeze_probs", help="Hugging face repository")
     ap.add_argument("-nml", "--no_multilabel", action="store_true", help="Didn't used multilabel model")
+    ap.add_argument("-bk", "--backend", type=str, default="torch", choices=["torch", "torchscript", "onnx"], help="Inference backend, exported models are cached next to the hugging face model. onnx needs onnxruntime.")
+    ap.add_argument("-q", "--quantize", type=str, default=None, choices=["int8"], help="Dynamic quantization of the model, cpu only.")
+    ap.add_argument("-pre", "--preprocessing", type=str, default="fast", choices=["fast", "hf"], help="Preprocess batches with batched torch operations or with the hugging face image processor.")
+    ap.add_argument("-cpre", "--check_preprocessing", action="store_true", help="Compare the fast preprocessing with the hugging face image processor on the first batch, and fall back on it if they differ.")
+    ap.add_argument("-pin", "--pin_memory", action="store_true", help="Copy batches to gpu from pinned memory.")
+    ap.add_argument("-chl", "--channels_last", action="store_true", help="Use channels last memory format for the model and inputs.")
+    ap.add_argument("-sem", "--save_embeddings", action="store_true", help="Save pooled backbone features of each tile in PROCESSED_DATA/IA to rescore them with another head.")
+    ap.add_argument("-rse", "--rescore_embeddings", action="store_true", help="Run only the classifier head on saved backbone features, sessions without features of the same backbone are fully inferred.")
+    ap.add_argument("-rsb", "--rescore_batch_size", type=int, default=8192, help="Numbers of features processed in one time by the head when rescoring.")
 
 
     # Orthophoto arguments.
@@ -41,112 +59,305 @@ def parse_args() -> Namespace:
     ap.add_argument('-vs', '--v_shift', type=float, default=0, help='Vertical overlap.')
     ap.add_argument('-bptp', '--black_pixels_threshold_percentage', type=float, default=5, help="Don't keep tile if we have a bigger percentage of black pixels than threshold.")
     ap.add_argument('-wptp', '--white_pixels_threshold_percentage', type=float, default=5, help="Don't keep tile if we have a bigger percentage of white pixels than threshold.")
+    ap.add_argument('-cr', '--capture_reader', type=str, default="strip", choices=["strip", "window"], help="Read orthophoto by block aligned row strips or with one window per tile.")
+    ap.add_argument('-op', '--overview_prefilter', action="store_true", help="Skip tiles without data in the orthophoto overview before reading them at full resolution.")
+    ap.add_argument('-cw', '--capture_workers', type=int, default=0, help="Number of processes to read and filter tiles. 0 to read in the main process.")
+    ap.add_argument('-dd', '--dedup_threshold', type=float, default=None, help="Copy the scores of a recent tile to tiles whose signature differs by less than the threshold, in [0, 1]. Not set to infer all tiles.")
+    ap.add_argument('-ddw', '--dedup_window', type=int, default=256, help="Number of recent inferred tiles compared with each tile.")
+    ap.add_argument('-cs', '--coarse_step', type=int, default=1, help="Infer one tile every n rows and columns first, then only tiles where the coarse scores change. 1 to infer all tiles.")
+    ap.add_argument('-ct', '--coarse_threshold', type=float, default=0.1, help="Maximum difference of the coarse scores around a tile to copy the nearest coarse scores.")
 
 
     # Optional arguments.
     ap.add_argument("-np", "--no-progress", action="store_true", help="Hide display progress")
     ap.add_argument("-ns", "--no-save", action="store_true", help="Don't save annotations")
+    ap.add_argument("-xcsv", "--export_csv", action="store_true", help="Also export scores in a csv file next to the parquet file")
     ap.add_argument("-npr", "--no_prediction_raster", action="store_true", help="Don't produce predictions rasters")
-    ap.add_argument("-c", "--clean", action="store_true", help="Clean pdf preview and predictions files")
+    ap.add_argument("-nsi", "--no_session_index", action="store_true", help="Don't produce the memory-mapped tile index of each session, used for bounding box, nearest tile and top-k queries")
+    ap.add_argument("-rm", "--raster_mode", type=str, default="interpolate", choices=["interpolate", "grid"], help="Interpolate a raster by class in EPSG:4326, or write one multi-band raster with a pixel by tile in the orthophoto crs")
+    ap.add_argument("-rw", "--raster_workers", type=int, default=0, help="Number of processes to write the interpolated class rasters. 0 to write them in the main process")
+    ap.add_argument("-ppw", "--postprocess_workers", type=int, default=0, help="Number of processes creating rasters of finished sessions while the next sessions are inferred. 0 to create them before the next session")
+    ap.add_argument("-ppb", "--postprocess_backlog", type=int, default=2, help="Maximum number of finished sessions waiting for post-processing before inference waits")
+    ap.add_argument("-c", "--clean", action="store_true", help="Clean pdf preview and predictions files, sessions up to date are processed again")
+    ap.add_argument("-scd", "--score_cache_dir", type=str, default=None, help="Directory of the score cache, sessions already inferred with the same orthophoto, tiling, thresholds and model skip capture and classification")
+    ap.add_argument("-scs", "--score_cache_size_mb", type=float, default=2000, help="Maximum size of the score cache, least recently used sessions are evicted")
+    ap.add_argument("-ckpt", "--checkpoint_every", type=int, default=100, help="Commit scores every n batches to resume an interrupted session. 0 to disable")
     ap.add_argument("-is", "--index_start", default="0", help="Choose from which index to start")
     ap.add_argument("-ip", "--index_position", default="-1", help="if != -1, take only session at selected index")
-    ap.add_argument("-bs", "--batch_size", default="1", help="Numbers of frames processed in one time")
+    ap.add_argument("-sh", "--shard", type=str, default=None, help="K/N, process only the K-th of N shards of the sessions. Shards are balanced by orthophoto size")
+    ap.add_argument("-cd", "--claim_dir", type=str, default=None, help="Shared directory of claim files, workers using the same directory never process the same session")
+    ap.add_argument("-bs", "--batch_size", default="1", help="Numbers of frames processed in one time, auto to probe the fastest one fitting in memory")
+    ap.add_argument("-bmem", "--batch_memory_mb", type=float, default=None, help="Memory limit of --batch_size auto, default to 90%% of gpu memory or half of the total ram")
+    ap.add_argument("-mb", "--memory_budget_mb", type=float, default=None, help="Streaming mode for large orthophotos. Bound capture bands and batches, and write rasters by windows in tiled GeoTIFF.")
+    ap.add_argument("-pd", "--prefetch_depth", type=int, default=2, help="Number of batches buffered between threaded pipeline tasks. 0 to run all tasks in the main thread.")
+    ap.add_argument("-prof", "--profile", type=str, default=None, choices=["cprofile", "pyinstrument"], help="Profile the main thread of each session and save the profile in PROCESSED_DATA/IA")
     ap.add_argument("-minp", "--min_prediction", default="100", help="Minimum for keeping predictions after inference.")
 
-    return ap.parse_args()
+    return ap.parse_args(argv)
+
+def coarse_pass(capture_images: CaptureImages, multilabel_model, coarse_scores: CoarseScores) -> None:
+    """ Infer one tile every coarse step rows and columns of the session set up in capture_images. """
+    coarse_scores.setup(capture_images.tile_grid, len(multilabel_model.classes_name))
+    start_index, capture_images.start_index = capture_images.start_index, 0
+    capture_images.tile_mask = capture_images.tile_grid.coarse_mask(coarse_scores.step)
+
+    # Coarse tasks are timed as one step, the task stages only count the full pass.
+    metrics, Pipeline.metrics = Pipeline.metrics, None
+    try:
+        with metrics.timed("coarse_pass") as stats:
+            for _ in capture_images | multilabel_model | coarse_scores:
+                pass
+            stats.items += coarse_scores.tiles
+    finally:
+        Pipeline.metrics = metrics
+        capture_images.start_index, capture_images.tile_mask = start_index, None
 
 def pipeline_seatizen(opt: Namespace):
     print("\n-- Parse input options", end="\n\n")
     
     batch_size = int(opt.batch_size) if opt.batch_size.isnumeric() else 1
 
+    # Backbone features of skipped tiles are not computed.
+    deduplicate = opt.dedup_threshold is not None or opt.coarse_step > 1
+    if deduplicate and opt.save_embeddings:
+        print("[WARNING] Backbone features are not saved with deduplication or coarse inference.")
+        opt.save_embeddings = False
+
     print("\n-- Load the pipeline ...", end="\n\n")
-    capture_images = CaptureImages(opt)
+    startup = {"imports_s": round(time.perf_counter() - START_T, 4)}
+
+    # Load Hugging face model, torch, transformers and pyarrow are only imported with the model.
+    multilabel_model, multilabel_savers = None, None
+    if not opt.no_multilabel:
+        from src.savers import MultilabelPredictions
+        from src.multilabel_classifier import MultiLabelClassifierCUDA
+
+        model_load_t = time.perf_counter()
+        multilabel_model = MultiLabelClassifierCUDA(opt.multilabel_url, batch_size, opt.preprocessing, opt.pin_memory, opt.channels_last, opt.backend, opt.quantize, opt.save_embeddings, opt.check_preprocessing)
+        startup["model_load_s"] = round(time.perf_counter() - model_load_t, 4)
+
+        if opt.batch_size == "auto":
+            batch_size = multilabel_model.autotune_batch_size(opt.batch_memory_mb)
+
+        if not opt.no_save:
+            multilabel_savers = MultilabelPredictions(multilabel_model.classes_name, opt.export_csv, opt.checkpoint_every)
 
-    # Load Hugging face model.
-    multilabel_model = None 
-    if opt.no_multilabel:
-        multilabel_model = None 
-    else:
-        multilabel_model = MultiLabelClassifierCUDA(opt.multilabel_url, batch_size)
+    # Capture builds batches of the size chosen for the model.
+    capture_images = CaptureImages(opt, batch_size)
 
-    multilabel_savers = None if opt.no_multilabel else MultilabelPredictions(multilabel_model.classes_name)
-    if opt.no_save:
-        multilabel_savers = None
+    # Outputs depend on the model weights.
+    revision = model_revision(multilabel_model.repo_path) if multilabel_model else None
+
+    score_cache = ScoreCache(opt.score_cache_dir, opt.score_cache_size_mb) if opt.score_cache_dir and multilabel_savers else None
+    score_cache_writer = ScoreCacheWriter(score_cache, multilabel_model.classes_name) if score_cache else None
+
+    # Saved features can be rescored by any head sharing the backbone and preprocessing.
+    fingerprint = None
+    if multilabel_model and (opt.save_embeddings or opt.rescore_embeddings):
+        fingerprint = backbone_fingerprint(multilabel_model.model, multilabel_model.repo_path)
+    embedding_writer = EmbeddingWriter(fingerprint) if multilabel_model and opt.save_embeddings else None
+
+    # Skip the classifier on near duplicate tiles and where coarse scores don't change.
+    deduplicator, expander, coarse_scores = None, None, None
+    if multilabel_model and deduplicate:
+        deduplicator = TileDeduplicator(opt.dedup_threshold, opt.dedup_window)
+        expander = DuplicateScoresExpander(opt.dedup_window)
+        coarse_scores = CoarseScores(opt.coarse_step, opt.coarse_threshold) if opt.coarse_step > 1 else None
 
     # Stat
-    sessions_fail = []
     list_session = get_list_sessions(opt)
     index_start = int(opt.index_start) if opt.index_start.isnumeric() and int(opt.index_start) < len(list_session) else 0
     index_position = int(opt.index_position)-1 if opt.index_position.isnumeric() and \
                                             int(opt.index_position) > 0 and \
                                             int(opt.index_position) <= len(list_session) else -1
     sessions = list_session[index_start:] if index_position == -1 else [list_session[index_position]]
+    if opt.shard:
+        sessions = shard_sessions(sessions, opt.shard)
+        print(f"\n-- Shard {opt.shard}: {len(sessions)} sessions", end="\n\n")
+
+    # Claim each session before processing it, and record its status when post-processing ends.
+    claims = SessionClaims(opt.claim_dir) if opt.claim_dir else None
+    scheduler = SessionScheduler(opt.postprocess_workers, opt.postprocess_backlog, claims.release if claims else None)
     print("\n-- Start inference !", end="\n\n")
 
-    for session in sessions:
-
-        print(f"\nLaunched session {session.name}\n\n")
-
-        # Clean sessions if needed
-        path_IA = Path(session, "PROCESSED_DATA/IA")
-        if Path.exists(path_IA) and opt.clean:
-            print("\t-- Clean session \n\n")
-            shutil.rmtree(path_IA)
-        path_IA.mkdir(exist_ok=True, parents=True)
-
-        multilabel_scores_csv_name = Path(session, "PROCESSED_DATA/IA", f"{session.name}_{opt.multilabel_url.replace('/', '_')}_scores.csv")
-
-        # Setup pipeline for current session
-        capture_images.setup(session)
-        if multilabel_savers:
-            multilabel_savers.setup(multilabel_scores_csv_name) 
-
-        pipeline = (
-            capture_images |
-            multilabel_model | 
-            multilabel_savers
-        )
-
-        # Iterate through pipeline
-        start_t = datetime.now()
-        print("\t-- Start prediction session \n\n")
-        progress = tqdm(disable=opt.no_progress)
-        
-        try:
-            for _ in pipeline:
-                progress.update(1)
-        except StopIteration:
-            return
-        except KeyboardInterrupt:
-            return
-        finally:
-            progress.close()
-
-        # Pipeline cleanup.
-        if multilabel_savers:
-            multilabel_savers.cleanup()
-
-        print(f"\n -- Elapsed time: {datetime.now() - start_t} seconds\n\n")
-
-        try:
-          
-            # Create raster predictions
-            print("\t-- Creating raster for each class \n\n")
-            if not opt.no_prediction_raster:
-                create_rasters_for_classes(multilabel_scores_csv_name, multilabel_model.classes_name, path_IA, session.name, 'linear')
+    # Claim of the session being inferred, released if the loop stops on an error or an interrupt.
+    current = None
+    try:
+        for session in sessions:
+
+            if claims and not claims.claim(session):
+                print(f"\nSession {session.name} already claimed by another worker, skip it.\n")
+                continue
+            current = session
+
+            print(f"\nLaunched session {session.name}\n\n")
+
+            # Clean sessions if needed
+            path_IA = Path(session, "PROCESSED_DATA/IA")
+            if Path.exists(path_IA) and opt.clean:
+                print("\t-- Clean session \n\n")
+                shutil.rmtree(path_IA)
+            path_IA.mkdir(exist_ok=True, parents=True)
+
+            multilabel_scores_name = Path(session, "PROCESSED_DATA/IA", f"{session.name}_{opt.multilabel_url.replace('/', '_')}_scores.parquet")
+
+            # Skip sessions completed with the same orthophoto, model and parameters, only post-process sessions with the same scores,
+            # else resume from the last checkpoint.
+            manifest, checkpoint, postprocess_only = None, None, False
+            if multilabel_savers and get_orthophoto_path(session).is_file():
+                manifest = session_manifest(get_orthophoto_path(session), opt, revision)
+                if is_up_to_date(path_IA, session.name, manifest, multilabel_scores_name):
+                    print(f"\t-- Session {session.name} is up to date, skip it.\n\n")
+                    if claims:
+                        claims.release(session, True)
+                    current = None
+                    continue
+                postprocess_only = has_up_to_date_scores(path_IA, session.name, manifest, multilabel_scores_name)
+                if postprocess_only:
+                    print(f"\t-- Scores of session {session.name} are up to date, only post-process it.\n\n")
+                elif opt.checkpoint_every > 0:
+                    checkpoint = SessionCheckpoint(path_IA, session.name, manifest)
+            scores_complete = postprocess_only or (checkpoint is not None and checkpoint.complete)
+
+            # Scores of the same orthophoto, tiling and model are in the cache, the checkpoint is useless.
+            cached_scores = None
+            cache_key = score_cache_key(get_orthophoto_path(session), opt, revision) if score_cache and manifest is not None else None
+            if cache_key is not None and not scores_complete:
+                cached_scores = score_cache.get(cache_key, multilabel_model.classes_name)
+                if cached_scores is not None:
+                    print("\t-- Scores found in cache, skip capture and classification.\n\n")
+                    if checkpoint:
+                        checkpoint.discard()
+
+            # Stored features are mapped on the tile grid, they are valid for the same orthophoto and tiling.
+            tiling = None
+            if fingerprint and get_orthophoto_path(session).is_file():
+                tiling = session_manifest(get_orthophoto_path(session), opt, None, TILING_ARGS)
+
+            # Features of the same backbone and tiling are stored, the checkpoint is useless.
+            stored_embeddings = None
+            if opt.rescore_embeddings and multilabel_model and cached_scores is None and not scores_complete:
+                store = EmbeddingStore.for_session(path_IA, session.name)
+                if tiling is not None and store.matches(fingerprint, tiling):
+                    print("\t-- Rescore stored backbone features with the classifier head.\n\n")
+                    stored_embeddings = store.read()
+                    if checkpoint:
+                        checkpoint.discard()
+                else:
+                    print(f"[WARNING] No backbone features of this model and tiling for session {session.name}, run full inference.")
+
+            # Setup pipeline for current session
+            capture_images.setup(session, checkpoint.last_tile if checkpoint else None)
+            if multilabel_savers and not scores_complete:
+                multilabel_savers.setup(multilabel_scores_name, checkpoint) 
+
+            # Record timings of each task, and profile the session if asked.
+            Pipeline.metrics = SessionMetrics(session.name)
+            Pipeline.metrics.startup = startup
+            profiler = SessionProfiler(opt.profile, Path(path_IA, f"{session.name}_profile"))
+            profiler.start()
+
+            # Each prefetch stage runs the tasks before it in a new thread.
+            prefetch = lambda: PrefetchStage(opt.prefetch_depth) if opt.prefetch_depth > 0 else None
+            pipeline = None
+            if cached_scores is not None:
+                pipeline = CachedScores(*cached_scores, capture_images.tile_grid, session.name, batch_size) | multilabel_savers
+            elif not scores_complete:
+                whole_session = stored_embeddings is not None or capture_images.start_index == 0
+                if cache_key is not None:
+                    score_cache_writer.setup(cache_key, whole_session)
+
+                if stored_embeddings is not None:
+                    source = StoredEmbeddings(*stored_embeddings, capture_images.tile_grid, session.name, opt.rescore_batch_size) | multilabel_model
+                else:
+                    if embedding_writer:
+                        if not whole_session:
+                            print("[WARNING] Session is resumed, backbone features are not saved.")
+                        embedding_writer.setup(EmbeddingStore.for_session(path_IA, session.name), whole_session, tiling)
+                    if deduplicator:
+                        if coarse_scores:
+                            print("\t-- Coarse pass \n\n")
+                            coarse_pass(capture_images, multilabel_model, coarse_scores)
+                        deduplicator.setup(coarse_scores)
+                    source = (
+                        capture_images |
+                        deduplicator |
+                        prefetch() |
+                        multilabel_model | 
+                        expander |
+                        prefetch() |
+                        embedding_writer
+                    )
+
+                pipeline = (
+                    source |
+                    (score_cache_writer if cache_key is not None else None) |
+                    multilabel_savers
+                )
+
+            # Iterate through pipeline, scores of an already complete session only need post-processing.
+            start_t = datetime.now()
+            if not scores_complete:
+                print("\t-- Start prediction session \n\n")
+                progress = tqdm(disable=opt.no_progress, initial=checkpoint.batches if checkpoint else 0)
             
-            print(f"\nSession {session.name} end succesfully ! ", end="\n\n\n")
+                try:
+                    for _ in pipeline:
+                        progress.update(1)
+
+                        # Cold start of the process, from its launch to the first batch out of the pipeline.
+                        if startup and "first_batch_s" not in startup:
+                            startup["first_batch_s"] = round(time.perf_counter() - START_T, 4)
+                            print(f"\n\t-- Cold start to first batch: {startup['first_batch_s']}s (imports {startup['imports_s']}s, model {startup.get('model_load_s', 0)}s)\n")
+                except StopIteration:
+                    return
+                except KeyboardInterrupt:
+                    return
+                finally:
+                    progress.close()
+                    if embedding_writer:
+                        embedding_writer.cleanup()
+
+                # Pipeline cleanup.
+                if multilabel_savers:
+                    multilabel_savers.cleanup()
 
-        except Exception:
-            print(traceback.format_exc(), end="\n\n")
+            print(f"\n -- Elapsed time: {datetime.now() - start_t} seconds\n\n")
 
-            sessions_fail.append(session.name)
+            # Post-process the session, in background if workers are set. Metrics of the run that inferred the scores are kept.
+            metrics_path = Path(path_IA, f"{session.name}_pipeline_metrics.json")
+            if not scores_complete or not metrics_path.exists():
+                Pipeline.metrics.save(metrics_path)
+            scheduler.submit(
+                session, postprocess_session,
+                session.name, multilabel_scores_name, multilabel_model.classes_name if multilabel_model else [], path_IA, opt.raster_mode, opt.raster_workers,
+                capture_images.tile_grid, f"EPSG:{opt.matching_crs}", metrics_path, opt.no_prediction_raster or multilabel_savers is None, manifest, opt.memory_budget_mb,
+                multilabel_savers is not None and not opt.no_session_index, postprocess_only and opt.export_csv
+            )
+            current = None
+
+            profiler.stop()
+            Pipeline.metrics = None
+            startup = None
+    finally:
+        if claims and current is not None:
+            claims.abandon(current)
+        if embedding_writer:
+            embedding_writer.cleanup()
+
+        # Sessions submitted to post-processing are released by the scheduler.
+        sessions_fail = scheduler.drain()
     
     # Stat
     print("\nEnd of process. On {} sessions, {} fails. ".format(len(sessions), len(sessions_fail)))
     if (len(sessions_fail)):
         [print("\t* " + session_name) for session_name in sessions_fail]
+
+    # Merged summary of all workers sharing the claim directory, since this worker started.
+    if claims:
+        sessions_done, sessions_failed = claims.summary()
+        print("\nAll workers. {} sessions done, {} fails. ".format(len(sessions_done), len(sessions_failed)))
+        [print("\t* " + session_name) for session_name in sessions_failed]
     
 if __name__ == "__main__":
     args = parse_args()
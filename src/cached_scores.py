@@ -0,0 +1,73 @@
+import numpy as np
+
+from .pipeline import Pipeline
+from .libs.tile_grid import TileGrid
+from .libs.score_cache import ScoreCache
+
+
+class CachedScores(Pipeline):
+    """Pipeline task to replay scores found in the score cache, in place of the capture and the classifier"""
+
+    # Key of the replayed values in the pipeline data.
+    values_key = "multilabel_scores"
+
+    def __init__(self, values: np.ndarray, grid_index: np.ndarray, tile_grid: TileGrid, session_name: str, batch_size: int):
+        super(CachedScores, self).__init__()
+
+        self.values = values
+        self.grid_index = grid_index
+        self.tile_grid = tile_grid
+        self.session_name = session_name
+        self.batch_size = batch_size
+
+    def generator(self):
+        n_cols = self.tile_grid.shape[1]
+        for start in range(0, len(self.values), self.batch_size):
+            grid_index = np.asarray(self.grid_index[start:start + self.batch_size], dtype=np.int64)
+            tiles_index = grid_index[:, 0] * n_cols + grid_index[:, 1]
+
+            data = {
+                "frame_paths": [self.tile_grid.filename(self.session_name, index) for index in tiles_index],
+                "frames_position": self.tile_grid.lonlat[tiles_index],
+                "frames_grid_index": grid_index,
+                self.values_key: np.asarray(self.values[start:start + self.batch_size])
+            }
+            if self.filter(data):
+                yield self.map(data)
+
+
+class ScoreCacheWriter(Pipeline):
+    """Pipeline task to store the scores of a whole session in the score cache"""
+
+    def __init__(self, cache: ScoreCache, classes: list[str]):
+        super(ScoreCacheWriter, self).__init__()
+
+        self.cache = cache
+        self.classes = classes
+
+    def setup(self, key: str, whole_session: bool) -> None:
+        """ Scores are stored only if all tiles of the session go through the task. """
+        self.key, self.whole_session = key, whole_session
+        self.scores, self.grid_index = [], []
+
+    def generator(self):
+        data = None
+        stop = False
+        while self.has_next() and not stop:
+            try:
+                data = next(self.source)
+            except StopIteration:
+                stop = True
+
+            if not stop and data:
+                if self.whole_session and "multilabel_scores" in data:
+                    self.scores.append(data["multilabel_scores"])
+                    self.grid_index.append(np.asarray(data["frames_grid_index"]))
+
+                yield data
+
+        if self.whole_session:
+            scores = np.concatenate(self.scores) if self.scores else np.empty((0, len(self.classes)), dtype=np.float32)
+            grid_index = np.concatenate(self.grid_index) if self.grid_index else np.empty((0, 2), dtype=np.int32)
+            self.cache.put(self.key, self.classes, scores, grid_index)
+            self.scores, self.grid_index = [], []
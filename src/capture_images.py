@@ -3,30 +3,35 @@ import numpy as np
 from pathlib import Path
 from argparse import Namespace
 from pyproj import Transformer
-from shapely.geometry import box
 
 import rasterio
-from rasterio.windows import Window
 
 from .pipeline import Pipeline
+from .libs.tile_grid import TileGrid
+from .libs.parse_opt import get_orthophoto_path
+from .libs.tile_filters import OverviewPrefilter
+from .libs.orthophoto_reader import READERS
+from .libs.parallel_capture import ParallelTileExtractor
+from .libs.memory_budget import MemoryBudget
 
 class CaptureImages(Pipeline):
     """Pipeline task to extract image from source"""
 
-    def __init__(self, args: Namespace):
+    def __init__(self, args: Namespace, batch_size: int | None = None):
         super(CaptureImages).__init__()
 
         self.args = args
-        self.batch_size = int(self.args.batch_size) if self.args.batch_size.isnumeric() else 1
+        self.batch_size = batch_size if batch_size is not None else int(self.args.batch_size) if self.args.batch_size.isnumeric() else 1
+        self.memory_budget = MemoryBudget(self.args.memory_budget_mb) if self.args.memory_budget_mb else None
 
     # All path variable not defined in constructor are defined in setup and nowhere else.
-    def setup(self, session: Path) -> None:
-        """ Reset image loaded """
+    def setup(self, session: Path, resume_tile: tuple[int, int] | None = None) -> None:
+        """ Reset image loaded, start after the tile at grid position resume_tile if set """
         # Session path
         self.session = session
 
         # Orthophoto path.
-        self.orthophoto_filepath = Path(self.session, "PROCESSED_DATA", "PHOTOGRAMMETRY", "odm_orthophoto", "odm_orthophoto.tif")
+        self.orthophoto_filepath = get_orthophoto_path(self.session)
         if not self.orthophoto_filepath.exists() or not self.orthophoto_filepath.is_file():
             raise NameError(f"Orthophoto not found at path: {self.orthophoto_filepath}")
         
@@ -43,84 +48,108 @@ class CaptureImages(Pipeline):
             except:
                 raise NameError("Cannot get GSD value")
         
-        # Check if orthophoto is in the correct crs.
-        with rasterio.open(self.orthophoto_filepath) as ortho:
-            if ortho.crs != rasterio.crs.CRS.from_epsg(self.args.matching_crs):
-                raise NameError(f"Orthophoto crs doesn't match with desired args {self.args.matching_crs}")
-
         self.transformer = Transformer.from_crs(self.args.matching_crs, "EPSG:4326", always_xy=True)
 
-    def generator(self):
-
         self.tile_size = int(self.args.tiles_size_meters // (self.GSD_mean / 100))
         self.size_inline_tile = self.tile_size**2
         self.x_overlap = int(self.tile_size * (1 - self.args.h_shift))
         self.y_overlap = int(self.tile_size * (1 - self.args.v_shift))
-        
-        counter, tiles, tiles_name, tiles_position = 0, [], [], []
+
+        # Check if orthophoto is in the correct crs and precompute the tile grid.
+        with rasterio.open(self.orthophoto_filepath) as ortho:
+            if ortho.crs != rasterio.crs.CRS.from_epsg(self.args.matching_crs):
+                raise NameError(f"Orthophoto crs doesn't match with desired args {self.args.matching_crs}")
+
+            self.tile_grid = TileGrid(ortho.transform, ortho.width, ortho.height, self.tile_size, self.x_overlap, self.y_overlap, self.transformer)
+
+            # Flag empty tiles from the overview to skip their decoding, unless black tiles are kept.
+            use_prefilter = self.args.overview_prefilter
+            if use_prefilter and self.args.black_pixels_threshold_percentage >= 100:
+                print("[WARNING] Black tiles are kept with a black pixels threshold of 100%, prefilter disabled.")
+                use_prefilter = False
+            self.prefilter = OverviewPrefilter.from_dataset(ortho, self.tile_grid) if use_prefilter else None
+            if use_prefilter and self.prefilter is None:
+                print("[WARNING] Orthophoto has no overview, prefilter disabled.")
+
+        # Bound the batches held by the prefetch queues and the tasks.
+        self.session_batch_size = self.batch_size
+        if self.memory_budget is not None:
+            batches_in_flight = 2 * self.args.prefetch_depth + 3
+            self.session_batch_size = self.memory_budget.batch_size(self.batch_size, self.tile_size**2 * 3, batches_in_flight)
+            if self.session_batch_size < self.batch_size:
+                print(f"[WARNING] Batch size reduced to {self.session_batch_size} to fit in the memory budget.")
+
+        # Index of the first tile to read and tiles to read, all tiles if not set.
+        self.start_index, self.tile_mask = 0, None
+        if resume_tile is not None:
+            self.start_index = resume_tile[0] * self.tile_grid.shape[1] + resume_tile[1] + 1
+            print(f"\t-- Resume capture after tile {tuple(resume_tile)}, {self.start_index} of {len(self.tile_grid)} tiles done\n")
+
+    def iter_kept_tiles(self):
+        """ Yield (index, tile, (black, white)) of tiles passing the black and white filters, tile of shape (n, n, 3) and percentages of black and white pixels. """
+        thresholds = (self.args.black_pixels_threshold_percentage, self.args.white_pixels_threshold_percentage)
+        row_start = self.start_index // self.tile_grid.shape[1]
+
+        if self.args.capture_workers > 0:
+            max_band_bytes = self.memory_budget.band_bytes(self.args.capture_workers * 2) if self.memory_budget else None
+            extractor = ParallelTileExtractor(self.orthophoto_filepath, self.tile_grid, self.prefilter, self.args.capture_reader, *thresholds, self.args.capture_workers, max_band_bytes, self.tile_mask)
+            for index, tile, filter_stats in extractor.iter_tiles(row_start):
+                if index >= self.start_index:
+                    yield index, tile, filter_stats
+            print(f"\n\t-- Orthophoto read: {extractor.stats.summary()}\n")
+            return
+
         with rasterio.open(self.orthophoto_filepath) as src:
-            for i in range(0, src.height - self.tile_size + 1, self.y_overlap):
-                for j in range(0, src.width - self.tile_size + 1, self.x_overlap):
-                    window = Window(j, i, self.tile_size, self.tile_size)
-                    transform_window = src.window_transform(window)
-
-                    tile = src.read(window=window, indexes=[1, 2, 3])
-
-                    # Apply threshold to avoid keep useless image.                    
-                    greyscale_tile = np.sum(tile, axis=0) / 3
-                    
-                    # Black threshold.
-                    percentage_black_pixel = np.sum(greyscale_tile == 0) * 100 / self.size_inline_tile
-                    if percentage_black_pixel > self.args.black_pixels_threshold_percentage:
-                        continue
-
-                    # White threshold.
-                    percentage_white_pixel = np.sum(greyscale_tile == 255) * 100 / self.size_inline_tile
-                    if percentage_white_pixel > self.args.white_pixels_threshold_percentage:
-                        continue
-                    
-                    # Get bounds.
-                    tile_box = None
-                    with rasterio.open(
-                        f"/tmp/tmp_tile_uav_{self.session.name}.tif", "w",
-                        driver="GTiff",
-                        height=tile.shape[1],
-                        width=tile.shape[2],
-                        count=3,
-                        dtype=tile.dtype,
-                        crs=src.crs,
-                        transform=transform_window
-                    ) as dst:
-                        tile_box = box(*dst.bounds)
-
-                    # Transpose tile from (3, n, n) to (n, n, 3) and save new path
-                    tile = np.transpose(tile, (1, 2, 0))
-                    tile_filename = f"{self.session.name}_{int(tile_box.centroid.x)}_{int(tile_box.centroid.y)}.png"
-                    lon, lat = self.transformer.transform(tile_box.centroid.x,tile_box.centroid.y)
-                    
-                    tiles.append(tile)
-                    tiles_name.append(tile_filename)
-                    tiles_position.append((lon, lat))
-                    counter += 1
-
-                    # If enough images, yield 
-                    if counter % self.batch_size != 0: continue
-                    try:
-                        data = {
-                            "frames": tiles,
-                            "frame_paths": tiles_name,
-                            "frames_position": tiles_position
-                        }
-
-                        if self.filter(data):
-                            counter, tiles, tiles_name, tiles_position = 0, [], [], []
-
-                            yield self.map(data)
-
-                    except StopIteration:
-                        return
-        yield None
-        
+            reader = READERS[self.args.capture_reader](src, self.tile_grid, self.prefilter, tile_mask=self.tile_mask)
+            for index, tile, filter_stats in reader.iter_kept_tiles(thresholds, row_start):
+                if index < self.start_index:
+                    continue
+                # Transpose tile from (3, n, n) to (n, n, 3).
+                yield index, np.transpose(tile, (1, 2, 0)), filter_stats
+            print(f"\n\t-- Orthophoto read: {reader.stats.summary()}\n")
+
+    def generator(self):
+
+        counter, tiles, tiles_index, tiles_stats = 0, None, [], []
+        for index, tile, filter_stats in self.iter_kept_tiles():
+
+            # Pack tiles in one contiguous (B, n, n, 3) array, a new one by batch as downstream tasks can keep it.
+            if tiles is None:
+                tiles = np.empty((self.session_batch_size, *tile.shape), dtype=tile.dtype)
+
+            # Tile can be a view on shared memory released after it, copy it before reading the next one.
+            tiles[counter] = tile
+            tiles_index.append(index)
+            tiles_stats.append(filter_stats)
+            counter += 1
+
+            # If enough images, yield 
+            if counter < self.session_batch_size: continue
+            try:
+                data = self.build_batch(tiles, tiles_index, tiles_stats)
+                counter, tiles, tiles_index, tiles_stats = 0, None, [], []
+
+                if self.filter(data):
+                    yield self.map(data)
+
+            except StopIteration:
+                return
+
+        # Flush the last partial batch.
+        if counter > 0:
+            data = self.build_batch(tiles[:counter], tiles_index, tiles_stats)
+            if self.filter(data):
+                yield self.map(data)
+
+    def build_batch(self, tiles: np.ndarray, tiles_index: list[int], tiles_stats: list[tuple[float, float]]) -> dict:
+        """ Get name and position of each tile from the grid, with its percentages of black and white pixels. """
+        return {
+            "frames": tiles,
+            "frame_paths": [self.tile_grid.filename(self.session.name, index) for index in tiles_index],
+            "frames_position": self.tile_grid.lonlat[tiles_index],
+            "frames_grid_index": self.tile_grid.grid_index(tiles_index),
+            "frames_filter_stats": np.array(tiles_stats, dtype=np.float32).reshape(-1, 2)
+        }
     
     def cleanup(self):
         """ nothing to release """
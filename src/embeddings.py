@@ -0,0 +1,50 @@
+from .pipeline import Pipeline
+from .cached_scores import CachedScores
+from .libs.embedding_store import EmbeddingStore
+
+
+class StoredEmbeddings(CachedScores):
+    """Pipeline task to replay stored backbone features, only the classifier head runs on them"""
+
+    values_key = "features"
+
+
+class EmbeddingWriter(Pipeline):
+    """Pipeline task to store backbone features of a whole session, features are removed from the data"""
+
+    def __init__(self, fingerprint: str):
+        super(EmbeddingWriter, self).__init__()
+
+        self.fingerprint = fingerprint
+        self.store = None
+
+    def setup(self, store: EmbeddingStore, whole_session: bool, tiling: dict) -> None:
+        """ Features are stored only if all tiles of the session go through the task, with the tiling manifest of the session. """
+        self.store = store if whole_session else None
+        if self.store is not None:
+            self.store.open_writer(self.fingerprint, tiling)
+
+    def generator(self):
+        data = None
+        stop = False
+        while self.has_next() and not stop:
+            try:
+                data = next(self.source)
+            except StopIteration:
+                stop = True
+
+            if not stop and data:
+                features = data.pop("features", None)
+                if self.store is not None and features is not None:
+                    self.store.append(features, data["frames_grid_index"])
+
+                yield data
+
+        if self.store is not None:
+            self.store.close_writer()
+
+    def cleanup(self):
+        """ Abort the store if the session stopped before the end of the pipeline. """
+        if self.store is not None:
+            self.store.abort_writer()
+            self.store = None
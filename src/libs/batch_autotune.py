@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import torch
+import socket
+import resource
+import numpy as np
+from pathlib import Path
+
+from .inference_backends import EXPORT_DIRECTORY
+
+
+# Batch sizes probed in increasing order.
+AUTOTUNE_BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+# Stop probing when throughput falls below this ratio of the best one.
+AUTOTUNE_MIN_GAIN = 0.95
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """ Out of memory error of cuda or of the cpu allocator. """
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    return isinstance(error, RuntimeError) and any(m in str(error) for m in ["out of memory", "can't allocate memory"])
+
+
+def default_memory_limit_MB(device: torch.device) -> float:
+    """ 90% of the gpu memory, or half of the total ram on cpu, stable between runs to reuse the cached batch size. """
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory * 0.9 / 1e6
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.5 / 1e6
+
+
+class BatchSizeTuner:
+    """ Probe batch sizes on random frames and keep the fastest under a memory limit, cached by host and setup in the model directory. """
+
+    def __init__(self, repo_path: Path, device: torch.device, setup: str, memory_limit_MB: float | None = None) -> None:
+        self.device = device
+        self.memory_limit = memory_limit_MB or default_memory_limit_MB(device)
+        self.cache_path = Path(repo_path, EXPORT_DIRECTORY, "batch_size.json")
+
+        device_name = torch.cuda.get_device_name(device) if device.type == "cuda" else f"cpu-{os.cpu_count()}"
+        self.key = f"{socket.gethostname()}|{device_name}|{setup}|{round(self.memory_limit)}MB"
+
+    def read_cache(self) -> dict:
+        if not self.cache_path.exists():
+            return {}
+        with open(self.cache_path, "r") as f:
+            return json.load(f)
+
+    def cached(self) -> int | None:
+        entry = self.read_cache().get(self.key)
+        return entry["batch_size"] if entry else None
+
+    def peak_memory_MB(self) -> float:
+        """ Peak allocated memory on gpu, peak resident size of the process on cpu. """
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device) / 1e6
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def probe(self, forward, frames: np.ndarray) -> tuple[float, float]:
+        """ Return tiles/s and peak memory of forward on frames, after a warm up run. """
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        forward(frames)
+        start_t = time.perf_counter()
+        forward(frames)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - start_t
+
+        return len(frames) / elapsed, self.peak_memory_MB()
+
+    def tune(self, forward, make_frames) -> int:
+        """ Probe forward on make_frames(batch_size) for increasing batch sizes, save and return the best one. """
+        probes, best = [], None
+        for batch_size in AUTOTUNE_BATCH_SIZES:
+            try:
+                tiles_per_s, peak_MB = self.probe(forward, make_frames(batch_size))
+            except Exception as e:
+                if not is_out_of_memory(e):
+                    raise
+                probes.append({"batch_size": batch_size, "out_of_memory": True})
+                break
+            finally:
+                if self.device.type == "cuda":
+                    torch.cuda.empty_cache()
+
+            probes.append({"batch_size": batch_size, "tiles_per_s": round(tiles_per_s, 2), "peak_MB": round(peak_MB, 1)})
+            print(f"\t-- Batch size {batch_size}: {tiles_per_s:.1f} tiles/s, peak memory {peak_MB:.0f} MB\n")
+            if peak_MB > self.memory_limit:
+                break
+            if best is not None and tiles_per_s < best["tiles_per_s"] * AUTOTUNE_MIN_GAIN:
+                break
+            if best is None or tiles_per_s > best["tiles_per_s"]:
+                best = probes[-1]
+
+        batch_size = best["batch_size"] if best else 1
+        cache = self.read_cache()
+        cache[self.key] = {"batch_size": batch_size, "probes": probes}
+        self.cache_path.parent.mkdir(exist_ok=True, parents=True)
+        with open(self.cache_path, "w") as f:
+            json.dump(cache, f, indent=4)
+
+        return batch_size
@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from argparse import Namespace
+
+
+# Arguments changing the tiles of a session.
+TILING_ARGS = [
+    "matching_crs", "tiles_size_meters", "h_shift", "v_shift",
+    "black_pixels_threshold_percentage", "white_pixels_threshold_percentage"
+]
+
+# Arguments changing the tiles or the scores of a session.
+SCORES_ARGS = ["multilabel_url", "backend", "quantize", "preprocessing"] + TILING_ARGS + ["dedup_threshold", "dedup_window", "coarse_step", "coarse_threshold"]
+
+# Arguments changing only the outputs post-processed from the scores file, the memory budget writes rasters in tiled GeoTIFF.
+POSTPROCESS_ARGS = ["export_csv", "no_prediction_raster", "raster_mode", "no_session_index", "memory_budget_mb"]
+
+# Arguments changing any output of a session.
+MANIFEST_ARGS = SCORES_ARGS + POSTPROCESS_ARGS
+
+
+def model_revision(repo_path: Path) -> str:
+    """ Hash of the model config and of the weights files size and modification time. """
+    digest = hashlib.sha1()
+    for path in sorted(Path(repo_path).iterdir()):
+        if path.name == "config.json":
+            digest.update(path.read_bytes())
+        elif path.suffix in [".safetensors", ".bin"]:
+            stat = path.stat()
+            digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def session_manifest(orthophoto_filepath: Path, opt: Namespace, revision: str, args: list[str] = MANIFEST_ARGS) -> dict:
+    """ Everything the outputs of a session depend on. """
+    stat = Path(orthophoto_filepath).stat()
+    return {
+        "orthophoto_size": stat.st_size,
+        "orthophoto_mtime_ns": stat.st_mtime_ns,
+        "model_revision": revision,
+        **{arg: getattr(opt, arg) for arg in args}
+    }
+
+
+def write_json(path: Path, content: dict) -> None:
+    """ Write in a temporary file then rename it, a crash never leaves a truncated file. """
+    tmp_path = Path(path.parent, f"{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def manifest_path(path_IA: Path, session_name: str) -> Path:
+    return Path(path_IA, f"{session_name}_manifest.json")
+
+
+def is_up_to_date(path_IA: Path, session_name: str, manifest: dict, scores_path: Path) -> bool:
+    """ Session was completed with the same orthophoto, model and parameters. """
+    path = manifest_path(path_IA, session_name)
+    if not path.exists() or not Path(scores_path).exists():
+        return False
+    with open(path, "r") as f:
+        return json.load(f) == manifest
+
+
+def has_up_to_date_scores(path_IA: Path, session_name: str, manifest: dict, scores_path: Path) -> bool:
+    """ Session was completed with the same orthophoto, model and scores parameters, only post-processed outputs may differ. """
+    path = manifest_path(path_IA, session_name)
+    if not path.exists() or not Path(scores_path).exists():
+        return False
+    with open(path, "r") as f:
+        saved = json.load(f)
+    scores_manifest = lambda m: {key: value for key, value in m.items() if key not in POSTPROCESS_ARGS}
+    return scores_manifest(saved) == scores_manifest(manifest)
+
+
+def complete_session(path_IA: Path, session_name: str, manifest: dict) -> None:
+    """ Mark the session as completed once its last output is written. """
+    write_json(manifest_path(path_IA, session_name), manifest)
+    Path(path_IA, f"{session_name}_checkpoint.json").unlink(missing_ok=True)
+
+
+class SessionCheckpoint:
+    """ Progress of a session inference saved in PROCESSED_DATA/IA, to resume after a crash. """
+
+    def __init__(self, path_IA: Path, session_name: str, manifest: dict) -> None:
+        self.path = Path(path_IA, f"{session_name}_checkpoint.json")
+        self.manifest = manifest
+
+        # Committed parquet part files, grid position (row, col) of the last saved tile, batches saved and csv size.
+        self.parts, self.last_tile, self.batches, self.csv_offset = [], None, 0, 0
+
+        # Scores file is complete, only post-processing is left.
+        self.complete = False
+
+        # A checkpoint of other parameters or of another orthophoto is not resumed.
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                state = json.load(f)
+            if state["manifest"] == self.manifest:
+                self.parts, self.last_tile = state["parts"], state["last_tile"]
+                self.batches, self.csv_offset = state["batches"], state["csv_offset"]
+                self.complete = state["complete"]
+
+    @property
+    def resumed(self) -> bool:
+        return self.last_tile is not None
+
+    def commit(self, part: str, last_tile: tuple[int, int], batches: int, csv_offset: int) -> None:
+        """ Record a part file closed by the saver. """
+        self.parts.append(part)
+        self.last_tile, self.batches, self.csv_offset = [int(last_tile[0]), int(last_tile[1])], batches, csv_offset
+        self.save()
+
+    def finish(self) -> None:
+        """ Record that parts are merged in the scores file. """
+        self.parts, self.complete = [], True
+        self.save()
+
+    def discard(self) -> None:
+        """ Remove the checkpoint and its committed part files. """
+        for part in self.parts:
+            Path(self.path.parent, part).unlink(missing_ok=True)
+        self.path.unlink(missing_ok=True)
+        self.parts, self.last_tile, self.batches, self.csv_offset, self.complete = [], None, 0, 0, False
+
+    def save(self) -> None:
+        write_json(self.path, {
+            "manifest": self.manifest,
+            "parts": self.parts,
+            "last_tile": self.last_tile,
+            "batches": self.batches,
+            "csv_offset": self.csv_offset,
+            "complete": self.complete
+        })
@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from pathlib import Path
+
+
+def backbone_fingerprint(model, repo_path: Path) -> str:
+    """ Hash of the backbone weights and of the preprocessing, heads sharing them can rescore the same embeddings. """
+    digest = hashlib.sha1()
+    preprocessor_config = Path(repo_path, "preprocessor_config.json")
+    if preprocessor_config.exists():
+        digest.update(preprocessor_config.read_bytes())
+    for name, tensor in model.dinov2.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """ Pooled backbone features of the kept tiles of a session, appended to a raw float32 file and read memory-mapped. """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.features_file, self.grid_index, self.count = None, [], 0
+
+    @classmethod
+    def for_session(cls, path_IA: Path, session_name: str) -> "EmbeddingStore":
+        return cls(Path(path_IA, f"{session_name}_embeddings"))
+
+    def meta(self) -> dict | None:
+        meta_path = Path(self.path, "meta.json")
+        if not meta_path.exists():
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def open_writer(self, fingerprint: str, tiling: dict) -> None:
+        """ Start a new store, the previous one is kept until close_writer. Features are valid for the backbone fingerprint and the tiling manifest. """
+        self.tmp_path = Path(self.path.parent, f"{self.path.name}.tmp")
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path.mkdir(parents=True)
+
+        self.fingerprint, self.tiling = fingerprint, tiling
+        self.features_file = open(Path(self.tmp_path, "features.f32"), "wb")
+        self.grid_index, self.count, self.dim = [], 0, None
+
+    def append(self, features: np.ndarray, grid_index: np.ndarray) -> None:
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        self.dim = features.shape[1]
+        self.features_file.write(features.tobytes())
+        self.grid_index.append(np.asarray(grid_index, dtype=np.int32))
+        self.count += len(features)
+
+    def close_writer(self) -> None:
+        """ Write tile positions and metadata then replace the previous store. """
+        self.features_file.close()
+        self.features_file = None
+
+        grid_index = np.concatenate(self.grid_index) if self.grid_index else np.empty((0, 2), dtype=np.int32)
+        np.save(Path(self.tmp_path, "grid_index.npy"), grid_index)
+        with open(Path(self.tmp_path, "meta.json"), "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "tiling": self.tiling, "count": self.count, "dim": self.dim, "dtype": "float32"}, f)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+        self.grid_index = []
+
+    def abort_writer(self) -> None:
+        """ Drop a store left open by an interrupted session, the previous one is kept. """
+        if self.features_file is None:
+            return
+        self.features_file.close()
+        self.features_file, self.grid_index = None, []
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def matches(self, fingerprint: str, tiling: dict) -> bool:
+        """ Store holds features of the same backbone on the same tile grid. """
+        meta = self.meta()
+        return meta is not None and meta["fingerprint"] == fingerprint and meta.get("tiling") == tiling
+
+    def read(self) -> tuple[np.ndarray, np.ndarray]:
+        """ Return features (N, dim) memory-mapped and grid positions (N, 2). """
+        meta = self.meta()
+        grid_index = np.load(Path(self.path, "grid_index.npy"))
+        if meta["count"] == 0:
+            return np.empty((0, meta["dim"] or 0), dtype=np.float32), grid_index
+
+        features = np.memmap(Path(self.path, "features.f32"), dtype=np.float32, mode="r", shape=(meta["count"], meta["dim"]))
+        return features, grid_index
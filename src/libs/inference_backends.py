@@ -0,0 +1,169 @@
+import os
+import copy
+import torch
+import hashlib
+import numpy as np
+import torch.nn as nn
+from pathlib import Path
+
+from .checkpoint import model_revision
+
+
+EXPORT_DIRECTORY = "exported"
+
+# Maximum difference of sigmoid scores allowed between a backend and the eager model.
+SCORES_TOLERANCE = {None: 1e-3, "int8": 5e-2}
+
+
+class LogitsModule(nn.Module):
+    """ Wrap the hugging face model to take and return plain tensors. """
+
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values).logits
+
+
+class TorchBackend:
+    """ Eager pytorch model, optionally with int8 dynamic quantization of linear layers on cpu. """
+
+    name, extension, opset = "torch", None, None
+
+    def __init__(self, model: nn.Module, repo_path: Path, device: torch.device, quantize: str | None, example: torch.Tensor) -> None:
+        self.repo_path = repo_path
+        self.quantize = quantize
+        self.device = device
+
+        if self.quantize is not None and self.device.type != "cpu":
+            print(f"[WARNING] {self.quantize} quantization is only available on cpu, a copy of the model is moved to cpu.")
+            self.device = torch.device("cpu")
+            # The model is shared with the classifier and the fallback backend, keep it on its device.
+            model = copy.deepcopy(model).cpu()
+
+        self.eager_model = LogitsModule(model.to(self.device)).eval()
+        self.load(example.to(self.device))
+
+    @property
+    def artifact_prefix(self) -> str:
+        suffix = f"_{self.quantize}" if self.quantize else ""
+        return f"{self.name}{suffix}"
+
+    @property
+    def artifact_path(self) -> Path:
+        """ Exported model named by the model revision, the export settings and the torch version. """
+        key = f"{model_revision(self.repo_path)}|{self.name}|{self.quantize}|{self.opset}|{torch.__version__}"
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        return Path(self.repo_path, EXPORT_DIRECTORY, f"{self.artifact_prefix}_{digest}.{self.extension}")
+
+    @property
+    def tmp_artifact_path(self) -> Path:
+        """ Export written by this process, moved to the artifact path once complete. """
+        return Path(self.artifact_path.parent, f"{self.artifact_path.stem}.tmp-{os.getpid()}.{self.extension}")
+
+    def artifact_is_valid(self) -> bool:
+        return self.artifact_path.exists()
+
+    def remove_stale_artifacts(self) -> None:
+        """ Remove artifacts of the same backend exported from another revision or with other settings. """
+        for path in self.artifact_path.parent.glob(f"{self.artifact_prefix}_*.{self.extension}"):
+            if path != self.artifact_path and path.stem[len(self.artifact_prefix) + 1:].isalnum():
+                path.unlink()
+
+    def quantized_model(self) -> nn.Module:
+        if self.quantize == "int8":
+            return torch.ao.quantization.quantize_dynamic(self.eager_model, {nn.Linear}, dtype=torch.qint8)
+        return self.eager_model
+
+    def load(self, example: torch.Tensor) -> None:
+        self.model = self.quantized_model()
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.model(pixel_values.to(self.device))
+
+    def check_accuracy(self, pixel_values: torch.Tensor) -> float:
+        """ Return max difference of sigmoid scores with the eager fp32 model. """
+        with torch.no_grad():
+            expected = torch.sigmoid(self.eager_model(pixel_values.to(self.device)).float())
+        scores = torch.sigmoid(self(pixel_values).float().to(self.device))
+        max_diff = (scores - expected).abs().max().item()
+
+        print(f"\t-- Backend {self.name} {self.quantize or 'fp32'}: max scores difference with eager model {max_diff:.6f}\n")
+        return max_diff
+
+    def is_accurate(self, pixel_values: torch.Tensor) -> bool:
+        """ Scores difference with the eager fp32 model is within the tolerance of the quantization. """
+        return self.check_accuracy(pixel_values) <= SCORES_TOLERANCE[self.quantize]
+
+
+class TorchScriptBackend(TorchBackend):
+    """ Traced model saved next to the hugging face model. """
+
+    name, extension, opset = "torchscript", "pt", None
+
+    def load(self, example: torch.Tensor) -> None:
+        if not self.artifact_is_valid():
+            print(f"\t-- Export model to {self.artifact_path}\n")
+            self.artifact_path.parent.mkdir(exist_ok=True, parents=True)
+            self.remove_stale_artifacts()
+            try:
+                with torch.no_grad():
+                    traced = torch.jit.trace(self.quantized_model(), example, check_trace=False)
+                torch.jit.save(traced, self.tmp_artifact_path)
+                os.replace(self.tmp_artifact_path, self.artifact_path)
+            finally:
+                self.tmp_artifact_path.unlink(missing_ok=True)
+
+        self.model = torch.jit.load(self.artifact_path, map_location=self.device).eval()
+
+
+class OnnxBackend(TorchBackend):
+    """ ONNX Runtime session on the model exported next to the hugging face model. """
+
+    name, extension, opset = "onnx", "onnx", 17
+
+    def load(self, example: torch.Tensor) -> None:
+        import onnxruntime as ort
+
+        if not self.artifact_is_valid():
+            fp32_path = Path(self.artifact_path.parent, f"{self.name}_fp32_export_{os.getpid()}.{self.extension}")
+            print(f"\t-- Export model to {self.artifact_path}\n")
+            self.artifact_path.parent.mkdir(exist_ok=True, parents=True)
+            self.remove_stale_artifacts()
+            try:
+                torch.onnx.export(
+                    self.eager_model, example, fp32_path,
+                    input_names=["pixel_values"], output_names=["logits"],
+                    dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+                    opset_version=self.opset
+                )
+
+                if self.quantize == "int8":
+                    from onnxruntime.quantization import quantize_dynamic, QuantType
+                    quantize_dynamic(fp32_path, self.tmp_artifact_path, weight_type=QuantType.QInt8)
+                    os.replace(self.tmp_artifact_path, self.artifact_path)
+                else:
+                    os.replace(fp32_path, self.artifact_path)
+            finally:
+                # Partial exports of this process are never left next to the model.
+                fp32_path.unlink(missing_ok=True)
+                self.tmp_artifact_path.unlink(missing_ok=True)
+
+        providers = ["CPUExecutionProvider"]
+        if self.device.type == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(str(self.artifact_path), providers=providers)
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        inputs = np.ascontiguousarray(pixel_values.detach().cpu().numpy(), dtype=np.float32)
+        logits = self.session.run(["logits"], {"pixel_values": inputs})[0]
+        return torch.from_numpy(logits)
+
+
+BACKENDS = {
+    "torch": TorchBackend,
+    "torchscript": TorchScriptBackend,
+    "onnx": OnnxBackend
+}
@@ -0,0 +1,20 @@
+class MemoryBudget:
+    """ Split a memory budget between the tiles read ahead by the capture, the batches in flight and the raster windows. """
+
+    # Shares of the budget, the rest is left to the model, the interpolator and the python runtime.
+    CAPTURE_SHARE, BATCHES_SHARE, RASTER_SHARE = 0.2, 0.2, 0.3
+
+    def __init__(self, budget_MB: float) -> None:
+        self.budget = budget_MB * 1e6
+
+    def band_bytes(self, bands_in_flight: int) -> int:
+        """ Maximum size of a band of tiles extracted by a capture worker. """
+        return int(self.budget * self.CAPTURE_SHARE / max(1, bands_in_flight))
+
+    def batch_size(self, batch_size: int, tile_bytes: int, batches_in_flight: int) -> int:
+        """ Largest batch size up to batch_size with all batches in flight in their share of the budget. """
+        return max(1, min(batch_size, int(self.budget * self.BATCHES_SHARE / (max(1, batches_in_flight) * tile_bytes))))
+
+    def window_bytes(self) -> int:
+        """ Maximum size of the data of a raster window. """
+        return int(self.budget * self.RASTER_SHARE)
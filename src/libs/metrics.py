@@ -0,0 +1,178 @@
+import json
+import time
+import resource
+import cProfile
+from pathlib import Path
+from contextlib import contextmanager
+
+
+def reset_peak_rss() -> bool:
+    """ Reset the peak resident size of the process to its current size, False if not supported (linux only). """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_MB() -> float | None:
+    """ Peak resident size of the process since the last reset_peak_rss, None if not supported. """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+class StageStats:
+    """ Counters of one pipeline task or processing step. """
+
+    def __init__(self, name: str, upstream: "StageStats | None" = None) -> None:
+        self.name = name
+        self.upstream = upstream
+        self.wall_time, self.batches, self.items, self.bytes = 0.0, 0, 0, 0
+
+        # Only for prefetch stages, time the consumer waits on an empty queue and the producer on a full queue.
+        self.is_queue, self.queue_full_time = False, 0.0
+
+    def add(self, data) -> None:
+        """ Count a batch yielded by the task. """
+        self.batches += 1
+        if isinstance(data, dict) and "frame_paths" in data:
+            self.items += len(data["frame_paths"])
+        if isinstance(data, dict) and "frames" in data:
+            self.bytes += getattr(data["frames"], "nbytes", 0)
+
+    def to_dict(self) -> dict:
+        if self.is_queue:
+            return {
+                "queue_empty_wait_s": round(self.wall_time, 4),
+                "queue_full_wait_s": round(self.queue_full_time, 4),
+                "batches": self.batches,
+                "items": self.items
+            }
+
+        # Tasks time includes their upstream tasks, behind a prefetch stage the upstream time is the queue wait.
+        own_time = self.wall_time - self.upstream.wall_time if self.upstream else self.wall_time
+        return {
+            "wall_time_s": round(self.wall_time, 4),
+            "own_time_s": round(own_time, 4),
+            "batches": self.batches,
+            "items": self.items,
+            "bytes": self.bytes,
+            "items_per_s": round(self.items / own_time, 2) if own_time > 0 else None,
+            "MB_per_s": round(self.bytes / 1e6 / own_time, 2) if own_time > 0 else None
+        }
+
+
+class SessionMetrics:
+    """ Collect stage timings of a session and write them as a json report. """
+
+    def __init__(self, session_name: str) -> None:
+        self.session_name = session_name
+        self.stages, self.steps = {}, {}
+        self.start_t = time.perf_counter()
+
+        # Startup timings of the process, only set on its first session.
+        self.startup = None
+
+        # Counters set by the tasks, like tiles skipped by the deduplication.
+        self.counters = {}
+
+        # Peak resident size of this session only, else of the whole process.
+        self.session_peak = reset_peak_rss()
+
+    def stage(self, task) -> StageStats:
+        """ Get the stats of a pipeline task, created on first call. """
+        if id(task) not in self.stages:
+            name = type(task).__name__
+            names = [s.name for s in self.stages.values()]
+            if name in names:
+                name = f"{name}_{names.count(name) + 1}"
+            self.stages[id(task)] = StageStats(name)
+        return self.stages[id(task)]
+
+    @contextmanager
+    def timed(self, name: str, items: int = 0, bytes: int = 0):
+        """ Time a processing step outside of the pipeline. """
+        stats = self.steps.setdefault(name, StageStats(name))
+        start_t = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.wall_time += time.perf_counter() - start_t
+            stats.batches += 1
+            stats.items += items
+            stats.bytes += bytes
+
+    def report(self) -> dict:
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        peak_rss = {"peak_rss_MB": peak_rss_MB()} if self.session_peak else {"process_peak_rss_MB": round(usage_self.ru_maxrss / 1024, 1)}
+        return {
+            "session": self.session_name,
+            "total_time_s": round(time.perf_counter() - self.start_t, 4),
+            **peak_rss,
+            # Children peak can't be reset, it covers all the children processes waited since the start.
+            "process_peak_rss_children_MB": round(usage_children.ru_maxrss / 1024, 1),
+            "stages": {s.name: s.to_dict() for s in self.stages.values()},
+            "steps": {s.name: s.to_dict() for s in self.steps.values()},
+            **({"counters": self.counters} if self.counters else {}),
+            **({"startup": self.startup} if self.startup else {})
+        }
+
+    def save(self, path: Path) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=4)
+
+
+def add_step_to_report(path: Path, name: str, wall_time: float, items: int = 0) -> None:
+    """ Add a step timed in another process to a saved report. """
+    with open(path, "r") as f:
+        report = json.load(f)
+
+    stats = StageStats(name)
+    stats.wall_time, stats.batches, stats.items = wall_time, 1, items
+    report["steps"][name] = stats.to_dict()
+
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+
+
+class SessionProfiler:
+    """ Profile a session with cProfile or pyinstrument, only the calling thread is profiled. """
+
+    def __init__(self, profiler: str | None, output_path: Path) -> None:
+        self.profiler = profiler
+        self.output_path = output_path
+        self.prof = None
+
+    def start(self) -> None:
+        if self.profiler == "cprofile":
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+
+        elif self.profiler == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise NameError("pyinstrument is not installed, use --profile cprofile or pip install pyinstrument")
+            self.prof = Profiler()
+            self.prof.start()
+
+    def stop(self) -> None:
+        if self.prof is None:
+            return
+
+        if self.profiler == "cprofile":
+            self.prof.disable()
+            self.prof.dump_stats(Path(self.output_path.parent, f"{self.output_path.name}.prof"))
+        else:
+            self.prof.stop()
+            with open(Path(self.output_path.parent, f"{self.output_path.name}.html"), "w") as f:
+                f.write(self.prof.output_html())
+        self.prof = None
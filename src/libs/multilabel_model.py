@@ -1,4 +1,5 @@
 import json
+import torch
 import torch.nn as nn
 from pathlib import Path
 from huggingface_hub import snapshot_download
@@ -26,15 +27,37 @@ class NewHeadDinoV2ForImageClassification(Dinov2ForImageClassification):
         layers.append(nn.Linear(features_lst[-1] , number_classes))
         return nn.Sequential(*layers)
 
+    def extract_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """ Pooled backbone features fed to the head, CLS token concatenated with the mean of patch tokens. """
+        sequence_output = self.dinov2(pixel_values)[0]
+        cls_token = sequence_output[:, 0]
+        patch_tokens = sequence_output[:, 1:]
+        return torch.cat([cls_token, patch_tokens.mean(dim=1)], dim=1)
 
-def getDynoConfig(repo_name):
+    def classify_features(self, features: torch.Tensor) -> torch.Tensor:
+        """ Logits of the head only. """
+        return self.classifier(features)
+
+
+def get_repo_path(repo_name):
+    """ Return local path of the hugging face repository, downloaded if needed. """
     repo_path = Path(Path.cwd(), PATH_TO_MULTILABEL_DIRECTORY, repo_name)
     if not Path.exists(repo_path):
-        snapshot_download(repo_id=repo_name, local_dir=Path(Path.cwd(), PATH_TO_MULTILABEL_DIRECTORY, repo_name))
+        snapshot_download(repo_id=repo_name, local_dir=repo_path)
+    
+    return repo_path
 
+
+def getDynoConfig(repo_path):
+    """ Read model config from the local repository. """
     config = None
     with open(Path(repo_path, "config.json")) as f:
         config = json.load(f)
     
     return config
 
+
+def load_model(repo_path: Path) -> NewHeadDinoV2ForImageClassification:
+    """ Load the model from the local repository only, safetensors weights are memory-mapped. """
+    use_safetensors = True if any(Path(repo_path).glob("*.safetensors")) else None
+    return NewHeadDinoV2ForImageClassification.from_pretrained(repo_path, local_files_only=True, use_safetensors=use_safetensors)
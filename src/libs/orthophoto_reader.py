@@ -0,0 +1,136 @@
+import math
+import time
+import numpy as np
+from rasterio.windows import Window
+
+from .tile_grid import TileGrid
+from .tile_filters import filter_tiles, OverviewPrefilter
+
+
+class ReaderStats:
+    """ Throughput counters of an orthophoto reader. """
+
+    def __init__(self) -> None:
+        self.tiles, self.prefiltered, self.masked, self.bytes_read, self.start_t = 0, 0, 0, 0, time.perf_counter()
+
+    def summary(self) -> str:
+        elapsed = max(time.perf_counter() - self.start_t, 1e-9)
+        masked = f", {self.masked} outside the tile mask" if self.masked else ""
+        return f"{self.tiles} tiles ({self.prefiltered} skipped by prefilter{masked}), {self.bytes_read / 1e6:.1f} MB decoded in {elapsed:.2f}s ({self.tiles / elapsed:.1f} tiles/s, {self.bytes_read / 1e6 / elapsed:.1f} MB/s)"
+
+
+class WindowReader:
+    """ Read each tile with its own window. """
+
+    def __init__(self, src, tile_grid: TileGrid, prefilter: OverviewPrefilter | None = None, indexes: list[int] = [1, 2, 3], tile_mask: np.ndarray | None = None) -> None:
+        self.src = src
+        self.tile_grid = tile_grid
+        self.prefilter = prefilter
+        self.indexes = indexes
+        self.stats = ReaderStats()
+
+        # Tiles to read, all tiles if not set, skipped tiles are counted as masked.
+        self.tile_mask = tile_mask
+
+    def iter_kept_tiles(self, thresholds: tuple[float, float], row_start: int = 0, row_end: int | None = None):
+        """ Yield (index, tile, (black, white)) for tiles passing the filters in grid rows [row_start, row_end), tile of shape (bands, tile_size, tile_size) and percentages of black and white pixels. """
+        ts = self.tile_grid.tile_size
+        n_cols = self.tile_grid.shape[1]
+        row_end = self.tile_grid.shape[0] if row_end is None else row_end
+        for index in range(row_start * n_cols, row_end * n_cols):
+            self.stats.tiles += 1
+            if self.tile_mask is not None and not self.tile_mask[index]:
+                self.stats.masked += 1
+                continue
+            if self.prefilter is not None and self.prefilter.empty[index]:
+                self.stats.prefiltered += 1
+                continue
+
+            window = Window(self.tile_grid.cols[index], self.tile_grid.rows[index], ts, ts)
+            tile = self.src.read(window=window, indexes=self.indexes)
+            self.stats.bytes_read += tile.nbytes
+
+            keep, black, white = filter_tiles(tile, np.array([0]), ts, *thresholds)
+            if keep[0]:
+                yield index, tile, (black[0], white[0])
+
+
+class StripReader(WindowReader):
+    """ Read the orthophoto by full-width row strips aligned on the internal blocks and slice tiles as views. """
+
+    def __init__(self, src, tile_grid: TileGrid, prefilter: OverviewPrefilter | None = None, indexes: list[int] = [1, 2, 3], tile_mask: np.ndarray | None = None) -> None:
+        super().__init__(src, tile_grid, prefilter, indexes, tile_mask)
+
+        self.block_height = src.block_shapes[0][0]
+        self.buffer, self.buffer_row = None, 0
+
+    def read_rows(self, row_start: int, row_end: int) -> np.ndarray:
+        """ Read rows [row_start, row_end) over the full width, columns without data are not decoded if a prefilter is set. """
+        if self.prefilter is None:
+            rows = self.src.read(window=Window(0, row_start, self.src.width, row_end - row_start), indexes=self.indexes)
+            self.stats.bytes_read += rows.nbytes
+            return rows
+
+        rows = np.zeros((len(self.indexes), row_end - row_start, self.src.width), dtype=self.src.dtypes[0])
+        span = self.prefilter.column_span(row_start, row_end)
+        if span is not None:
+            col_start, col_end = span
+            decoded = self.src.read(window=Window(col_start, row_start, col_end - col_start, row_end - row_start), indexes=self.indexes)
+            rows[:, :, col_start:col_end] = decoded
+            self.stats.bytes_read += decoded.nbytes
+        return rows
+
+    def strip(self, row_offset: int) -> np.ndarray:
+        """ Return a view of rows [row_offset, row_offset + tile_size) over the full width. Rows are decoded only once. """
+        row_end = row_offset + self.tile_grid.tile_size
+        buffer_end = self.buffer_row + self.buffer.shape[1] if self.buffer is not None else 0
+
+        # Drop the buffer if we don't move forward in the orthophoto.
+        if self.buffer is not None and not (self.buffer_row <= row_offset <= buffer_end):
+            self.buffer, buffer_end = None, 0
+
+        if self.buffer is None or row_end > buffer_end:
+            read_start = max(buffer_end, row_offset) if self.buffer is not None else row_offset
+            read_end = min(self.src.height, math.ceil(row_end / self.block_height) * self.block_height)
+            new_rows = self.read_rows(read_start, read_end)
+
+            # Keep the already decoded rows shared with overlapping tiles.
+            if self.buffer is not None and row_offset < buffer_end:
+                self.buffer = np.concatenate((self.buffer[:, row_offset - self.buffer_row:], new_rows), axis=1)
+                self.buffer_row = row_offset
+            else:
+                self.buffer, self.buffer_row = new_rows, read_start
+
+        return self.buffer[:, row_offset - self.buffer_row:row_end - self.buffer_row]
+
+    def iter_kept_tiles(self, thresholds: tuple[float, float], row_start: int = 0, row_end: int | None = None):
+        ts = self.tile_grid.tile_size
+        n_cols = self.tile_grid.shape[1]
+        cols_offset = self.tile_grid.cols_offset
+        row_end = self.tile_grid.shape[0] if row_end is None else row_end
+        for row_index in range(row_start, row_end):
+            self.stats.tiles += n_cols
+
+            candidates = np.ones(n_cols, dtype=bool)
+            if self.tile_mask is not None:
+                candidates &= self.tile_mask[row_index * n_cols:(row_index + 1) * n_cols]
+                self.stats.masked += n_cols - int(np.count_nonzero(candidates))
+            if self.prefilter is not None:
+                in_mask = int(np.count_nonzero(candidates))
+                candidates &= ~self.prefilter.empty[row_index * n_cols:(row_index + 1) * n_cols]
+                self.stats.prefiltered += in_mask - int(np.count_nonzero(candidates))
+            if not candidates.any():
+                continue
+
+            # Filter all tiles of the strip at once.
+            strip = self.strip(int(self.tile_grid.rows_offset[row_index]))
+            keep, black, white = filter_tiles(strip, cols_offset, ts, *thresholds)
+            for col_index in np.flatnonzero(keep & candidates):
+                col_offset = cols_offset[col_index]
+                yield row_index * n_cols + int(col_index), strip[:, :, col_offset:col_offset + ts], (black[col_index], white[col_index])
+
+
+READERS = {
+    "window": WindowReader,
+    "strip": StripReader
+}
@@ -0,0 +1,130 @@
+import math
+import numpy as np
+import multiprocessing as mp
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import rasterio
+
+from .tile_grid import TileGrid
+from .tile_filters import OverviewPrefilter
+from .orthophoto_reader import READERS, ReaderStats
+
+
+# State of each worker process, set once by the pool initializer.
+_worker = {}
+
+def _init_worker(orthophoto_filepath: Path, tile_grid: TileGrid, prefilter: OverviewPrefilter | None, reader_name: str, black_threshold: float, white_threshold: float, tile_mask: np.ndarray | None = None) -> None:
+    _worker.update(
+        orthophoto_filepath=orthophoto_filepath,
+        tile_grid=tile_grid,
+        prefilter=prefilter,
+        tile_mask=tile_mask,
+        reader_name=reader_name,
+        thresholds=(black_threshold, white_threshold)
+    )
+
+
+def extract_band(row_start: int, row_end: int) -> tuple[str | None, str | None, np.ndarray, np.ndarray, ReaderStats]:
+    """ Read and filter tile rows [row_start, row_end) and copy the kept tiles (n, n, 3) in a shared memory block. """
+    ts = _worker["tile_grid"].tile_size
+
+    kept_indexes, kept_tiles, kept_stats = [], [], []
+    with rasterio.open(_worker["orthophoto_filepath"]) as src:
+        reader = READERS[_worker["reader_name"]](src, _worker["tile_grid"], _worker["prefilter"], tile_mask=_worker["tile_mask"])
+        for index, tile, filter_stats in reader.iter_kept_tiles(_worker["thresholds"], row_start, row_end):
+            kept_indexes.append(index)
+            kept_tiles.append(tile)
+            kept_stats.append(filter_stats)
+
+    kept_stats = np.array(kept_stats, dtype=np.float32).reshape(-1, 2)
+    if len(kept_tiles) == 0:
+        return None, None, np.array(kept_indexes, dtype=np.int64), kept_stats, reader.stats
+
+    shm = SharedMemory(create=True, size=len(kept_tiles) * ts * ts * 3 * kept_tiles[0].dtype.itemsize)
+    buffer = np.ndarray((len(kept_tiles), ts, ts, 3), dtype=kept_tiles[0].dtype, buffer=shm.buf)
+    for i, tile in enumerate(kept_tiles):
+        buffer[i] = np.transpose(tile, (1, 2, 0))
+    del buffer
+    shm.close()
+
+    return shm.name, kept_tiles[0].dtype.str, np.array(kept_indexes, dtype=np.int64), kept_stats, reader.stats
+
+
+class ParallelTileExtractor:
+    """ Split the tile grid in row bands, read and filter them in worker processes. """
+
+    def __init__(self, orthophoto_filepath: Path, tile_grid: TileGrid, prefilter: OverviewPrefilter | None, reader_name: str, black_threshold: float, white_threshold: float, workers: int, max_band_bytes: int | None = None, tile_mask: np.ndarray | None = None) -> None:
+        self.orthophoto_filepath = orthophoto_filepath
+        self.tile_grid = tile_grid
+        self.prefilter = prefilter
+        self.tile_mask = tile_mask
+        self.reader_name = reader_name
+        self.thresholds = (black_threshold, white_threshold)
+        self.workers = workers
+        self.stats = ReaderStats()
+
+        # Several bands per worker to balance the load, but a bounded number in flight to bound memory.
+        n_rows = self.tile_grid.shape[0]
+        self.band_rows = max(1, math.ceil(n_rows / (self.workers * 4)))
+        self.max_in_flight = self.workers * 2
+
+        # Bound the shared memory of a band if all its tiles are kept.
+        if max_band_bytes is not None:
+            row_bytes = self.tile_grid.shape[1] * self.tile_grid.tile_size**2 * 3
+            self.band_rows = max(1, min(self.band_rows, max_band_bytes // row_bytes))
+
+    def iter_tiles(self, row_start: int = 0):
+        """
+            Yield (index, tile, (black, white)) of kept tiles from grid row row_start with tile of shape (n, n, 3), in grid order.
+            Tile is a view on the shared memory of its band, only valid until the next tile is requested.
+        """
+        n_rows = self.tile_grid.shape[0]
+        bands = deque((row, min(row + self.band_rows, n_rows)) for row in range(row_start, n_rows, self.band_rows))
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.orthophoto_filepath, self.tile_grid, self.prefilter, self.reader_name, *self.thresholds, self.tile_mask)
+        ) as executor:
+            in_flight = deque()
+            try:
+                while bands or in_flight:
+                    while bands and len(in_flight) < self.max_in_flight:
+                        in_flight.append(executor.submit(extract_band, *bands.popleft()))
+
+                    # Results are consumed in submission order, output is the same as the serial path.
+                    shm_name, dtype, indexes, filter_stats, band_stats = in_flight.popleft().result()
+                    self.stats.tiles += band_stats.tiles
+                    self.stats.prefiltered += band_stats.prefiltered
+                    self.stats.masked += band_stats.masked
+                    self.stats.bytes_read += band_stats.bytes_read
+                    if shm_name is None:
+                        continue
+
+                    shm = SharedMemory(name=shm_name)
+                    ts = self.tile_grid.tile_size
+                    tiles = np.ndarray((len(indexes), ts, ts, 3), dtype=np.dtype(dtype), buffer=shm.buf)
+                    try:
+                        for i, index in enumerate(indexes):
+                            yield int(index), tiles[i], filter_stats[i]
+                    finally:
+                        del tiles
+                        shm.close()
+                        shm.unlink()
+            finally:
+                # Release the shared memory of bands already extracted if we stop early, errors of other bands don't hide the first one.
+                for future in in_flight:
+                    if future.cancel():
+                        continue
+                    try:
+                        shm_name = future.result()[0]
+                    except Exception:
+                        continue
+                    if shm_name is not None:
+                        shm = SharedMemory(name=shm_name)
+                        shm.close()
+                        shm.unlink()
@@ -53,4 +53,8 @@ def get_list_sessions(opt) -> list[Path]:
             df_ses = pd.read_csv(src)
             list_sessions = [Path(row.root_folder, row.session_name) for row in df_ses.itertuples(index=False)]
 
-    return list_sessions
\ No newline at end of file
+    return list_sessions
+
+def get_orthophoto_path(session: Path) -> Path:
+    """ Path of the session orthophoto """
+    return Path(session, "PROCESSED_DATA", "PHOTOGRAMMETRY", "odm_orthophoto", "odm_orthophoto.tif")
@@ -1,113 +1,180 @@
 import os
+import rasterio
+import itertools
 import numpy as np
+from contextlib import ExitStack
+from rasterio.windows import Window
+from rasterio.enums import MergeAlg
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
 import pandas as pd
 from tqdm import tqdm
+import shapely
 import geopandas as gpd
 from geocube.api.core import make_geocube
-from math import radians, cos, sin, sqrt, atan2
+from geocube.geo_utils.geobox import GeoBoxMaker
 
 from matplotlib.path import Path
-from scipy.spatial import ConvexHull
-from scipy.interpolate import griddata
+from scipy.spatial import ConvexHull, Delaunay
+from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator, CloughTocher2DInterpolator
 
 
 def haversine(point1, point2):
-    """Calculate the Haversine distance between two geographic points."""
+    """Calculate the Haversine distance between geographic points, given as scalars or arrays."""
     R = 6371000  # Earth radius in meters
     lat1, lon1 = point1
     lat2, lon2 = point2
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
     dlat = lat2 - lat1
     dlon = lon2 - lon1
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     return R * c
 
 
+def read_predictions(predictions_path, columns=None):
+    """Read scores file written by the savers, parquet or csv."""
+    if str(predictions_path).endswith(".parquet"):
+        return pd.read_parquet(predictions_path, columns=columns)
+    return pd.read_csv(predictions_path, usecols=columns)
+
+
+def iter_predictions(predictions_path, columns, chunk_rows=65536):
+    """Read scores file by chunks of rows."""
+    if str(predictions_path).endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(predictions_path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(predictions_path, usecols=columns, chunksize=chunk_rows)
+
+
+def calculate_degree_spacing(meters, avg_latitude):
+    # Conversion factor from meters to degrees (approximate)
+    meters_per_degree = 111319
+
+    # Convert meters to degrees for latitude
+    degrees_latitude = meters / meters_per_degree
+
+    # Convert latitude from degrees to radians
+    avg_latitude_rad = np.radians(avg_latitude)
+
+    # Convert meters to degrees for longitude
+    degrees_longitude = meters / (meters_per_degree * np.cos(avg_latitude_rad))
+
+    return degrees_latitude, degrees_longitude
+
+
+def check_predictions(predictions_csv):
+    """Return False and print why if rasters can't be interpolated from the predictions."""
+    if len(predictions_csv) == 0:
+        print("[ERROR] No predictions.")
+        return False
+    
+    if "GPSLongitude" not in predictions_csv or "GPSLatitude" not in predictions_csv: 
+        print("[ERROR] No GPS coordinate.")
+        return False
+    
+    if round(predictions_csv["GPSLatitude"].std(), 10) == 0.0 or round(predictions_csv["GPSLongitude"].std(), 10) == 0.0: 
+        print("[ERROR] All frames have the same gps coordinate.")
+        return False
+
+    return True
+
+
 def compute_grid_value(predictions_csv):
     """Prepare gridded data by processing a dataframe from CSV and calculating grid_value."""
     
-    distances = []
-    for i in range(len(predictions_csv) - 1):
-        p1 = (predictions_csv.iloc[i]['GPSLatitude'], predictions_csv.iloc[i]['GPSLongitude'])
-        p2 = (predictions_csv.iloc[i+1]['GPSLatitude'], predictions_csv.iloc[i+1]['GPSLongitude'])
-        distances.append(haversine(p1, p2))
+    # Distance between each consecutive predictions.
+    lat = predictions_csv['GPSLatitude'].to_numpy()
+    lon = predictions_csv['GPSLongitude'].to_numpy()
+    distances = haversine((lat[:-1], lon[:-1]), (lat[1:], lon[1:]))
 
     median_within = np.median(distances)
 
     return median_within
 
 
-def prepare_gridded_data(predictions_csv, target_class, grid_value, interpolation_method):
-    def calculate_degree_spacing(meters, avg_latitude):
-        # Conversion factor from meters to degrees (approximate)
-        meters_per_degree = 111319
+def build_interpolator(points, values, interpolation_method):
+    """Same interpolators as scipy griddata, with values (n_points, n_classes) sharing one triangulation."""
+    if interpolation_method == "nearest":
+        return NearestNDInterpolator(points, values)
 
-        # Convert meters to degrees for latitude
-        degrees_latitude = meters / meters_per_degree
+    triangulation = Delaunay(points)
+    if interpolation_method == "linear":
+        return LinearNDInterpolator(triangulation, values)
+    if interpolation_method == "cubic":
+        return CloughTocher2DInterpolator(triangulation, values)
 
-        # Convert latitude from degrees to radians
-        avg_latitude_rad = np.radians(avg_latitude)
+    raise NameError(f"Unknown interpolation method {interpolation_method}")
 
-        # Convert meters to degrees for longitude
-        degrees_longitude = meters / (meters_per_degree * np.cos(avg_latitude_rad))
 
-        return degrees_latitude, degrees_longitude
+def prepare_gridded_data(predictions_csv, classes, grid_value, interpolation_method):
+    """Interpolate all classes on the same grid in one pass, the grid, the triangulation and the convex hull mask are computed once."""
     # Convert grid_value, which is in meters, to degrees of latitude and longitude
     latitude_spacing, longitude_spacing = calculate_degree_spacing(grid_value, predictions_csv['GPSLatitude'].mean())
-    # Extract relevant columns
-    df = predictions_csv[['GPSLongitude', 'GPSLatitude', target_class]]
     # Assuming 'GPSLongitude' and 'GPSLatitude' are already in decimal degrees.
     # Creating gridded data using np.meshgrid
     grid_x, grid_y = np.meshgrid(
-        np.arange(df['GPSLongitude'].min(), df['GPSLongitude'].max(), longitude_spacing),
-        np.arange(df['GPSLatitude'].min(), df['GPSLatitude'].max(), latitude_spacing)
+        np.arange(predictions_csv['GPSLongitude'].min(), predictions_csv['GPSLongitude'].max(), longitude_spacing),
+        np.arange(predictions_csv['GPSLatitude'].min(), predictions_csv['GPSLatitude'].max(), latitude_spacing)
     )
-    
-    # Perform linear interpolation using griddata
-    points = df[['GPSLongitude', 'GPSLatitude']].values
-    values = df[target_class].values
-    grid_z = griddata(points, values, (grid_x, grid_y), method=interpolation_method)
-    
-    # Flatten the grid for DataFrame creation
-    grid_x_flat = grid_x.ravel()
-    grid_y_flat = grid_y.ravel()
-    grid_z_flat = grid_z.ravel()
-    
-    # Create a DataFrame from the gridded data
-    df_gridded = pd.DataFrame({
-        'GPSLongitude': grid_x_flat,
-        'GPSLatitude': grid_y_flat,
-        target_class: grid_z_flat
-    })
+    grid_points = np.column_stack((grid_x.ravel(), grid_y.ravel()))
 
     # Compute the convex hull for the original points
+    points = predictions_csv[['GPSLongitude', 'GPSLatitude']].values
     hull = ConvexHull(points)
     hull_path = Path(points[hull.vertices])
     
-    # Mask the gridded data based on convex hull
-    mask = np.array([hull_path.contains_point(i) for i in zip(df_gridded['GPSLongitude'], df_gridded['GPSLatitude'])])
-    df_gridded.loc[~mask, target_class] = np.nan  # Apply mask
+    # Mask the gridded data based on convex hull, only the points inside are interpolated
+    grid_points = grid_points[hull_path.contains_points(grid_points)]
+
+    # Interpolate every classes at once, gridded data is (n_grid_points, 2 + n_classes) with longitude and latitude first
+    values = predictions_csv[classes].to_numpy(dtype=np.float64)
+    gridded = np.empty((len(grid_points), 2 + len(classes)), dtype=np.float64)
+    gridded[:, :2] = grid_points
+    gridded[:, 2:] = build_interpolator(points, values, interpolation_method)(grid_points)
+
+    return gridded, latitude_spacing, longitude_spacing
+
+
+def write_class_raster(gridded, class_index, target_class, resol, output_path, sessiontag):
+    """Rasterize one class of the gridded data with geocube and write it."""
+    values = gridded[:, 2 + class_index]
 
     # Remove NaN values that result from the interpolation step
-    df_gridded = df_gridded.dropna(subset=[target_class])
+    valid = ~np.isnan(values)
+    df_gridded = pd.DataFrame({
+        'GPSLongitude': gridded[valid, 0],
+        'GPSLatitude': gridded[valid, 1],
+        target_class: values[valid]
+    })
 
-    return df_gridded, latitude_spacing, longitude_spacing
+    gdf = gpd.GeoDataFrame(df_gridded, geometry=gpd.points_from_xy(df_gridded['GPSLongitude'], df_gridded['GPSLatitude']), crs='EPSG:4326')
+    cube = make_geocube(vector_data=gdf, measurements=[target_class], resolution=(-resol, resol))
+    raster_path = os.path.join(output_path, f"{sessiontag}_{target_class.replace('/', '_')}_classification_multilabel_raster.tif")
+    cube[target_class].rio.to_raster(raster_path)
 
 
-def create_rasters_for_classes(predictions_csv_path, classes, output_path, sessiontag, interpolation_method):
+# Gridded data of each raster worker process, attached once by the pool initializer.
+_raster_worker = {}
 
-    predictions_csv = pd.read_csv(predictions_csv_path)
-    if len(predictions_csv) == 0:
-        print("[ERROR] No predictions.")
-        return None
-    
-    if "GPSLongitude" not in predictions_csv or "GPSLatitude" not in predictions_csv: 
-        print("[ERROR] No GPS coordinate.")
-        return None
-    
-    if round(predictions_csv["GPSLatitude"].std(), 10) == 0.0 or round(predictions_csv["GPSLongitude"].std(), 10) == 0.0: 
-        print("[ERROR] All frames have the same gps coordinate.")
+def _init_raster_worker(shm_name, shape):
+    _raster_worker["shm"] = SharedMemory(name=shm_name)
+    _raster_worker["gridded"] = np.ndarray(shape, dtype=np.float64, buffer=_raster_worker["shm"].buf)
+
+
+def _write_class_raster_worker(class_index, target_class, resol, output_path, sessiontag):
+    write_class_raster(_raster_worker["gridded"], class_index, target_class, resol, output_path, sessiontag)
+
+
+def create_rasters_for_classes(predictions_csv_path, classes, output_path, sessiontag, interpolation_method, workers=0):
+
+    predictions_csv = read_predictions(predictions_csv_path)
+    if not check_predictions(predictions_csv):
         return None
 
     # Assuming compute_grid_value and prepare_gridded_data are already defined and correct
@@ -117,11 +184,264 @@ def create_rasters_for_classes(predictions_csv_path, classes, output_path, sessi
         print("[ERROR] Something occurs during computing grid value. Mission is not a polygon.")
         return None
 
-    for target_class in tqdm(classes):
-        df_gridded, lat_spacing, lon_spacing = prepare_gridded_data(predictions_csv, target_class, grid_value, interpolation_method)
-        gdf = gpd.GeoDataFrame(df_gridded, geometry=gpd.points_from_xy(df_gridded['GPSLongitude'], df_gridded['GPSLatitude']), crs='EPSG:4326')
-        # Calculate initial resolution based on median distances
-        resol =  np.max([lat_spacing, lon_spacing])
-        cube = make_geocube(vector_data=gdf, resolution=(-resol, resol))
-        raster_path = os.path.join(output_path, f"{sessiontag}_{target_class.replace('/', '_')}_classification_multilabel_raster.tif")
-        cube[target_class].rio.to_raster(raster_path)
\ No newline at end of file
+    gridded, lat_spacing, lon_spacing = prepare_gridded_data(predictions_csv, classes, grid_value, interpolation_method)
+    # Calculate initial resolution based on median distances
+    resol =  np.max([lat_spacing, lon_spacing])
+
+    if workers <= 0:
+        for class_index, target_class in enumerate(tqdm(classes)):
+            write_class_raster(gridded, class_index, target_class, resol, output_path, sessiontag)
+        return
+
+    # Spread classes over a process pool, gridded data is shared instead of pickled for each class.
+    shm = SharedMemory(create=True, size=gridded.nbytes)
+    try:
+        np.ndarray(gridded.shape, dtype=np.float64, buffer=shm.buf)[:] = gridded
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_raster_worker,
+            initargs=(shm.name, gridded.shape)
+        ) as executor:
+            futures = [
+                executor.submit(_write_class_raster_worker, class_index, target_class, resol, output_path, sessiontag)
+                for class_index, target_class in enumerate(classes)
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def create_raster_from_tile_grid(predictions_path, classes, tile_grid, crs, output_path, sessiontag):
+    """Write the scores of each tile in one multi-band COG, one pixel by tile of the capture grid, without interpolation."""
+
+    predictions = read_predictions(predictions_path)
+    if len(predictions) == 0:
+        print("[ERROR] No predictions.")
+        return None
+
+    if "TileRow" not in predictions or "TileCol" not in predictions:
+        print("[ERROR] No tile grid position, scores file is older than grid raster mode.")
+        return None
+
+    rows, cols = tile_grid.shape
+    grid = np.full((len(classes), rows, cols), np.nan, dtype=np.float32)
+    grid[:, predictions["TileRow"].to_numpy(), predictions["TileCol"].to_numpy()] = predictions[classes].to_numpy(dtype=np.float32).T
+
+    raster_path = os.path.join(output_path, f"{sessiontag}_classification_multilabel_raster_grid.tif")
+    with rasterio.open(
+        raster_path, "w",
+        driver="COG",
+        height=rows,
+        width=cols,
+        count=len(classes),
+        dtype=np.float32,
+        nodata=np.nan,
+        crs=crs,
+        transform=tile_grid.raster_transform,
+        compress="deflate",
+        predictor="YES"
+    ) as dst:
+        dst.write(grid)
+        for i, target_class in enumerate(classes, start=1):
+            dst.set_band_description(i, target_class)
+
+
+# Tiled GeoTIFF written by windows, COG can't be written without the whole raster in memory.
+STREAMING_PROFILE = {
+    "driver": "GTiff",
+    "dtype": "float32",
+    "nodata": np.nan,
+    "tiled": True,
+    "blockxsize": 256,
+    "blockysize": 256,
+    "compress": "deflate",
+    "predictor": 3,
+    "BIGTIFF": "IF_SAFER"
+}
+
+
+def class_geobox(bounds, resol):
+    """Grid of the geocube raster of points within bounds (lon_min, lat_min, lon_max, lat_max)."""
+    corners = gpd.GeoDataFrame(geometry=gpd.points_from_xy(bounds[::2], bounds[1::2]), crs="EPSG:4326")
+    return GeoBoxMaker(output_crs=None, resolution=(-resol, resol), align=None, geom=None, like=None).from_vector(corners)
+
+
+class StreamingClassRaster:
+    """Rows of a class raster burnt from chunks of points of increasing latitude, written once no later point can reach them."""
+
+    def __init__(self, dst, transform):
+        self.dst, self.transform = dst, transform
+        self.width, self.height = dst.width, dst.height
+
+        # Pending rows [top, bottom) of the raster, rows below bottom are written.
+        self.top, self.bottom = dst.height, dst.height
+        self.buffer = np.empty((0, self.width), dtype=np.float64)
+
+    def burn(self, lon, lat, values):
+        """Burn points like geocube, the last point falling in a pixel gives its value."""
+        if len(values) == 0:
+            return
+
+        # Rows of the points within one row of rounding, rows below the lowest one + 1 are final.
+        first_row = int(np.floor((self.transform.f - lat.max()) / -self.transform.e))
+        top = min(max(first_row - 1, 0), self.top)
+        if top < self.top:
+            self.buffer = np.concatenate((np.full((self.top - top, self.width), np.nan), self.buffer))
+            self.top = top
+
+        rasterize(
+            zip(shapely.points(lon, lat), values),
+            out=self.buffer,
+            transform=self.transform * Affine.translation(0, self.top),
+            all_touched=False,
+            merge_alg=MergeAlg.replace
+        )
+        self.flush(max(first_row + 2, self.top))
+
+    def flush(self, row):
+        """Write the pending rows from row to the bottom."""
+        if row >= self.bottom:
+            return
+        self.dst.write(self.buffer[row - self.top:], 1, window=Window(0, row, self.width, self.bottom - row))
+        self.buffer = self.buffer[:row - self.top]
+        self.bottom = row
+
+    def close(self):
+        """Write the pending rows and the rows above them, without points."""
+        self.flush(self.top)
+        if self.top > 0:
+            self.buffer, self.top = np.full((self.top, self.width), np.nan), 0
+            self.flush(0)
+
+
+def create_rasters_for_classes_streaming(predictions_path, classes, output_path, sessiontag, interpolation_method, window_bytes):
+    """
+        Same rasters as create_rasters_for_classes, written by windows of rows in tiled GeoTIFF without the dense grid in memory.
+        Interpolated points are spilled in a temporary file, then burnt in the same grid and order as geocube.
+    """
+    predictions = read_predictions(predictions_path, ["GPSLongitude", "GPSLatitude", *classes])
+    if not check_predictions(predictions):
+        return None
+
+    grid_value = compute_grid_value(predictions)
+    if grid_value == 0.0:
+        print("[ERROR] Something occurs during computing grid value. Mission is not a polygon.")
+        return None
+
+    # Same grid as prepare_gridded_data.
+    latitude_spacing, longitude_spacing = calculate_degree_spacing(grid_value, predictions['GPSLatitude'].mean())
+    resol = np.max([latitude_spacing, longitude_spacing])
+    longitudes = np.arange(predictions['GPSLongitude'].min(), predictions['GPSLongitude'].max(), longitude_spacing)
+    latitudes = np.arange(predictions['GPSLatitude'].min(), predictions['GPSLatitude'].max(), latitude_spacing)
+
+    points = predictions[['GPSLongitude', 'GPSLatitude']].to_numpy()
+    hull_path = Path(points[ConvexHull(points).vertices])
+    interpolator = build_interpolator(points, predictions[classes].to_numpy(dtype=np.float64), interpolation_method)
+    del predictions
+
+    # Interpolate by chunks of grid rows, gridded points are (n_points, 2 + n_classes) as in prepare_gridded_data.
+    record = 2 + len(classes)
+    chunk_rows = max(1, window_bytes // (max(len(longitudes), 1) * (32 + 16 * record)))
+    spill_path = os.path.join(output_path, f"{sessiontag}_gridded.tmp")
+    bounds = np.tile([np.inf, np.inf, -np.inf, -np.inf], (len(classes), 1))
+    chunk_counts = []
+    try:
+        with open(spill_path, "wb") as f:
+            for row_start in range(0, len(latitudes), chunk_rows):
+                grid_x, grid_y = np.meshgrid(longitudes, latitudes[row_start:row_start + chunk_rows])
+                grid_points = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+                grid_points = grid_points[hull_path.contains_points(grid_points)]
+
+                gridded = np.empty((len(grid_points), record), dtype=np.float64)
+                gridded[:, :2] = grid_points
+                gridded[:, 2:] = interpolator(grid_points) if len(grid_points) else np.empty((0, len(classes)))
+                f.write(gridded.tobytes())
+                chunk_counts.append(len(gridded))
+
+                # Bounds of the points kept by class, NaN values are removed by class.
+                for class_index in range(len(classes)):
+                    valid = gridded[~np.isnan(gridded[:, 2 + class_index]), :2]
+                    if len(valid):
+                        bounds[class_index, :2] = np.minimum(bounds[class_index, :2], valid.min(axis=0))
+                        bounds[class_index, 2:] = np.maximum(bounds[class_index, 2:], valid.max(axis=0))
+
+        gridded_all = np.memmap(spill_path, dtype=np.float64, mode="r", shape=(sum(chunk_counts), record)) if sum(chunk_counts) else None
+        with ExitStack() as stack:
+            rasters = {}
+            for class_index, target_class in enumerate(classes):
+                if not np.isfinite(bounds[class_index]).all():
+                    print(f"[WARNING] No interpolated value for class {target_class}, raster not written.")
+                    continue
+                geobox = class_geobox(bounds[class_index], resol)
+                raster_path = os.path.join(output_path, f"{sessiontag}_{target_class.replace('/', '_')}_classification_multilabel_raster.tif")
+                profile = {**STREAMING_PROFILE, "dtype": "float64", "width": geobox.width, "height": geobox.height, "count": 1, "crs": "EPSG:4326", "transform": geobox.affine}
+                dst = stack.enter_context(rasterio.open(raster_path, "w", **profile))
+                rasters[class_index] = StreamingClassRaster(dst, geobox.affine)
+
+            offset = 0
+            for count in tqdm(chunk_counts):
+                gridded = np.asarray(gridded_all[offset:offset + count]) if count else None
+                offset += count
+                if gridded is None:
+                    continue
+                for class_index, raster in rasters.items():
+                    values = gridded[:, 2 + class_index]
+                    valid = ~np.isnan(values)
+                    raster.burn(gridded[valid, 0], gridded[valid, 1], values[valid])
+
+            for raster in rasters.values():
+                raster.close()
+            del gridded_all
+    finally:
+        if os.path.exists(spill_path):
+            os.remove(spill_path)
+
+
+def create_raster_from_tile_grid_streaming(predictions_path, classes, tile_grid, crs, output_path, sessiontag, window_bytes):
+    """Same raster as create_raster_from_tile_grid in a tiled GeoTIFF, written by windows of grid rows from scores read by chunks in grid order."""
+
+    chunks = iter_predictions(predictions_path, ["TileRow", "TileCol", *classes])
+    first_chunk = next(chunks, None)
+    if first_chunk is None or len(first_chunk) == 0:
+        print("[ERROR] No predictions.")
+        return None
+
+    rows, cols = tile_grid.shape
+    window_rows = max(1, window_bytes // (cols * 4 * len(classes)))
+    window_start, window = 0, np.full((len(classes), window_rows, cols), np.nan, dtype=np.float32)
+
+    raster_path = os.path.join(output_path, f"{sessiontag}_classification_multilabel_raster_grid.tif")
+    profile = {**STREAMING_PROFILE, "width": cols, "height": rows, "count": len(classes), "crs": crs, "transform": tile_grid.raster_transform}
+    with rasterio.open(raster_path, "w", **profile) as dst:
+        for i, target_class in enumerate(classes, start=1):
+            dst.set_band_description(i, target_class)
+
+        def flush():
+            height = min(window_rows, rows - window_start)
+            dst.write(window[:, :height], window=Window(0, window_start, cols, height))
+            window.fill(np.nan)
+
+        for chunk in itertools.chain([first_chunk], chunks):
+            tile_rows, tile_cols = chunk["TileRow"].to_numpy(), chunk["TileCol"].to_numpy()
+            values = chunk[classes].to_numpy(dtype=np.float32)
+            if len(tile_rows) == 0:
+                continue
+            if tile_rows[0] < window_start or np.any(np.diff(tile_rows) < 0):
+                raise NameError("Scores are not in tile grid order, use --raster_mode grid without --memory_budget_mb.")
+
+            # Fill the current window, write it when the chunk goes past its last row.
+            start = 0
+            while start < len(tile_rows):
+                end = start + int(np.searchsorted(tile_rows[start:], window_start + window_rows))
+                window[:, tile_rows[start:end] - window_start, tile_cols[start:end]] = values[start:end].T
+                if end < len(tile_rows):
+                    flush()
+                    window_start += window_rows
+                start = end
+
+        while window_start < rows:
+            flush()
+            window_start += window_rows
@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from pathlib import Path
+from argparse import Namespace
+
+from .checkpoint import session_manifest, SCORES_ARGS
+
+
+def score_cache_key(orthophoto_filepath: Path, opt: Namespace, revision: str) -> str:
+    """ Hash of the orthophoto size and mtime, the tiling and filter arguments and the model revision. """
+    key = session_manifest(orthophoto_filepath, opt, revision, SCORES_ARGS)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class ScoreCache:
+    """
+        Scores of whole sessions stored on disk by key, evicted by least recent use above max_size_MB.
+        An entry holds float32 scores (N, n_classes) and tile grid positions (N, 2) as .npy files, loaded memory-mapped.
+    """
+
+    def __init__(self, cache_dir: str, max_size_MB: float) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_size = max_size_MB * 1e6
+
+    def get(self, key: str, classes: list[str]) -> tuple[np.ndarray, np.ndarray] | None:
+        """ Return scores and grid positions of the entry, None on miss. """
+        entry = Path(self.cache_dir, key)
+        if not Path(entry, "meta.json").exists():
+            return None
+
+        with open(Path(entry, "meta.json"), "r") as f:
+            if json.load(f)["classes"] != classes:
+                return None
+
+        # Last use is the modification time of the meta file.
+        os.utime(Path(entry, "meta.json"))
+        return np.load(Path(entry, "scores.npy"), mmap_mode="r"), np.load(Path(entry, "grid_index.npy"), mmap_mode="r")
+
+    def put(self, key: str, classes: list[str], scores: np.ndarray, grid_index: np.ndarray) -> None:
+        """ Store an entry then evict the least recently used ones. """
+        tmp_entry = Path(self.cache_dir, f"{key}.tmp-{os.getpid()}")
+        tmp_entry.mkdir(exist_ok=True)
+        np.save(Path(tmp_entry, "scores.npy"), np.ascontiguousarray(scores, dtype=np.float32))
+        np.save(Path(tmp_entry, "grid_index.npy"), np.ascontiguousarray(grid_index, dtype=np.int32))
+        with open(Path(tmp_entry, "meta.json"), "w") as f:
+            json.dump({"classes": classes, "tiles": len(scores), "created": time.time()}, f)
+
+        # Rename is atomic, another worker may have stored the same entry.
+        try:
+            os.rename(tmp_entry, Path(self.cache_dir, key))
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def evict(self, keep: str | None = None) -> None:
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            meta = Path(entry, "meta.json")
+            if entry.is_dir() and meta.exists() and ".tmp-" not in entry.name:
+                entries.append((meta.stat().st_mtime, sum(p.stat().st_size for p in entry.iterdir()), entry))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_size:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,200 @@
+import os
+import json
+import math
+import shutil
+import numpy as np
+from pathlib import Path
+
+from .tile_grid import TileGrid
+
+
+# One record by tile, centroid in the orthophoto crs, score_offset is the row of the tile in the scores file.
+INDEX_DTYPE = np.dtype([
+    ("row", "<i4"), ("col", "<i4"),
+    ("x", "<f8"), ("y", "<f8"),
+    ("lon", "<f8"), ("lat", "<f8"),
+    ("black_pct", "<f4"), ("white_pct", "<f4"),
+    ("score_offset", "<i8")
+])
+
+# Mean number of tiles in a cell of the spatial grid.
+TILES_PER_CELL = 256
+
+
+def index_path(path_IA: Path, session_name: str) -> Path:
+    return Path(path_IA, f"{session_name}_index")
+
+
+def build_session_index(scores_path: Path, classes: list[str], tile_grid: TileGrid, crs: str, output_path: Path, chunk_rows: int = 65536) -> bool:
+    """
+        Write the index of a parquet scores file, tiles sorted by cell of a regular spatial grid and scores stored by class.
+        Return False if the scores file has no tile grid position.
+    """
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(scores_path)
+    names = parquet.schema_arrow.names
+    if "TileRow" not in names or "TileCol" not in names:
+        print("[WARNING] No tile grid position, scores file is older than the session index.")
+        return False
+    has_stats = "BlackPercentage" in names and "WhitePercentage" in names
+
+    output_path = Path(output_path)
+    tmp_path = Path(output_path.parent, f"{output_path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    # Scores of a class are contiguous, a top-k query reads only one class.
+    count = parquet.metadata.num_rows
+    tiles = np.empty(count, dtype=INDEX_DTYPE)
+    scores = np.lib.format.open_memmap(Path(tmp_path, "scores.npy"), mode="w+", dtype=np.float32, shape=(len(classes), count))
+
+    columns = ["TileRow", "TileCol", *classes] + (["BlackPercentage", "WhitePercentage"] if has_stats else [])
+    start = 0
+    for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns):
+        end = start + batch.num_rows
+        rows = batch.column("TileRow").to_numpy()
+        cols = batch.column("TileCol").to_numpy()
+        indexes = rows.astype(np.int64) * tile_grid.shape[1] + cols
+
+        chunk = tiles[start:end]
+        chunk["row"], chunk["col"] = rows, cols
+        chunk["x"], chunk["y"] = tile_grid.centroids[indexes].T
+        chunk["lon"], chunk["lat"] = tile_grid.lonlat[indexes].T
+        chunk["black_pct"] = batch.column("BlackPercentage").to_numpy(zero_copy_only=False) if has_stats else np.nan
+        chunk["white_pct"] = batch.column("WhitePercentage").to_numpy(zero_copy_only=False) if has_stats else np.nan
+        chunk["score_offset"] = np.arange(start, end)
+        for class_index, class_name in enumerate(classes):
+            scores[class_index, start:end] = batch.column(class_name).to_numpy(zero_copy_only=False)
+        start = end
+
+    scores.flush()
+    del scores
+
+    # Regular grid over the centroids, about TILES_PER_CELL tiles by cell.
+    x_min, y_min = (float(tiles["x"].min()), float(tiles["y"].min())) if count else (0.0, 0.0)
+    width, height = (float(tiles["x"].max()) - x_min, float(tiles["y"].max()) - y_min) if count else (0.0, 0.0)
+    n_cells = max(1, count // TILES_PER_CELL)
+    cell_size = max(math.sqrt(width * height / n_cells), max(width, height) / n_cells, 1e-6)
+    cells_shape = (int(height // cell_size) + 1, int(width // cell_size) + 1)
+
+    cell_ids = ((tiles["y"] - y_min) // cell_size).astype(np.int64) * cells_shape[1] + ((tiles["x"] - x_min) // cell_size).astype(np.int64)
+    order = np.argsort(cell_ids, kind="stable")
+    cell_offsets = np.concatenate(([0], np.cumsum(np.bincount(cell_ids, minlength=cells_shape[0] * cells_shape[1]))))
+
+    # Position in tiles.npy of each row of the scores file.
+    tile_of_offset = np.empty(count, dtype=np.int64)
+    tile_of_offset[order] = np.arange(count)
+
+    np.save(Path(tmp_path, "tiles.npy"), tiles[order])
+    np.save(Path(tmp_path, "cell_offsets.npy"), cell_offsets.astype(np.int64))
+    np.save(Path(tmp_path, "tile_of_offset.npy"), tile_of_offset)
+    with open(Path(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "scores_file": Path(scores_path).name,
+            "classes": classes,
+            "crs": crs,
+            "count": count,
+            "grid_shape": list(tile_grid.shape),
+            "origin": [x_min, y_min],
+            "cell_size": cell_size,
+            "cells_shape": list(cells_shape)
+        }, f, indent=4)
+
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+    return True
+
+
+class SessionIndex:
+    """
+        Memory-mapped index of the tiles of a session, written by build_session_index.
+        Coordinates of the queries are in the orthophoto crs, only the cells and the classes queried are read from disk.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        with open(Path(self.path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+
+        self.classes = self.meta["classes"]
+        self.origin, self.cell_size = self.meta["origin"], self.meta["cell_size"]
+        self.cells_shape = tuple(self.meta["cells_shape"])
+
+        self.tiles = np.load(Path(self.path, "tiles.npy"), mmap_mode="r")
+        self.scores_by_class = np.load(Path(self.path, "scores.npy"), mmap_mode="r")
+        self.cell_offsets = np.load(Path(self.path, "cell_offsets.npy"), mmap_mode="r")
+        self.tile_of_offset = np.load(Path(self.path, "tile_of_offset.npy"), mmap_mode="r")
+
+    @classmethod
+    def for_session(cls, path_IA: Path, session_name: str) -> "SessionIndex":
+        return cls(index_path(path_IA, session_name))
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def cell_of(self, x: float, y: float) -> tuple[int, int]:
+        """ Cell (row, col) of a point, outside of the grid if the point is. """
+        return int((y - self.origin[1]) // self.cell_size), int((x - self.origin[0]) // self.cell_size)
+
+    def cells_tiles(self, cell_row: int, col_start: int, col_end: int) -> np.ndarray:
+        """ Tiles of cells [col_start, col_end] of a cell row, a contiguous slice of the index. """
+        col_start, col_end = max(col_start, 0), min(col_end, self.cells_shape[1] - 1)
+        if not 0 <= cell_row < self.cells_shape[0] or col_start > col_end:
+            return self.tiles[:0]
+        first = cell_row * self.cells_shape[1]
+        return self.tiles[self.cell_offsets[first + col_start]:self.cell_offsets[first + col_end + 1]]
+
+    def bbox(self, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+        """ Tiles whose centroid is in the bounding box. """
+        row_start, col_start = self.cell_of(x_min, y_min)
+        row_end, col_end = self.cell_of(x_max, y_max)
+
+        found = [self.cells_tiles(cell_row, col_start, col_end) for cell_row in range(max(row_start, 0), min(row_end, self.cells_shape[0] - 1) + 1)]
+        tiles = np.concatenate(found) if found else self.tiles[:0].copy()
+        inside = (tiles["x"] >= x_min) & (tiles["x"] <= x_max) & (tiles["y"] >= y_min) & (tiles["y"] <= y_max)
+        return tiles[inside]
+
+    def nearest(self, x: float, y: float, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """ Return the k tiles nearest to a point and their distances, searching rings of cells around the point. """
+        cell_row, cell_col = self.cell_of(x, y)
+        last_ring = max(abs(cell_row), abs(cell_row - self.cells_shape[0] + 1), abs(cell_col), abs(cell_col - self.cells_shape[1] + 1))
+
+        found = []
+        for ring in range(last_ring + 1):
+            # Top and bottom rows of the ring, then its left and right columns.
+            found.append(self.cells_tiles(cell_row - ring, cell_col - ring, cell_col + ring))
+            if ring > 0:
+                found.append(self.cells_tiles(cell_row + ring, cell_col - ring, cell_col + ring))
+                for row in range(cell_row - ring + 1, cell_row + ring):
+                    found.append(self.cells_tiles(row, cell_col - ring, cell_col - ring))
+                    found.append(self.cells_tiles(row, cell_col + ring, cell_col + ring))
+
+            # Tiles of the next rings are at least ring cells away.
+            tiles = np.concatenate(found)
+            if len(tiles) >= k:
+                distances = np.hypot(tiles["x"] - x, tiles["y"] - y)
+                if np.partition(distances, k - 1)[k - 1] <= ring * self.cell_size:
+                    break
+
+        tiles = np.concatenate(found) if found else self.tiles[:0].copy()
+        distances = np.hypot(tiles["x"] - x, tiles["y"] - y)
+        nearest = np.argsort(distances, kind="stable")[:k]
+        return tiles[nearest], distances[nearest]
+
+    def scores(self, tiles: np.ndarray, classes: list[str] | None = None) -> np.ndarray:
+        """ Scores (N, n_classes) of tiles returned by a query, of all classes if not set. """
+        classes = self.classes if classes is None else classes
+        offsets = np.asarray(tiles["score_offset"])
+        return np.stack([self.scores_by_class[self.classes.index(class_name)][offsets] for class_name in classes], axis=1)
+
+    def top_k(self, class_name: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """ Return the k tiles with the highest scores of a class and their scores, highest first. """
+        class_scores = self.scores_by_class[self.classes.index(class_name)]
+        k = min(k, len(class_scores))
+        if k == 0:
+            return self.tiles[:0].copy(), np.empty(0, dtype=np.float32)
+
+        offsets = np.argpartition(-np.nan_to_num(class_scores, nan=-np.inf), k - 1)[:k]
+        offsets = offsets[np.argsort(-class_scores[offsets], kind="stable")]
+        return self.tiles[self.tile_of_offset[offsets]], np.asarray(class_scores[offsets])
@@ -0,0 +1,120 @@
+import time
+import traceback
+import multiprocessing as mp
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import add_step_to_report
+from .checkpoint import complete_session
+from .memory_budget import MemoryBudget
+from .session_index import build_session_index, index_path
+
+
+def postprocess_session(session_name, scores_path, classes, path_IA, raster_mode, raster_workers, tile_grid, crs, metrics_path, no_prediction_raster, manifest=None, memory_budget_mb=None, session_index=False, export_csv=False):
+    """
+        Create raster predictions and the tile index of a session and add the steps timing to its metrics report, then mark the session as completed.
+        The csv export is written from the scores file if export_csv is set, when the session was not inferred in this run.
+    """
+
+    if export_csv:
+        from ..savers import export_scores_csv
+        print(f"\t-- Export scores of session {session_name} in csv\n\n")
+        export_scores_csv(scores_path, classes)
+
+    start_t = time.perf_counter()
+    if not no_prediction_raster:
+        # Raster stack is only imported when rasters are created.
+        from .predictions_raster_tools import create_rasters_for_classes, create_raster_from_tile_grid
+        from .predictions_raster_tools import create_rasters_for_classes_streaming, create_raster_from_tile_grid_streaming
+
+        print(f"\t-- Creating raster for each class of session {session_name}\n\n")
+        if memory_budget_mb:
+            # Rasters written by windows to stay in the memory budget.
+            window_bytes = MemoryBudget(memory_budget_mb).window_bytes()
+            if raster_mode == "grid":
+                create_raster_from_tile_grid_streaming(scores_path, classes, tile_grid, crs, path_IA, session_name, window_bytes)
+            else:
+                create_rasters_for_classes_streaming(scores_path, classes, path_IA, session_name, 'linear', window_bytes)
+        elif raster_mode == "grid":
+            create_raster_from_tile_grid(scores_path, classes, tile_grid, crs, path_IA, session_name)
+        else:
+            create_rasters_for_classes(scores_path, classes, path_IA, session_name, 'linear', raster_workers)
+
+        if Path(metrics_path).exists():
+            add_step_to_report(metrics_path, "create_rasters_for_classes", time.perf_counter() - start_t, len(classes))
+
+    if session_index and Path(scores_path).exists():
+        print(f"\t-- Creating tile index of session {session_name}\n\n")
+        start_t = time.perf_counter()
+        build_session_index(scores_path, classes, tile_grid, crs, index_path(path_IA, session_name))
+        if Path(metrics_path).exists():
+            add_step_to_report(metrics_path, "build_session_index", time.perf_counter() - start_t, len(tile_grid))
+
+    if manifest is not None:
+        complete_session(path_IA, session_name, manifest)
+
+
+class SessionScheduler:
+    """ Run post-processing of finished sessions in a process pool while the main process infers the next sessions. """
+
+    def __init__(self, workers: int, max_backlog: int, on_done=None) -> None:
+        self.workers = workers
+        self.on_done = on_done
+        self.max_backlog = max(1, max_backlog)
+        self.executor = None
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp.get_context("spawn"))
+
+        self.pending = deque()
+        self.sessions_fail = []
+
+    def submit(self, session: Path, fn, *args) -> None:
+        """
+            Run fn(*args) for the session, inline without workers. Wait for the oldest session if the backlog is full.
+            on_done is called with the session path, sessions of the same name in different folders don't collide.
+        """
+        if self.executor is None:
+            self.run_inline(session, fn, *args)
+            return
+
+        while len(self.pending) >= self.max_backlog:
+            self.collect(*self.pending.popleft())
+
+        self.pending.append((session, self.executor.submit(fn, *args)))
+
+        # Report sessions already finished.
+        while self.pending and self.pending[0][1].done():
+            self.collect(*self.pending.popleft())
+
+    def run_inline(self, session: Path, fn, *args) -> None:
+        try:
+            fn(*args)
+            self.finish(session, True)
+        except Exception:
+            print(traceback.format_exc(), end="\n\n")
+            self.finish(session, False)
+
+    def collect(self, session: Path, future) -> None:
+        try:
+            future.result()
+            self.finish(session, True)
+        except Exception:
+            print(traceback.format_exc(), end="\n\n")
+            self.finish(session, False)
+
+    def finish(self, session: Path, success: bool) -> None:
+        if success:
+            print(f"\nSession {Path(session).name} end succesfully ! ", end="\n\n\n")
+        else:
+            self.sessions_fail.append(Path(session).name)
+        if self.on_done is not None:
+            self.on_done(session, success)
+
+    def drain(self) -> list[str]:
+        """ Wait for all sessions and return the failed ones. """
+        while self.pending:
+            self.collect(*self.pending.popleft())
+        if self.executor is not None:
+            self.executor.shutdown()
+        return self.sessions_fail
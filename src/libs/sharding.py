@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import socket
+import hashlib
+from pathlib import Path
+from datetime import datetime
+
+from .parse_opt import get_orthophoto_path
+
+
+def orthophoto_size(session: Path) -> int:
+    """ Size in bytes of the session orthophoto, 0 if not found. """
+    orthophoto_filepath = get_orthophoto_path(session)
+    return orthophoto_filepath.stat().st_size if orthophoto_filepath.is_file() else 0
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """ Parse K/N with 1 <= K <= N. """
+    try:
+        index, count = (int(a) for a in shard.split("/"))
+    except ValueError:
+        raise NameError(f"Shard must be K/N, got {shard}")
+    if not 1 <= index <= count:
+        raise NameError(f"Shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def shard_sessions(sessions: list[Path], shard: str) -> list[Path]:
+    """ Keep sessions of shard K/N, sessions are spread by orthophoto size so every worker computes the same assignment. """
+    index, count = parse_shard(shard)
+
+    # Largest orthophotos first on the least loaded shard.
+    sizes = {session: orthophoto_size(session) for session in sessions}
+    loads, assignment = [0] * count, {}
+    for session in sorted(sessions, key=lambda s: (-sizes[s], str(s))):
+        shard_index = loads.index(min(loads))
+        assignment[session] = shard_index
+        loads[shard_index] += max(sizes[session], 1)
+
+    return [session for session in sessions if assignment[session] == index - 1]
+
+
+class SessionClaims:
+    """ Claim files in a shared directory so several workers pull sessions from the same list without double work. """
+
+    def __init__(self, claim_dir: str) -> None:
+        self.claim_dir = Path(claim_dir)
+        self.claim_dir.mkdir(exist_ok=True, parents=True)
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+        # Summary only counts status files written during this run.
+        self.start_t = time.time()
+
+    def key(self, session: Path) -> str:
+        return f"{session.name}_{hashlib.sha1(str(Path(session).resolve()).encode()).hexdigest()[:8]}"
+
+    def claim_path(self, session: Path) -> Path:
+        return Path(self.claim_dir, f"{self.key(session)}.claim")
+
+    def status_path(self, session: Path, status: str) -> Path:
+        return Path(self.claim_dir, f"{self.key(session)}.{status}.json")
+
+    def claim(self, session: Path) -> bool:
+        """
+            Atomically create the claim file of the session, False if another worker is processing it.
+            Claims are removed when the session ends, remove the claim file to release a session of a dead worker.
+        """
+        try:
+            fd = os.open(self.claim_path(session), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, "w") as f:
+            json.dump({"session": str(session), "worker": self.worker, "claimed_at": datetime.now().isoformat()}, f)
+
+        # Status of a previous run.
+        self.status_path(session, "done").unlink(missing_ok=True)
+        self.status_path(session, "failed").unlink(missing_ok=True)
+        return True
+
+    def release(self, session: Path, success: bool) -> None:
+        """ Write the status of a processed session and remove its claim, a later run checks the session manifest to skip it or not. """
+        status = "done" if success else "failed"
+        with open(self.status_path(session, status), "w") as f:
+            json.dump({"session": str(session), "worker": self.worker, "finished_at": datetime.now().isoformat()}, f)
+        self.claim_path(session).unlink(missing_ok=True)
+
+    def abandon(self, session: Path) -> None:
+        """ Remove the claim of a session stopped before its end, without status. """
+        self.claim_path(session).unlink(missing_ok=True)
+
+    def summary(self) -> tuple[list[str], list[str]]:
+        """ Sessions done and failed by all workers since this worker started. """
+        def read(status):
+            sessions = []
+            for path in sorted(self.claim_dir.glob(f"*.{status}.json")):
+                if path.stat().st_mtime < self.start_t:
+                    continue
+                with open(path) as f:
+                    sessions.append(json.load(f)["session"])
+            return sessions
+        return read("done"), read("failed")
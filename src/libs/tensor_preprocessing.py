@@ -0,0 +1,82 @@
+import json
+import torch
+import numpy as np
+from pathlib import Path
+import torch.nn.functional as F
+
+
+# PIL resampling filters used by hugging face image processors.
+RESAMPLE_TO_TORCH_MODE = {0: "nearest", 2: "bilinear", 3: "bicubic"}
+
+# Maximum mean absolute difference of pixel values allowed with the hugging face image processor.
+FAST_PREPROCESSING_TOLERANCE = 0.02
+
+
+class TensorImageProcessor:
+    """ Batched torch version of the resize, center crop, rescale and normalize steps of the model image processor. """
+
+    def __init__(self, config: dict, device: torch.device, pin_memory: bool = False, channels_last: bool = False) -> None:
+        self.config = config
+        self.device = device
+        self.pin_memory = pin_memory and device.type == "cuda"
+        self.channels_last = channels_last
+
+        self.do_resize = config.get("do_resize", True)
+        self.size = config.get("size", {"shortest_edge": 224})
+        self.mode = RESAMPLE_TO_TORCH_MODE.get(config.get("resample", 3), "bicubic")
+
+        self.do_center_crop = config.get("do_center_crop", False)
+        self.crop_size = config.get("crop_size", {"height": 224, "width": 224})
+
+        # Rescale and normalize are merged in one affine transform.
+        rescale_factor = config.get("rescale_factor", 1 / 255) if config.get("do_rescale", True) else 1.0
+        mean = np.array(config.get("image_mean", [0.0, 0.0, 0.0])) if config.get("do_normalize", True) else np.zeros(3)
+        std = np.array(config.get("image_std", [1.0, 1.0, 1.0])) if config.get("do_normalize", True) else np.ones(3)
+        self.scale = torch.tensor(rescale_factor / std, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+        self.offset = torch.tensor(-mean / std, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+
+    @classmethod
+    def from_pretrained(cls, repo_path: Path, device: torch.device, pin_memory: bool = False, channels_last: bool = False) -> "TensorImageProcessor":
+        with open(Path(repo_path, "preprocessor_config.json")) as f:
+            config = json.load(f)
+        return cls(config, device, pin_memory, channels_last)
+
+    def resize_shape(self, height: int, width: int) -> tuple[int, int]:
+        """ Same output size as transformers get_resize_output_image_size. """
+        if "shortest_edge" in self.size:
+            short, long = (width, height) if width <= height else (height, width)
+            new_short, new_long = self.size["shortest_edge"], int(self.size["shortest_edge"] * long / short)
+            return (new_long, new_short) if width <= height else (new_short, new_long)
+        return self.size["height"], self.size["width"]
+
+    def __call__(self, frames: np.ndarray) -> torch.Tensor:
+        """ Turn a (B, H, W, 3) uint8 batch in model pixel values (B, 3, h, w) on device. """
+        x = torch.from_numpy(np.ascontiguousarray(frames))
+        if self.pin_memory:
+            x = x.pin_memory()
+        x = x.to(self.device, non_blocking=self.pin_memory).permute(0, 3, 1, 2).float()
+
+        if self.do_resize:
+            shape = self.resize_shape(x.shape[2], x.shape[3])
+            if shape != tuple(x.shape[2:]):
+                antialias = self.mode != "nearest"
+                x = F.interpolate(x, size=shape, mode=self.mode, antialias=antialias, align_corners=False if antialias else None)
+
+                # Hugging face resizes with PIL on uint8 images.
+                x = x.round_().clamp_(0, 255)
+
+        if self.do_center_crop:
+            crop_height, crop_width = self.crop_size["height"], self.crop_size["width"]
+            top, left = (x.shape[2] - crop_height) // 2, (x.shape[3] - crop_width) // 2
+            x = x[:, :, top:top + crop_height, left:left + crop_width]
+
+        x = x * self.scale + self.offset
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def compare(self, image_processor, frames: np.ndarray) -> tuple[float, float]:
+        """ Return mean and max absolute difference with the hugging face image processor on a batch. """
+        expected = image_processor(list(frames), return_tensors="pt")["pixel_values"].to(self.device)
+        diff = (self(frames) - expected).abs()
+        return diff.mean().item(), diff.max().item()
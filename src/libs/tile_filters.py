@@ -0,0 +1,84 @@
+import math
+import numpy as np
+from rasterio.enums import MaskFlags
+
+from .tile_grid import TileGrid
+
+
+def filter_tiles(strip: np.ndarray, cols_offset: np.ndarray, tile_size: int, black_threshold: float, white_threshold: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Apply black and white thresholds on all tiles of a strip (3, tile_size, width) at once.
+        Return keep mask, percentage of black pixels and percentage of white pixels of each tile.
+    """
+    # A pixel is black (resp. white) if its greyscale value, mean of the three bands, is 0 (resp. 255).
+    pixel_sum = np.sum(strip, axis=0, dtype=np.int32 if np.issubdtype(strip.dtype, np.integer) else None)
+
+    # Count by column then by tile with a cumulative sum, overlapping tiles are supported.
+    black_by_column = np.concatenate(([0], np.cumsum(np.count_nonzero(pixel_sum == 0, axis=0))))
+    white_by_column = np.concatenate(([0], np.cumsum(np.count_nonzero(pixel_sum == 255 * 3, axis=0))))
+
+    size_inline_tile = tile_size * tile_size
+    percentage_black_pixel = (black_by_column[cols_offset + tile_size] - black_by_column[cols_offset]) * 100 / size_inline_tile
+    percentage_white_pixel = (white_by_column[cols_offset + tile_size] - white_by_column[cols_offset]) * 100 / size_inline_tile
+
+    keep = (percentage_black_pixel <= black_threshold) & (percentage_white_pixel <= white_threshold)
+    return keep, percentage_black_pixel, percentage_white_pixel
+
+
+class OverviewPrefilter:
+    """ Flag empty tiles from a low resolution read of the orthophoto mask, before any full resolution decode. """
+
+    def __init__(self, valid: np.ndarray, height: int, width: int, tile_grid: TileGrid) -> None:
+        self.valid = valid
+        self.scale_y, self.scale_x = valid.shape[0] / height, valid.shape[1] / width
+        self.width = width
+
+        # Count valid low resolution pixels under each tile with an integral image.
+        integral = np.zeros((valid.shape[0] + 1, valid.shape[1] + 1), dtype=np.int64)
+        integral[1:, 1:] = np.cumsum(np.cumsum(valid, axis=0), axis=1)
+
+        ts = tile_grid.tile_size
+        r0, r1 = self.to_low_rows(tile_grid.rows, tile_grid.rows + ts)
+        c0, c1 = self.to_low_cols(tile_grid.cols, tile_grid.cols + ts)
+        valid_count = integral[r1, c1] - integral[r0, c1] - integral[r1, c0] + integral[r0, c0]
+        self.empty = valid_count == 0
+
+    @classmethod
+    def from_dataset(cls, src, tile_grid: TileGrid) -> "OverviewPrefilter | None":
+        """ Build the prefilter from the coarsest overview smaller than half a tile, None if the orthophoto has no overview. """
+        factors = [f for f in src.overviews(1) if f <= tile_grid.tile_size // 2]
+        if len(factors) == 0:
+            return None
+
+        out_shape = (math.ceil(src.height / max(factors)), math.ceil(src.width / max(factors)))
+        if all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+            # No alpha or nodata, look for black pixels in the overview.
+            valid = np.sum(src.read([1, 2, 3], out_shape=(3, *out_shape)), axis=0, dtype=np.int32) > 0
+        else:
+            valid = src.dataset_mask(out_shape=out_shape) > 0
+
+        # Dilate by one pixel to stay conservative with the resampling of the overview.
+        dilated = valid.copy()
+        dilated[1:, :] |= valid[:-1, :]
+        dilated[:-1, :] |= valid[1:, :]
+        dilated[:, 1:] |= valid[:, :-1]
+        dilated[:, :-1] |= valid[:, 1:]
+
+        return cls(dilated, src.height, src.width, tile_grid)
+
+    def to_low_rows(self, row_start, row_end):
+        return np.floor(row_start * self.scale_y).astype(np.int64), np.minimum(np.ceil(row_end * self.scale_y).astype(np.int64), self.valid.shape[0])
+
+    def to_low_cols(self, col_start, col_end):
+        return np.floor(col_start * self.scale_x).astype(np.int64), np.minimum(np.ceil(col_end * self.scale_x).astype(np.int64), self.valid.shape[1])
+
+    def column_span(self, row_start: int, row_end: int) -> tuple[int, int] | None:
+        """ Return full resolution columns [start, end) holding data between two rows, None if rows are empty. """
+        r0, r1 = self.to_low_rows(row_start, row_end)
+        valid_columns = np.flatnonzero(self.valid[r0:r1].any(axis=0))
+        if len(valid_columns) == 0:
+            return None
+
+        col_start = int(math.floor(valid_columns[0] / self.scale_x))
+        col_end = int(min(math.ceil((valid_columns[-1] + 1) / self.scale_x), self.width))
+        return col_start, col_end
@@ -0,0 +1,73 @@
+import numpy as np
+from affine import Affine
+from pyproj import Transformer
+
+
+class TileGrid:
+    """ Regular grid of square tiles over an orthophoto, georeferenced without any disk I/O. """
+
+    def __init__(self, transform: Affine, width: int, height: int, tile_size: int, x_overlap: int, y_overlap: int, transformer: Transformer) -> None:
+
+        self.transform = transform
+        self.tile_size = tile_size
+        self.x_overlap = x_overlap
+        self.y_overlap = y_overlap
+
+        # Pixel offsets of the top-left corner of each tile, same order as the original nested loops.
+        self.rows_offset = np.arange(0, height - tile_size + 1, y_overlap, dtype=np.int64)
+        self.cols_offset = np.arange(0, width - tile_size + 1, x_overlap, dtype=np.int64)
+        self.shape = (len(self.rows_offset), len(self.cols_offset))
+
+        rows, cols = np.meshgrid(self.rows_offset, self.cols_offset, indexing="ij")
+        self.rows, self.cols = rows.ravel(), cols.ravel()
+
+        # Bounds of each tile from the window transform.
+        self.bounds = self.compute_bounds(self.rows, self.cols)
+        left, bottom, right, top = self.bounds.T
+        self.centroids = np.column_stack(((left + right) / 2, (bottom + top) / 2))
+
+        # Convert all centroids to lon/lat in one call.
+        lon, lat = transformer.transform(self.centroids[:, 0], self.centroids[:, 1])
+        self.lonlat = np.column_stack((lon, lat))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def compute_bounds(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """ Return (left, bottom, right, top) for each tile, like rasterio dataset bounds. """
+        a, b, c, d, e, f = self.transform[:6]
+        ts = self.tile_size
+
+        if b == 0 and d == 0:
+            left = c + a * cols
+            top = f + e * rows
+            return np.column_stack((left, top + e * ts, left + a * ts, top))
+
+        # Rotated transform, take the envelope of the four corners.
+        corners_col = np.stack((cols, cols + ts, cols, cols + ts))
+        corners_row = np.stack((rows, rows, rows + ts, rows + ts))
+        xs = a * corners_col + b * corners_row + c
+        ys = d * corners_col + e * corners_row + f
+        return np.column_stack((xs.min(axis=0), ys.min(axis=0), xs.max(axis=0), ys.max(axis=0)))
+
+    def grid_index(self, indexes: np.ndarray) -> np.ndarray:
+        """ Return (row, col) positions of the tiles in the grid. """
+        return np.column_stack(np.divmod(np.asarray(indexes, dtype=np.int64), self.shape[1]))
+
+    def coarse_mask(self, step: int) -> np.ndarray:
+        """ Return a mask of the tiles on a grid step times coarser, last row and column always included. """
+        rows = np.zeros(self.shape[0], dtype=bool)
+        cols = np.zeros(self.shape[1], dtype=bool)
+        rows[::step], cols[::step] = True, True
+        rows[-1:], cols[-1:] = True, True
+        return (rows[:, None] & cols[None, :]).ravel()
+
+    @property
+    def raster_transform(self) -> Affine:
+        """ Transform of a raster with one pixel by tile, each pixel is a step of the grid centered on its tile. """
+        return self.transform * Affine.translation((self.tile_size - self.x_overlap) / 2, (self.tile_size - self.y_overlap) / 2) * Affine.scale(self.x_overlap, self.y_overlap)
+
+    def filename(self, session_name: str, index: int) -> str:
+        """ Build tile filename from the centroid truncated to meters. """
+        x, y = self.centroids[index]
+        return f"{session_name}_{int(x)}_{int(y)}.png"
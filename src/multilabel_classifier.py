@@ -4,7 +4,10 @@ from transformers import AutoImageProcessor
 
 from .pipeline import Pipeline
 
-from .libs.multilabel_model import NewHeadDinoV2ForImageClassification, getDynoConfig
+from .libs.inference_backends import BACKENDS, SCORES_TOLERANCE
+from .libs.batch_autotune import BatchSizeTuner, is_out_of_memory
+from .libs.tensor_preprocessing import TensorImageProcessor, FAST_PREPROCESSING_TOLERANCE
+from .libs.multilabel_model import getDynoConfig, get_repo_path, load_model
 
 
 class MultiLabelClassifier(Pipeline):
@@ -12,8 +15,10 @@ class MultiLabelClassifier(Pipeline):
     def __init__(self, repo_name, batch_size):
         super(MultiLabelClassifier).__init__()
 
-        self.image_processor = AutoImageProcessor.from_pretrained(repo_name)
-        self.config = getDynoConfig(repo_name)
+        # Resolve the repository once, everything is then loaded from the local copy.
+        self.repo_path = get_repo_path(repo_name)
+        self.image_processor = AutoImageProcessor.from_pretrained(self.repo_path, local_files_only=True)
+        self.config = getDynoConfig(self.repo_path)
         self.classes_name = list(self.config["label2id"].keys())
         self.batch_size = batch_size
     
@@ -27,15 +32,125 @@ class MultiLabelClassifier(Pipeline):
 class MultiLabelClassifierCUDA(MultiLabelClassifier):
     """Multilabel classifier with cuda"""
 
-    def __init__(self, repo_name, batch_size):
+    def __init__(self, repo_name, batch_size, preprocessing="fast", pin_memory=False, channels_last=False, backend="torch", quantize=None, save_features=False, check_preprocessing=False):
         super().__init__(repo_name, batch_size)
+        self.preprocessing = preprocessing
 
-        self.model = NewHeadDinoV2ForImageClassification.from_pretrained(repo_name)
+        self.model = load_model(self.repo_path)
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
- 
-    def generator(self):
+        self.channels_last = channels_last
+
+        # Backend is built on the first batch, used as example input for export.
+        self.backend_name, self.quantize, self.backend = backend, quantize, None
+
+        # Pooled backbone features are computed by the eager model, exported backends only return logits.
+        self.save_features = save_features
+        if self.save_features and (backend != "torch" or quantize is not None):
+            print("[WARNING] Backbone features are saved with the eager model, backend and quantization are ignored.")
+
+        # Largest number of tiles in one forward pass, set after an out of memory error.
+        self.max_forward_batch = None
+
+        self.fast_processor = None
+        if preprocessing == "fast":
+            self.fast_processor = TensorImageProcessor.from_pretrained(self.repo_path, self.device, pin_memory, channels_last)
+
+        # Fast preprocessing is covered by tests, compare it with the image processor on the first batch only if asked.
+        self.fast_processor_checked = not check_preprocessing
+
+    def preprocess(self, frames):
+        """ Return model inputs of a (B, H, W, 3) batch. """
+        if self.fast_processor is None:
+            return self.image_processor(list(frames), return_tensors="pt").to(self.device)
+
+        # Check once that the fast path matches the image processor, else fall back on it.
+        if not self.fast_processor_checked:
+            self.fast_processor_checked = True
+            mean_diff, max_diff = self.fast_processor.compare(self.image_processor, frames)
+            print(f"\t-- Fast preprocessing difference with image processor: mean {mean_diff:.5f}, max {max_diff:.5f}\n")
+            if mean_diff > FAST_PREPROCESSING_TOLERANCE:
+                print("[WARNING] Fast preprocessing doesn't match the image processor, fall back on the image processor.")
+                self.fast_processor = None
+                return self.preprocess(frames)
+
+        return {"pixel_values": self.fast_processor(frames)}
+
+    def load_backend(self, pixel_values):
+        """ Build the inference backend and check its scores against the eager model, fall back on the eager model if they differ. """
+        self.backend = BACKENDS[self.backend_name](self.model, self.repo_path, self.device, self.quantize, pixel_values)
+        if (self.backend_name != "torch" or self.quantize is not None) and not self.backend.is_accurate(pixel_values):
+            print(f"[WARNING] Scores of backend {self.backend_name} {self.quantize or 'fp32'} are above the tolerance {SCORES_TOLERANCE[self.quantize]}, fall back on the eager fp32 model.")
+            self.backend = BACKENDS["torch"](self.model, self.repo_path, self.device, None, pixel_values)
+
+    def to_device(self):
         # Pass model to gpu
         self.model = self.model.to(self.device)
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+    def forward(self, frames):
+        """ Return logits and pooled features, None if not saved, of a (B, H, W, 3) batch. """
+        inputs = self.preprocess(frames)
+        if self.save_features:
+            with torch.no_grad():
+                features = self.model.extract_features(inputs["pixel_values"].to(self.device))
+                return self.model.classify_features(features), features
+
+        if self.backend is None:
+            self.load_backend(inputs["pixel_values"])
+        return self.backend(inputs["pixel_values"]), None
+
+    def forward_splitting(self, frames):
+        """ Run forward by chunks of max_forward_batch tiles, chunks are halved on out of memory errors. """
+        # All tiles of the batch can be skipped by the deduplication.
+        if len(frames) == 0:
+            return torch.empty((0, len(self.classes_name))), None
+
+        size = len(frames) if self.max_forward_batch is None else self.max_forward_batch
+        while True:
+            try:
+                outputs = [self.forward(frames[i:i + size]) for i in range(0, len(frames), size)]
+                break
+            except Exception as e:
+                if not is_out_of_memory(e) or size == 1:
+                    raise
+                outputs = None
+                if self.device.type == "cuda":
+                    torch.cuda.empty_cache()
+                size = (size + 1) // 2
+                self.max_forward_batch = size
+                print(f"[WARNING] Out of memory, batches are split in chunks of {size} tiles.")
+
+        logits = torch.cat([o[0] for o in outputs])
+        features = torch.cat([o[1] for o in outputs]) if self.save_features else None
+        return logits, features
+
+    def autotune_batch_size(self, memory_limit_MB=None):
+        """ Pick the fastest batch size under the memory limit, probed once per model, host and setup. """
+        setup = f"{self.backend_name}|{self.quantize}|{self.preprocessing}|features={self.save_features}|channels_last={self.channels_last}"
+        tuner = BatchSizeTuner(self.repo_path, self.device, setup, memory_limit_MB)
+        self.batch_size = tuner.cached()
+        if self.batch_size is not None:
+            print(f"\t-- Batch size {self.batch_size} from {tuner.cache_path}\n")
+            return self.batch_size
+
+        # Probe on frames of the model input size.
+        crop_size = self.image_processor.crop_size if getattr(self.image_processor, "do_center_crop", False) else {"height": 224, "width": 224}
+        rng = np.random.default_rng(0)
+        make_frames = lambda batch_size: rng.integers(0, 256, (batch_size, crop_size["height"], crop_size["width"], 3), dtype=np.uint8)
+
+        # Random frames don't check the fast preprocessing, it is checked on the first real batch.
+        self.to_device()
+        checked, self.fast_processor_checked = self.fast_processor_checked, True
+        try:
+            self.batch_size = tuner.tune(self.forward, make_frames)
+        finally:
+            self.fast_processor_checked = checked
+        print(f"\t-- Batch size {self.batch_size} selected and saved in {tuner.cache_path}\n")
+        return self.batch_size
+ 
+    def generator(self):
+        self.to_device()
 
         data = None
         stop = False
@@ -49,14 +164,18 @@ class MultiLabelClassifierCUDA(MultiLabelClassifier):
             if not stop and data:
                 # Check if image is not useless
 
-                inputs = self.image_processor(data["frames"], return_tensors="pt")
-                inputs = inputs.to(self.device)
-                with torch.no_grad():
-                    model_outputs = self.model(**inputs)
+                if "features" in data:
+                    # Stored backbone features, run the head only.
+                    with torch.no_grad():
+                        logits = self.model.classify_features(torch.from_numpy(np.asarray(data["features"], dtype=np.float32)).to(self.device))
+                    del data["features"]
+
+                else:
+                    logits, features = self.forward_splitting(data["frames"])
+                    if features is not None:
+                        data["features"] = features.float().cpu().numpy()
                 
-                data["multilabel_scores"] = []
-                for logit in model_outputs["logits"]:
-                    scores = self.sigmoid(logit.cpu().numpy())
-                    data["multilabel_scores"].append([str(a) for a in scores])
+                # Sigmoid on device, scores are kept as a float32 (B, n_classes) array.
+                data["multilabel_scores"] = torch.sigmoid(logits.float()).cpu().numpy()
 
                 yield data
\ No newline at end of file
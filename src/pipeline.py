@@ -1,11 +1,19 @@
+import time
+import queue
+import threading
+
+
 class Pipeline(object):
     """Common pipeline class fo all pipeline tasks."""
 
+    # Set to a SessionMetrics to record the timings of the task.
+    metrics = None
+
     def __init__(self, source=None):
         self.source = source
 
     def __iter__(self):
-        return self.generator()
+        return self.timed(self.generator())
 
     def generator(self):
         """Yields the pipeline data."""
@@ -22,11 +30,36 @@ class Pipeline(object):
         """Allows to connect the pipeline task using | operator."""
 
         if other is not None:
-            other.source = self.generator()
+            other.source = self.timed(self.generator())
+            if self.metrics is not None:
+                self.metrics.stage(other).upstream = self.metrics.stage(self)
             return other
         else:
             return self
 
+    def timed(self, generator):
+        """Record wall time, items and bytes yielded by the task, upstream tasks included."""
+
+        if self.metrics is None:
+            return generator
+
+        def wrapper(stats):
+            try:
+                while True:
+                    start_t = time.perf_counter()
+                    try:
+                        data = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        stats.wall_time += time.perf_counter() - start_t
+                    stats.add(data)
+                    yield data
+            finally:
+                generator.close()
+
+        return wrapper(self.metrics.stage(self))
+
     def filter(self, data):
         """Overwrite to filter out the pipeline data."""
 
@@ -42,3 +75,67 @@ class Pipeline(object):
 
         return True
 
+
+
+class PrefetchStage(Pipeline):
+    """Pipeline task to run upstream tasks in their own thread behind a bounded queue."""
+
+    _END = object()
+
+    class _Failure(object):
+        """Exception raised upstream, re-raised in the consumer thread."""
+
+        def __init__(self, exception):
+            self.exception = exception
+
+    def __init__(self, depth=2):
+        super(PrefetchStage, self).__init__()
+        self.depth = depth
+
+    def generator(self):
+        """Yields the upstream data produced in a background thread."""
+
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        stats = self.metrics.stage(self) if self.metrics is not None else None
+        if stats is not None:
+            stats.is_queue = True
+
+        def put(item):
+            # Block while the queue is full to apply backpressure, but give up if the consumer stopped.
+            start_t = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    if stats is not None:
+                        stats.queue_full_time += time.perf_counter() - start_t
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for data in self.source:
+                    if not put(data):
+                        return
+                put(self._END)
+            except BaseException as e:
+                put(self._Failure(e))
+            finally:
+                self.source.close()
+
+        thread = threading.Thread(target=produce, name=f"prefetch-{id(self)}", daemon=True)
+        thread.start()
+        try:
+            while self.has_next():
+                item = buffer.get()
+                if item is self._END:
+                    return
+                if isinstance(item, self._Failure):
+                    raise item.exception
+                if self.filter(item):
+                    yield self.map(item)
+        finally:
+            stop.set()
+            thread.join()
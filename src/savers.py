@@ -1,23 +1,128 @@
+import os
+import numpy as np
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+
 from .pipeline import Pipeline
 
+
+def csv_header(classes):
+    return f"FileName,{','.join(classes)},GPSLatitude,GPSLongitude\n"
+
+
+def csv_rows(frame_paths, scores, latitudes, longitudes):
+    """ Rows of the csv export of a batch of scores (B, n_classes). """
+    return "".join(
+        f"{frame_path},{','.join(map(str, frame_scores))},{lat},{lon}\n"
+        for frame_path, frame_scores, lat, lon in zip(frame_paths, scores, latitudes, longitudes)
+    )
+
+
+def export_scores_csv(filename_scores, classes, chunk_rows=65536):
+    """ Write the csv export next to a parquet scores file, in the same format as the savers. """
+    with open(Path(filename_scores).with_suffix(".csv"), "w") as f:
+        f.write(csv_header(classes))
+        for batch in pq.ParquetFile(filename_scores).iter_batches(batch_size=chunk_rows, columns=["FileName", *classes, "GPSLatitude", "GPSLongitude"]):
+            scores = np.column_stack([batch.column(classe).to_numpy(zero_copy_only=False) for classe in classes])
+            f.write(csv_rows(
+                batch.column("FileName").to_pylist(), scores,
+                batch.column("GPSLatitude").to_numpy(zero_copy_only=False), batch.column("GPSLongitude").to_numpy(zero_copy_only=False)
+            ))
+
+
 class  MultilabelPredictions(Pipeline):
     """Pipeline task to save Multilabel predictions"""
 
-    def __init__(self, classes):
-        self.filename_scores, self.csv_connector_scores = None, None
+    def __init__(self, classes, export_csv=False, checkpoint_every=0):
+        self.filename_scores, self.parquet_writer_scores = None, None
+        self.filename_scores_csv, self.csv_connector_scores = None, None
         self.classes = classes
+        self.export_csv = export_csv
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint, self.part_path = None, None
         super(MultilabelPredictions, self).__init__()
+
+        self.schema = pa.schema(
+            [("FileName", pa.string())] +
+            [(classe, pa.float32()) for classe in self.classes] +
+            [("GPSLatitude", pa.float64()), ("GPSLongitude", pa.float64())] +
+            [("TileRow", pa.int32()), ("TileCol", pa.int32())] +
+            [("BlackPercentage", pa.float32()), ("WhitePercentage", pa.float32())]
+        )
     
-    def setup(self, filename_scores):
+    def setup(self, filename_scores, checkpoint=None):
+        """ Open scores files, with a checkpoint scores are written in part files committed every checkpoint_every batches. """
         self.filename_scores = filename_scores
-        self.csv_connector_scores = open(self.filename_scores, "w")
+        self.checkpoint = checkpoint if self.checkpoint_every > 0 else None
+        self.batches = self.checkpoint.batches if self.checkpoint else 0
+        self.batches_in_part, self.last_tile = 0, None
 
-    def generator(self):
-        """ Write in csv file"""
-        classe_to_write = ",".join(self.classes)
-        self.csv_connector_scores.write(f"FileName,{classe_to_write},GPSLatitude,GPSLongitude\n")
+        if self.checkpoint is None:
+            self.parquet_writer_scores = pq.ParquetWriter(self.filename_scores, self.schema)
+        else:
+            # Drop parts written after the last commit.
+            for part in self.filename_scores.parent.glob(f"{self.filename_scores.stem}.part*.parquet"):
+                if part.name not in self.checkpoint.parts:
+                    part.unlink()
+            self.open_part()
+
+        if self.export_csv:
+            self.filename_scores_csv = self.filename_scores.with_suffix(".csv")
+            if self.checkpoint and self.checkpoint.resumed:
+                # Drop rows written after the last commit.
+                self.csv_connector_scores = open(self.filename_scores_csv, "r+")
+                self.csv_connector_scores.truncate(self.checkpoint.csv_offset)
+                self.csv_connector_scores.seek(self.checkpoint.csv_offset)
+            else:
+                self.csv_connector_scores = open(self.filename_scores_csv, "w")
+                self.csv_connector_scores.write(csv_header(self.classes))
+
+    def open_part(self):
+        self.part_path = Path(self.filename_scores.parent, f"{self.filename_scores.stem}.part{len(self.checkpoint.parts):05d}.parquet")
+        self.parquet_writer_scores = pq.ParquetWriter(self.part_path, self.schema)
 
+    def commit(self):
+        """ Close the current part file and record it with the last saved tile in the checkpoint. """
+        self.parquet_writer_scores.close()
 
+        csv_offset = 0
+        if self.csv_connector_scores:
+            self.csv_connector_scores.flush()
+            os.fsync(self.csv_connector_scores.fileno())
+            csv_offset = self.csv_connector_scores.tell()
+
+        self.checkpoint.commit(self.part_path.name, self.last_tile, self.batches, csv_offset)
+        self.batches_in_part = 0
+
+    def write_batch(self, frame_paths, scores, positions, grid_index, filter_stats=None):
+        """
+            Write a batch of float32 scores (B, n_classes), positions (B, 2) as lon, lat, tile grid positions (B, 2) as row, col
+            and percentages of black and white pixels (B, 2), NaN if tiles were not read like with cached scores.
+        """
+        if filter_stats is None:
+            filter_stats = np.full((len(frame_paths), 2), np.nan, dtype=np.float32)
+
+        columns = [pa.array(frame_paths, type=pa.string())]
+        columns += [pa.array(scores[:, i], type=pa.float32()) for i in range(len(self.classes))]
+        columns += [pa.array(positions[:, 1], type=pa.float64()), pa.array(positions[:, 0], type=pa.float64())]
+        columns += [pa.array(grid_index[:, 0], type=pa.int32()), pa.array(grid_index[:, 1], type=pa.int32())]
+        columns += [pa.array(filter_stats[:, 0], type=pa.float32()), pa.array(filter_stats[:, 1], type=pa.float32())]
+        self.parquet_writer_scores.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+        if self.csv_connector_scores:
+            self.csv_connector_scores.write(csv_rows(frame_paths, scores, positions[:, 1], positions[:, 0]))
+
+        if self.checkpoint:
+            self.batches += 1
+            self.batches_in_part += 1
+            self.last_tile = grid_index[-1]
+            if self.batches_in_part >= self.checkpoint_every:
+                self.commit()
+                self.open_part()
+
+    def generator(self):
+        """ Write in parquet file, and csv file if asked"""
         data = None
         stop = False
         while self.has_next() and not stop:
@@ -29,11 +134,36 @@ class  MultilabelPredictions(Pipeline):
 
             if not stop and data:
                 if "multilabel_scores" in data:
-                    for i, frame_path in enumerate(data["frame_paths"]):
-                        lon, lat = data['frames_position'][i]
-                        self.csv_connector_scores.write(f"{frame_path},{','.join(data['multilabel_scores'][i])},{lat},{lon}\n")
+                    filter_stats = np.asarray(data["frames_filter_stats"]) if "frames_filter_stats" in data else None
+                    self.write_batch(data["frame_paths"], data["multilabel_scores"], np.asarray(data["frames_position"]), np.asarray(data["frames_grid_index"]), filter_stats)
             
                 yield data
     
     def cleanup(self):
-        self.csv_connector_scores.close()
\ No newline at end of file
+        if self.checkpoint:
+            # Commit the last part, drop it if empty.
+            if self.batches_in_part > 0:
+                self.commit()
+            else:
+                self.parquet_writer_scores.close()
+                self.part_path.unlink()
+        else:
+            self.parquet_writer_scores.close()
+
+        if self.csv_connector_scores:
+            self.csv_connector_scores.close()
+            self.csv_connector_scores = None
+
+        if self.checkpoint:
+            self.merge_parts()
+
+    def merge_parts(self):
+        """ Concatenate committed part files in the scores file. """
+        parts = [Path(self.filename_scores.parent, part) for part in self.checkpoint.parts]
+        with pq.ParquetWriter(self.filename_scores, self.schema) as writer:
+            for part in parts:
+                writer.write_table(pq.read_table(part, schema=self.schema))
+
+        self.checkpoint.finish()
+        for part in parts:
+            part.unlink()
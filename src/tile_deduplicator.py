@@ -0,0 +1,254 @@
+import numpy as np
+
+from .pipeline import Pipeline
+from .libs.tile_grid import TileGrid
+
+
+def is_tile_field(key: str) -> bool:
+    """ Fields with one value by tile of the batch, like frames, frame_paths or frames_grid_index. """
+    return key.startswith("frame")
+
+
+def select_tiles(values, positions: np.ndarray):
+    if isinstance(values, list):
+        return [values[i] for i in positions]
+    return np.asarray(values)[positions]
+
+
+def merge_tiles(kept_values, dropped_values, kept: np.ndarray, dropped: np.ndarray, size: int):
+    """ Rebuild a tile field of the whole batch from its kept and dropped tiles. """
+    if isinstance(kept_values, list):
+        values = [None] * size
+        for i, value in zip(kept, kept_values):
+            values[i] = value
+        for i, value in zip(dropped, dropped_values):
+            values[i] = value
+        return values
+
+    kept_values, dropped_values = np.asarray(kept_values), np.asarray(dropped_values)
+    values = np.empty((size, *kept_values.shape[1:]), dtype=kept_values.dtype)
+    values[kept], values[dropped] = kept_values, dropped_values
+    return values
+
+
+class CoarseScores(Pipeline):
+    """Pipeline task to collect the scores of a coarse pass on one tile every step rows and columns"""
+
+    def __init__(self, step: int, threshold: float):
+        super(CoarseScores, self).__init__()
+
+        self.step = step
+        self.threshold = threshold
+
+    def setup(self, tile_grid: TileGrid, n_classes: int) -> None:
+        """ Coarse grid of NaN scores, filled by the coarse pass. """
+        self.tile_grid = tile_grid
+        coarse_mask = tile_grid.coarse_mask(self.step).reshape(tile_grid.shape)
+        self.coarse_rows = np.flatnonzero(coarse_mask.any(axis=1))
+        self.coarse_cols = np.flatnonzero(coarse_mask.any(axis=0))
+        self.scores = np.full((len(self.coarse_rows), len(self.coarse_cols), n_classes), np.nan, dtype=np.float32)
+        self.tiles = 0
+
+    def generator(self):
+        data = None
+        stop = False
+        while self.has_next() and not stop:
+            try:
+                data = next(self.source)
+            except StopIteration:
+                stop = True
+
+            if not stop and data:
+                grid_index = np.asarray(data["frames_grid_index"])
+                rows = np.searchsorted(self.coarse_rows, grid_index[:, 0])
+                cols = np.searchsorted(self.coarse_cols, grid_index[:, 1])
+                self.scores[rows, cols] = data["multilabel_scores"]
+                self.tiles += len(grid_index)
+
+                yield data
+
+    def bracket(self, positions: np.ndarray, coarse_positions: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Coarse positions before and after each position, and the nearest of both. """
+        after = np.minimum(np.searchsorted(coarse_positions, positions), len(coarse_positions) - 1)
+        before = np.where(coarse_positions[after] <= positions, after, np.maximum(after - 1, 0))
+        nearest = np.where(positions - coarse_positions[before] <= coarse_positions[after] - positions, before, after)
+        return before, after, nearest
+
+    def lookup(self, grid_index: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Return the scores of the nearest coarse tile and a refine flag of each tile.
+            A tile is refined if the scores of the four coarse tiles around it differ by more than the threshold or one of them is missing.
+        """
+        grid_index = np.asarray(grid_index)
+        r0, r1, r = self.bracket(grid_index[:, 0], self.coarse_rows)
+        c0, c1, c = self.bracket(grid_index[:, 1], self.coarse_cols)
+
+        corners = np.stack((self.scores[r0, c0], self.scores[r0, c1], self.scores[r1, c0], self.scores[r1, c1]), axis=1)
+        spread = np.ptp(corners, axis=1).max(axis=1)
+
+        # Missing corners give a NaN spread, those tiles are refined.
+        return self.scores[r, c], ~(spread <= self.threshold)
+
+
+class TileDeduplicator(Pipeline):
+    """
+        Pipeline task to drop tiles before the classifier, their scores are copied by a DuplicateScoresExpander after it.
+        A tile is dropped if its signature is close to a recent inferred tile, or if the coarse scores around it agree.
+    """
+
+    def __init__(self, threshold: float | None, window: int = 256, signature_size: int = 8):
+        super(TileDeduplicator, self).__init__()
+
+        self.threshold = threshold
+        self.window = window
+        self.signature_size = signature_size
+
+    def setup(self, coarse_scores: CoarseScores | None = None) -> None:
+        """ Reset recent signatures, copy scores of the coarse pass if set. """
+        self.coarse_scores = coarse_scores
+
+        # Signatures and unique ids of the last inferred tiles, slot of a tile is its unique id modulo the window.
+        self.signatures, self.next_id = None, 0
+        self.ids = np.full(self.window, -1, dtype=np.int64)
+        self.tiles, self.duplicates, self.coarse_copies = 0, 0, 0
+
+    def signature(self, frames: np.ndarray) -> np.ndarray:
+        """ Mean and standard deviation of each band on a signature_size x signature_size grid of cells, (B, D) array. """
+        edges = np.linspace(0, frames.shape[1], self.signature_size + 1).astype(np.int64)
+        cells = np.diff(edges)
+        cell_pixels = (cells[:, None] * cells[None, :])[None, :, :, None]
+
+        sums = np.add.reduceat(np.add.reduceat(frames, edges[:-1], axis=1, dtype=np.float64), edges[:-1], axis=2)
+        squares = np.add.reduceat(np.add.reduceat(np.square(frames, dtype=np.float64), edges[:-1], axis=1), edges[:-1], axis=2)
+        mean = sums / cell_pixels
+        std = np.sqrt(np.maximum(squares / cell_pixels - mean**2, 0))
+        return np.concatenate((mean.reshape(len(frames), -1), std.reshape(len(frames), -1)), axis=1).astype(np.float32)
+
+    def deduplicate(self, data: dict) -> dict:
+        frames = data["frames"]
+        size = len(frames)
+
+        # Id of the inferred tile whose scores are copied, -1 for coarse scores.
+        references = np.full(size, -2, dtype=np.int64)
+        unique_ids = np.full(size, -1, dtype=np.int64)
+
+        coarse = None
+        if self.coarse_scores is not None:
+            coarse, refine = self.coarse_scores.lookup(data["frames_grid_index"])
+            references[~refine] = -1
+
+        to_infer = np.flatnonzero(references == -2)
+        signatures = self.signature(frames[to_infer]) if self.threshold is not None and len(to_infer) > 0 else None
+        if signatures is not None and self.signatures is None:
+            self.signatures = np.full((self.window, signatures.shape[1]), np.inf, dtype=np.float32)
+
+        for k, i in enumerate(to_infer):
+            if signatures is not None:
+                # Mean absolute difference of the signatures, in [0, 1].
+                distances = np.abs(self.signatures - signatures[k]).mean(axis=1) / 255
+                slot = int(np.argmin(distances))
+                if distances[slot] <= self.threshold:
+                    references[i] = self.ids[slot]
+                    continue
+                self.signatures[self.next_id % self.window] = signatures[k]
+                self.ids[self.next_id % self.window] = self.next_id
+
+            unique_ids[i] = self.next_id
+            self.next_id += 1
+
+        kept, dropped = np.flatnonzero(references == -2), np.flatnonzero(references != -2)
+        self.tiles += size
+        self.duplicates += int(np.count_nonzero(references >= 0))
+        self.coarse_copies += int(np.count_nonzero(references == -1))
+
+        dedup = {
+            "size": size,
+            "kept": kept,
+            "dropped": dropped,
+            "references": references[dropped],
+            "unique_ids": unique_ids[kept],
+            "coarse_scores": coarse[dropped] if coarse is not None else None,
+            "fields": {}
+        }
+
+        # Drop the tiles from the batch, frames of dropped tiles are released.
+        for key in [key for key in data if is_tile_field(key)]:
+            if key != "frames":
+                dedup["fields"][key] = select_tiles(data[key], dropped)
+            data[key] = select_tiles(data[key], kept)
+        data["dedup"] = dedup
+        return data
+
+    def generator(self):
+        data = None
+        stop = False
+        while self.has_next() and not stop:
+            try:
+                data = next(self.source)
+            except StopIteration:
+                stop = True
+
+            if not stop and data:
+                yield self.deduplicate(data)
+
+        if self.metrics is not None:
+            inferred = self.tiles - self.duplicates - self.coarse_copies
+            self.metrics.counters["deduplication"] = {
+                "tiles": self.tiles,
+                "inferred": inferred,
+                "duplicates": self.duplicates,
+                "coarse_copies": self.coarse_copies,
+                "coarse_pass_tiles": self.coarse_scores.tiles if self.coarse_scores is not None else 0,
+                "skip_rate": round(1 - inferred / self.tiles, 4) if self.tiles > 0 else None
+            }
+
+
+class DuplicateScoresExpander(Pipeline):
+    """Pipeline task to copy the scores of the tiles dropped by a TileDeduplicator and rebuild the whole batch"""
+
+    def __init__(self, window: int = 256):
+        super(DuplicateScoresExpander, self).__init__()
+
+        self.window = window
+        self.scores = None
+
+    def expand(self, data: dict) -> dict:
+        dedup = data.pop("dedup")
+        kept, dropped, references = dedup["kept"], dedup["dropped"], dedup["references"]
+        scores = np.asarray(data["multilabel_scores"])
+
+        # Scores of the last inferred tiles, same slots as the signatures of the deduplicator.
+        if self.scores is None:
+            self.scores = np.full((self.window, scores.shape[1]), np.nan, dtype=scores.dtype)
+
+        # References to tiles of earlier batches are read before the tiles of this batch take their slots.
+        unique_ids = dedup["unique_ids"]
+        dropped_scores = np.empty((len(dropped), scores.shape[1]), dtype=scores.dtype)
+        duplicates = references >= 0
+        in_batch = duplicates & np.isin(references, unique_ids)
+        earlier = duplicates & ~in_batch
+        dropped_scores[earlier] = self.scores[references[earlier] % self.window]
+        dropped_scores[in_batch] = scores[np.searchsorted(unique_ids, references[in_batch])]
+        if dedup["coarse_scores"] is not None:
+            dropped_scores[~duplicates] = dedup["coarse_scores"][~duplicates]
+
+        self.scores[unique_ids % self.window] = scores
+
+        # Batch is back in its original order, frames are not kept as only inferred tiles have them.
+        data.pop("frames", None)
+        data["multilabel_scores"] = merge_tiles(scores, dropped_scores, kept, dropped, dedup["size"])
+        for key, dropped_values in dedup["fields"].items():
+            data[key] = merge_tiles(data[key], dropped_values, kept, dropped, dedup["size"])
+        return data
+
+    def generator(self):
+        data = None
+        stop = False
+        while self.has_next() and not stop:
+            try:
+                data = next(self.source)
+            except StopIteration:
+                stop = True
+
+            if not stop and data:
+                yield self.expand(data) if "dedup" in data else data
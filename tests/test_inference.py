@@ -0,0 +1,81 @@
+import json
+import os
+import pytest
+from pathlib import Path
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("rasterio")
+
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+os.environ["HF_HUB_OFFLINE"] = "1"
+
+from inference import parse_args, pipeline_seatizen
+from benchmarks.tiny_model import make_tiny_model, TINY_REPO_NAME
+from benchmarks.synthetic_session import make_session
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    """ Small synthetic session and tiny model, models are loaded from the working directory. """
+    monkeypatch.chdir(tmp_path)
+    make_tiny_model(TINY_REPO_NAME)
+    return make_session(Path(tmp_path, "sessions"), width=512, height=512)
+
+
+def run(session: Path, *args: str) -> None:
+    pipeline_seatizen(parse_args(["-eses", "-pses", str(session), "-mlu", TINY_REPO_NAME, "-bs", "8", "-np", "-nsi", *args]))
+
+
+def scores_path(session: Path) -> Path:
+    return Path(session, "PROCESSED_DATA", "IA", f"{session.name}_{TINY_REPO_NAME.replace('/', '_')}_scores.parquet")
+
+
+def test_postprocess_only_session_with_score_cache(session, tmp_path, capsys):
+    cache_dir = str(Path(tmp_path, "cache"))
+    run(session, "-npr", "-scd", cache_dir)
+    inferred_mtime = scores_path(session).stat().st_mtime_ns
+    capsys.readouterr()
+
+    # Only an output argument changes, scores are kept and the session is only post-processed.
+    run(session, "-npr", "-xcsv", "-scd", cache_dir)
+    output = capsys.readouterr().out
+    assert "only post-process it" in output
+    assert "Start prediction session" not in output
+    assert scores_path(session).stat().st_mtime_ns == inferred_mtime
+    assert scores_path(session).with_suffix(".csv").exists()
+
+    run(session, "-npr", "-xcsv", "-scd", cache_dir)
+    assert "is up to date, skip it" in capsys.readouterr().out
+
+
+def test_postprocess_only_session_skips_coarse_pass(session, capsys):
+    run(session, "-npr", "-cs", "3")
+    metrics_path = Path(session, "PROCESSED_DATA", "IA", f"{session.name}_pipeline_metrics.json")
+    inferred_metrics = json.loads(metrics_path.read_text())
+    capsys.readouterr()
+
+    run(session, "-npr", "-cs", "3", "-xcsv")
+    output = capsys.readouterr().out
+    assert "only post-process it" in output
+    assert "Coarse pass" not in output
+
+    # Metrics of the run that inferred the scores are kept.
+    assert json.loads(metrics_path.read_text())["stages"] == inferred_metrics["stages"]
+
+
+def test_postprocess_only_session_leaves_no_embedding_store_open(session):
+    run(session, "-npr", "-sem")
+    run(session, "-npr", "-sem", "-xcsv")
+
+    path_IA = Path(session, "PROCESSED_DATA", "IA")
+    assert Path(path_IA, f"{session.name}_embeddings", "meta.json").exists()
+    assert not Path(path_IA, f"{session.name}_embeddings.tmp").exists()
+
+
+def test_torchscript_export_leaves_only_the_artifact(session, tmp_path):
+    run(session, "-npr", "-bk", "torchscript", "-q", "int8")
+
+    export_path = Path(tmp_path, "models", "multilabel", TINY_REPO_NAME, "exported")
+    exported = list(export_path.iterdir())
+    assert len(exported) == 1 and exported[0].name.startswith("torchscript_int8_") and ".tmp-" not in exported[0].name
@@ -0,0 +1,17 @@
+import sys
+import numpy as np
+import pytest
+
+from src.libs.metrics import SessionMetrics
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Peak of a session needs /proc/self/clear_refs")
+def test_peak_rss_is_reset_by_session():
+    first = SessionMetrics("first")
+    allocated = np.ones(256 * 1024 * 1024 // 8)
+    first_peak = first.report()["peak_rss_MB"]
+    del allocated
+
+    # The peak of the previous session isn't reported by the next one.
+    second = SessionMetrics("second")
+    assert second.report()["peak_rss_MB"] < first_peak - 128
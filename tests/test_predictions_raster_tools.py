@@ -0,0 +1,148 @@
+import pytest
+import numpy as np
+from pathlib import Path
+from math import radians, cos, sin, sqrt, atan2
+
+pytest.importorskip("geocube")
+pytest.importorskip("scipy")
+
+import pandas as pd
+import rasterio
+from affine import Affine
+from pyproj import Transformer
+from scipy.interpolate import griddata
+from scipy.spatial import ConvexHull
+from matplotlib.path import Path as HullPath
+
+from src.libs.tile_grid import TileGrid
+from src.libs.predictions_raster_tools import (
+    compute_grid_value, prepare_gridded_data, create_rasters_for_classes, create_rasters_for_classes_streaming,
+    create_raster_from_tile_grid, create_raster_from_tile_grid_streaming
+)
+
+
+CLASSES = ["Sand", "Rock", "Algae/Coral"]
+
+
+def make_tile_grid() -> TileGrid:
+    """ 40 x 30 tiles of 1.5 m in UTM 40S, on the west coast of Reunion. """
+    transformer = Transformer.from_crs("EPSG:32740", "EPSG:4326", always_xy=True)
+    return TileGrid(Affine(0.015, 0, 315000, 0, -0.015, 7665000), 4000, 3000, 100, 100, 100, transformer)
+
+
+def make_predictions(tile_grid: TileGrid, seed: int = 0) -> pd.DataFrame:
+    """ Scores of the tiles kept in an irregular footprint, in tile grid order. """
+    rng = np.random.default_rng(seed)
+    rows, cols = tile_grid.grid_index(np.arange(len(tile_grid))).T
+    kept = (rows + cols > 5) & (rows - cols < 20) & (rng.random(len(tile_grid)) > 0.1)
+    indexes = np.flatnonzero(kept)
+    predictions = pd.DataFrame({
+        "FileName": [f"tile_{index}.jpg" for index in indexes],
+        "GPSLatitude": tile_grid.lonlat[indexes, 1],
+        "GPSLongitude": tile_grid.lonlat[indexes, 0],
+        "TileRow": rows[indexes],
+        "TileCol": cols[indexes]
+    })
+    for class_name in CLASSES:
+        predictions[class_name] = rng.random(len(indexes)).astype(np.float32)
+    return predictions
+
+
+@pytest.fixture
+def scores_path(tmp_path):
+    path = Path(tmp_path, "scores.parquet")
+    make_predictions(make_tile_grid()).to_parquet(path)
+    return path
+
+
+def read_raster(path: Path) -> tuple[np.ndarray, Affine]:
+    with rasterio.open(path) as src:
+        return src.read(1), src.transform
+
+
+def class_raster(output_path: Path, class_name: str) -> Path:
+    return Path(output_path, f"S_{class_name.replace('/', '_')}_classification_multilabel_raster.tif")
+
+
+def test_grid_value_and_hull_mask_match_the_loops():
+    predictions = make_predictions(make_tile_grid())
+
+    # Previous implementation, one scalar haversine by pair of rows.
+    def haversine(point1, point2):
+        lat1, lon1, lat2, lon2 = map(radians, [*point1, *point2])
+        a = sin((lat2 - lat1) / 2)**2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2)**2
+        return 6371000 * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    distances = [
+        haversine(
+            (predictions.iloc[i]['GPSLatitude'], predictions.iloc[i]['GPSLongitude']),
+            (predictions.iloc[i + 1]['GPSLatitude'], predictions.iloc[i + 1]['GPSLongitude'])
+        )
+        for i in range(len(predictions) - 1)
+    ]
+    assert compute_grid_value(predictions) == pytest.approx(np.median(distances), rel=1e-12)
+
+    points = predictions[['GPSLongitude', 'GPSLatitude']].values
+    hull_path = HullPath(points[ConvexHull(points).vertices])
+    grid = points + 0.3e-5
+    np.testing.assert_array_equal(hull_path.contains_points(grid), [hull_path.contains_point(point) for point in grid])
+
+
+def test_gridded_data_matches_griddata_by_class():
+    predictions = make_predictions(make_tile_grid())
+    grid_value = compute_grid_value(predictions)
+    gridded, lat_spacing, lon_spacing = prepare_gridded_data(predictions, CLASSES, grid_value, "linear")
+
+    # Previous implementation, griddata on the whole grid by class then the hull mask.
+    grid_x, grid_y = np.meshgrid(
+        np.arange(predictions['GPSLongitude'].min(), predictions['GPSLongitude'].max(), lon_spacing),
+        np.arange(predictions['GPSLatitude'].min(), predictions['GPSLatitude'].max(), lat_spacing)
+    )
+    points = predictions[['GPSLongitude', 'GPSLatitude']].values
+    hull_path = HullPath(points[ConvexHull(points).vertices])
+    mask = hull_path.contains_points(np.column_stack((grid_x.ravel(), grid_y.ravel())))
+    for class_index, class_name in enumerate(CLASSES):
+        grid_z = griddata(points, predictions[class_name].values, (grid_x, grid_y), method="linear").ravel()
+        expected = np.column_stack((grid_x.ravel(), grid_y.ravel(), grid_z))[mask]
+        expected = expected[~np.isnan(expected[:, 2])]
+
+        values = gridded[:, 2 + class_index]
+        np.testing.assert_allclose(np.column_stack((gridded[:, :2], values))[~np.isnan(values)], expected, rtol=0, atol=1e-12)
+
+
+def test_raster_workers_write_the_same_rasters(scores_path, tmp_path):
+    serial, pool = Path(tmp_path, "serial"), Path(tmp_path, "pool")
+    serial.mkdir(), pool.mkdir()
+    create_rasters_for_classes(scores_path, CLASSES, serial, "S", "linear")
+    create_rasters_for_classes(scores_path, CLASSES, pool, "S", "linear", workers=2)
+
+    for class_name in CLASSES:
+        np.testing.assert_array_equal(read_raster(class_raster(pool, class_name))[0], read_raster(class_raster(serial, class_name))[0])
+
+
+# One grid row by window, windows of a few rows, the whole grid in one window.
+@pytest.mark.parametrize("window_bytes", [1, 64 * 1024, 1 << 30])
+def test_streaming_rasters_match_geocube(scores_path, tmp_path, window_bytes):
+    reference, streaming = Path(tmp_path, "reference"), Path(tmp_path, "streaming")
+    reference.mkdir(), streaming.mkdir()
+    create_rasters_for_classes(scores_path, CLASSES, reference, "S", "linear")
+
+    create_rasters_for_classes_streaming(scores_path, CLASSES, streaming, "S", "linear", window_bytes)
+    for class_name in CLASSES:
+        expected, expected_transform = read_raster(class_raster(reference, class_name))
+        values, transform = read_raster(class_raster(streaming, class_name))
+        np.testing.assert_array_equal(values, expected)
+        np.testing.assert_allclose(transform[:6], expected_transform[:6], rtol=1e-9)
+    assert not any(path.suffix == ".tmp" for path in streaming.iterdir())
+
+
+def test_streaming_grid_raster_matches_cog(scores_path, tmp_path):
+    tile_grid = make_tile_grid()
+    create_raster_from_tile_grid(scores_path, CLASSES, tile_grid, "EPSG:32740", tmp_path, "reference")
+    create_raster_from_tile_grid_streaming(scores_path, CLASSES, tile_grid, "EPSG:32740", tmp_path, "streaming", 4 * 1024)
+
+    with rasterio.open(Path(tmp_path, "reference_classification_multilabel_raster_grid.tif")) as reference, \
+         rasterio.open(Path(tmp_path, "streaming_classification_multilabel_raster_grid.tif")) as streaming:
+        np.testing.assert_array_equal(streaming.read(), reference.read())
+        assert streaming.transform == reference.transform
+        assert streaming.descriptions == reference.descriptions
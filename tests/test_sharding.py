@@ -0,0 +1,36 @@
+from pathlib import Path
+
+from src.libs.sharding import SessionClaims
+from src.libs.session_scheduler import SessionScheduler
+
+
+def test_session_can_be_claimed_again_after_its_end(tmp_path):
+    claims = SessionClaims(Path(tmp_path, "claims"))
+    session = Path(tmp_path, "20240101_REU-SESSION_UAV-01_01")
+
+    assert claims.claim(session)
+    assert not claims.claim(session)
+
+    # The manifest of the session decides if a later run skips it.
+    claims.release(session, True)
+    assert claims.summary() == ([str(session)], [])
+    assert claims.claim(session)
+    claims.release(session, False)
+    assert claims.summary() == ([], [str(session)])
+    assert claims.claim(session)
+
+
+def test_sessions_of_the_same_name_are_released_apart(tmp_path):
+    claims = SessionClaims(Path(tmp_path, "claims"))
+    first, second = Path(tmp_path, "a", "20240101_REU-SESSION_UAV-01_01"), Path(tmp_path, "b", "20240101_REU-SESSION_UAV-01_01")
+    assert claims.claim(first) and claims.claim(second)
+
+    def fail():
+        raise ValueError("post-processing failed")
+
+    scheduler = SessionScheduler(0, 1, claims.release)
+    scheduler.submit(first, lambda: None)
+    scheduler.submit(second, fail)
+    assert scheduler.drain() == [second.name]
+
+    assert claims.summary() == ([str(first)], [str(second)])
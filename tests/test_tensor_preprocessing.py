@@ -0,0 +1,33 @@
+import json
+import pytest
+import numpy as np
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from src.libs.tensor_preprocessing import TensorImageProcessor, FAST_PREPROCESSING_TOLERANCE
+
+
+# Image processor of the DINOv2 models.
+DINOV2_CONFIG = {
+    "image_processor_type": "BitImageProcessor",
+    "do_resize": True, "size": {"shortest_edge": 256}, "resample": 3,
+    "do_center_crop": True, "crop_size": {"height": 224, "width": 224},
+    "do_rescale": True, "rescale_factor": 1 / 255,
+    "do_normalize": True, "image_mean": [0.485, 0.456, 0.406], "image_std": [0.229, 0.224, 0.225],
+    "do_convert_rgb": True
+}
+
+
+# Tiles of 1.5 meters at 1.5 cm and 0.5 cm of GSD, and a tile larger than the model input.
+@pytest.mark.parametrize("tile_size", [100, 300, 512])
+def test_fast_preprocessing_matches_image_processor(tmp_path, tile_size):
+    with open(tmp_path / "preprocessor_config.json", "w") as f:
+        json.dump(DINOV2_CONFIG, f)
+    image_processor = transformers.AutoImageProcessor.from_pretrained(tmp_path, local_files_only=True)
+    fast_processor = TensorImageProcessor.from_pretrained(tmp_path, torch.device("cpu"))
+
+    frames = np.random.default_rng(0).integers(0, 256, (4, tile_size, tile_size, 3), dtype=np.uint8)
+    mean_diff, _ = fast_processor.compare(image_processor, frames)
+    assert fast_processor(frames).shape == (4, 3, 224, 224)
+    assert mean_diff <= FAST_PREPROCESSING_TOLERANCE
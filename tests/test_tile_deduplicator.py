@@ -0,0 +1,57 @@
+import numpy as np
+
+from src.tile_deduplicator import TileDeduplicator, DuplicateScoresExpander
+
+
+def make_batch(values: list[int], first_index: int) -> dict:
+    """ Batch of uniform 16x16 tiles, tile k filled with values[k]. """
+    frames = np.stack([np.full((16, 16, 3), value, dtype=np.uint8) for value in values])
+    indexes = np.arange(first_index, first_index + len(values))
+    return {
+        "frames": frames,
+        "frame_paths": [f"tile_{index}.png" for index in indexes],
+        "frames_grid_index": np.column_stack((np.zeros_like(indexes), indexes))
+    }
+
+
+def classify(data: dict) -> dict:
+    """ Score of a tile is its pixel value, in place of the classifier. """
+    data["multilabel_scores"] = data["frames"][:, 0, 0, :1].astype(np.float32)
+    return data
+
+
+def run(deduplicator: TileDeduplicator, expander: DuplicateScoresExpander, batches: list[list[int]]) -> list[np.ndarray]:
+    outputs, first_index = [], 0
+    for values in batches:
+        data = expander.expand(classify(deduplicator.deduplicate(make_batch(values, first_index))))
+        outputs.append(data["multilabel_scores"][:, 0])
+        first_index += len(values)
+    return outputs
+
+
+def test_duplicate_of_a_slot_reused_in_the_same_batch():
+    deduplicator, expander = TileDeduplicator(0.01, window=4), DuplicateScoresExpander(window=4)
+    deduplicator.setup()
+
+    # The duplicate of tile 0 is read before the new tile 200 takes the slot of tile 0.
+    outputs = run(deduplicator, expander, [[0, 50, 100, 150], [0, 200]])
+    np.testing.assert_array_equal(outputs[1], [0, 200])
+
+
+def test_duplicate_of_a_tile_of_the_same_batch():
+    deduplicator, expander = TileDeduplicator(0.01, window=4), DuplicateScoresExpander(window=4)
+    deduplicator.setup()
+
+    outputs = run(deduplicator, expander, [[0, 50, 100, 150], [200, 100, 200, 250]])
+    np.testing.assert_array_equal(outputs[1], [200, 100, 200, 250])
+    assert deduplicator.duplicates == 2
+
+
+def test_batch_order_and_fields_are_restored():
+    deduplicator, expander = TileDeduplicator(0.01, window=8), DuplicateScoresExpander(window=8)
+    deduplicator.setup()
+
+    data = expander.expand(classify(deduplicator.deduplicate(make_batch([10, 10, 90, 10], 0))))
+    np.testing.assert_array_equal(data["multilabel_scores"][:, 0], [10, 10, 90, 10])
+    assert data["frame_paths"] == [f"tile_{index}.png" for index in range(4)]
+    np.testing.assert_array_equal(data["frames_grid_index"][:, 1], np.arange(4))